@@ -1,13 +1,28 @@
+import time
+STARTED_AT = time.perf_counter()  # для замера времени от импорта до приёма запросов
+
 import os
 import json
 import re
 import sys
+import random
+import calendar
+import collections
+import csv
+import itertools
+import sqlite3
+import tempfile
+import threading
+import zlib
+import contextvars
+from array import array
+from bisect import bisect_right
 from datetime import datetime, timedelta
 from flask import Flask, request
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 import requests
 
+# gspread и oauth2client тяжёлые — импортируются лениво в get_client()
+
 app = Flask(__name__)
 
 print("BOT STARTING", flush=True)
@@ -15,11 +30,25 @@ print("BOT STARTING", flush=True)
 # ============ НАСТРОЙКИ ============
 TOKEN = os.environ['BOT_TOKEN']
 SECRET = os.environ.get('WEBHOOK_SECRET', '')
-SHEET_ID = os.environ['SHEET_ID']
+SHEET_ID = os.environ.get('SHEET_ID', '')
+# Несколько клиник: JSON-список [{"id", "sheet_id", "contacts", "staff", "chats"}]
+TENANTS_JSON = os.environ.get('TENANTS_JSON', '')
+TENANT_IDLE_TTL = int(os.environ.get('TENANT_IDLE_TTL', 1800))  # секунд до выгрузки данных клиники
+TENANT_MAX_BYTES = int(os.environ.get('TENANT_MAX_BYTES', 64 * 1024 * 1024))
 GOOGLE_CREDS = os.environ.get('GOOGLE_CREDS_JSON', '')
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 60))  # секунд до фонового обновления кэша
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', 'bdpj_snapshot.sqlite3')
+# Изменения за это время (секунд) сохраняются в снимок одной записью
+SNAPSHOT_DEBOUNCE = float(os.environ.get('SNAPSHOT_DEBOUNCE', 5))
+# Листы для поиска через запятую; пусто — все листы таблицы
+SEARCH_SHEETS = [name.strip() for name in os.environ.get('SEARCH_SHEETS', '').split(',') if name.strip()]
+SHEET_TITLES_TTL = int(os.environ.get('SHEET_TITLES_TTL', 600))
+# Между полными перечитываниями листа догружаем только новые строки
+FULL_REFRESH_INTERVAL = int(os.environ.get('FULL_REFRESH_INTERVAL', 600))
 
 print(f"TOKEN loaded: {bool(TOKEN)}", flush=True)
 print(f"SHEET_ID loaded: {bool(SHEET_ID)}", flush=True)
+print(f"TENANTS_JSON loaded: {bool(TENANTS_JSON)}", flush=True)
 print(f"GOOGLE_CREDS loaded: {bool(GOOGLE_CREDS)}", flush=True)
 
 # Эмодзи стиль
@@ -46,7 +75,9 @@ EMOJI = {
     'check': '✓',
     'cross': '✕',
     'clock': '🕐',
-    'location': '📍'
+    'location': '📍',
+    'edit': '✏️',
+    'archive': '🗄'
 }
 
 # ============ ВАЛИДАТОРЫ ДАННЫХ ============
@@ -288,61 +319,1545 @@ class DataValidator:
         except ValueError:
             return None, "Неверное число"
 
+# ============ КЛИНИКИ (ТЕНАНТЫ) ============
+# Один процесс обслуживает несколько клиник. У каждой своя таблица, контакты,
+# сотрудники, кэш листов и снимок на диске; учётные данные Google,
+# HTTP-соединения, бюджет запросов и предохранитель Sheets — общие.
+DEFAULT_CONTACTS = f"{EMOJI['paw']} Ветеринарная клиника\n\n{EMOJI['phone']} +7 (XXX) XXX-XX-XX\n{EMOJI['clock']} Пн-Пт: 9:00-18:00\n{EMOJI['clock']} Сб: 9:00-14:00"
+
+def normalize_staff(user):
+    """@Username, username и username с пробелами — один и тот же сотрудник"""
+    return str(user).strip().lower().lstrip('@')
+
+def tenant_snapshot_path(tenant_id):
+    root, ext = os.path.splitext(SNAPSHOT_PATH)
+    return f"{root}.{tenant_id}{ext or '.sqlite3'}"
+
+class Tenant:
+    """Клиника: своя таблица, контакты, сотрудники, кэши и очередь записей"""
+    
+    def __init__(self, tenant_id, sheet_id, contacts=None, staff=(), chats=(), snapshot_path=None):
+        self.id = tenant_id
+        self.sheet_id = sheet_id
+        self.contacts = contacts or DEFAULT_CONTACTS
+        self.staff = {normalize_staff(user) for user in staff}
+        self.chats = {str(chat) for chat in chats}
+        self.snapshot_path = snapshot_path or tenant_snapshot_path(tenant_id)
+        self.records_cache = {}
+        self.header_maps = {}
+        self.spreadsheet = None
+        self.worksheets = {}
+        self.sheet_titles = {'titles': [], 'loaded_at': 0}
+        self.pending_writes = []
+        self.sms_log = {}  # ключ записи -> отправленное SMS-напоминание и его статус
+        self.refreshing = set()
+        self.last_access = time.time()
+        self.loaded = False  # снимок с диска уже в памяти
+        self.load_lock = threading.Lock()  # снимок загружается один раз, остальные ждут
+        # Проверка строк и запись по их номерам (правки, удаление архивом) — без промежутков:
+        # иначе удаление между проверкой и записью сдвинет строки под правкой
+        self.write_lock = threading.Lock()
+        self.saved_sheets = {}  # лист -> (id хранилища, версия), уже записанные в снимок
+        self.snapshot_due = False  # отложенное сохранение снимка уже запланировано
+    
+    def allows(self, user):
+        """Пустой список сотрудников — доступ у всех"""
+        return not self.staff or normalize_staff(user) in self.staff
+    
+    def memory_usage(self):
+        return sum(entry['records'].memory_usage() for entry in list(self.records_cache.values()))
+    
+    def evict(self):
+        """Выгрузить кэш из памяти (он остаётся в снимке); очередь записей не трогаем"""
+        with cache_lock:
+            self.records_cache.clear()
+            self.header_maps.clear()
+            self.loaded = False
+
+def load_tenants():
+    """Клиники из TENANTS_JSON; SHEET_ID задаёт клинику по умолчанию"""
+    result = {}
+    for item in json.loads(TENANTS_JSON) if TENANTS_JSON else []:
+        result[item['id']] = Tenant(item['id'], item['sheet_id'], item.get('contacts'),
+                                    item.get('staff', []), item.get('chats', []))
+    if SHEET_ID and 'default' not in result:
+        result['default'] = Tenant('default', SHEET_ID, snapshot_path=SNAPSHOT_PATH)
+    if not result:
+        raise RuntimeError('SHEET_ID or TENANTS_JSON must be set')
+    return result
+
+tenants = load_tenants()
+DEFAULT_TENANT = tenants.get('default') or next(iter(tenants.values()))
+chat_routes = {chat: t for t in tenants.values() for chat in t.chats}
+staff_routes = {user: t for t in tenants.values() for user in t.staff}
+current_tenant = contextvars.ContextVar('tenant', default=None)
+_last_sweep = [0.0]
+
+print(f"Tenants: {', '.join(tenants)}", flush=True)
+
+def tenant():
+    """Клиника текущего апдейта (или клиника по умолчанию)"""
+    return current_tenant.get() or DEFAULT_TENANT
+
+def route_tenant(chat_id, user):
+    """Клиника по чату, затем по сотруднику; иначе клиника по умолчанию (если есть)"""
+    return (chat_routes.get(str(chat_id)) or staff_routes.get(normalize_staff(user))
+            or tenants.get('default'))
+
+def run_for_tenant(t, func, *args):
+    """Выполнить func в контексте клиники t"""
+    def run():
+        current_tenant.set(t)
+        return func(*args)
+    return contextvars.copy_context().run(run)
+
+def start_thread(func, *args):
+    """Фоновый поток с контекстом текущей клиники (без очереди Bot API апдейта)"""
+    ctx = contextvars.copy_context()
+    ctx.run(_outbox.set, None)
+    threading.Thread(target=ctx.run, args=(func, *args), daemon=True).start()
+
+def activate_tenant(t):
+    """Отметить обращение к клинике; подгрузить её снимок, если он был выгружен"""
+    t.last_access = time.time()
+    current_tenant.set(t)
+    ensure_snapshot_loaded()
+    evict_idle_tenants()
+
+def evict_idle_tenants():
+    """Раз в минуту выгружаем кэши клиник, к которым давно не обращались"""
+    now = time.time()
+    if now - _last_sweep[0] < 60:
+        return
+    _last_sweep[0] = now
+    for t in list(tenants.values()):
+        if t.records_cache and now - t.last_access > TENANT_IDLE_TTL:
+            print(f"Tenant {t.id} idle for {int(now - t.last_access)} s, evicting cache", flush=True)
+            t.evict()
+
+def enforce_memory_limit(t):
+    """Держим кэш клиники в пределах TENANT_MAX_BYTES, выгружая давно не нужные листы"""
+    total = t.memory_usage()
+    if total <= TENANT_MAX_BYTES:
+        return
+    with cache_lock:
+        candidates = sorted((name for name in t.records_cache if name != 'Ввод_бот'),
+                            key=lambda name: t.records_cache[name].get('used_at', 0))
+    for name in candidates:
+        if total <= TENANT_MAX_BYTES:
+            break
+        entry = t.records_cache.pop(name, None)
+        if entry:
+            total -= entry['records'].memory_usage()
+            print(f"Tenant {t.id}: evicted sheet {name} from cache", flush=True)
+    if total > TENANT_MAX_BYTES:
+        print(f"Tenant {t.id}: cache {total} bytes exceeds TENANT_MAX_BYTES", flush=True)
+
 # ============ GOOGLE SHEETS ============
+_client = None
+_client_lock = threading.Lock()
+
 def get_client():
-    scope = ['https://spreadsheets.google.com/feeds', 
-             'https://www.googleapis.com/auth/drive']
-    
-    if GOOGLE_CREDS:
-        import tempfile
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as f:
-            f.write(GOOGLE_CREDS)
-            creds_path = f.name
-        creds = ServiceAccountCredentials.from_json_keyfile_name(creds_path, scope)
-    else:
-        creds = ServiceAccountCredentials.from_json_keyfile_name('credentials.json', scope)
+    """Клиент gspread создаётся один раз и переиспользуется между запросами"""
+    global _client
+    if _client is not None:
+        return _client
+    
+    with _client_lock:
+        if _client is None:
+            import gspread
+            from oauth2client.service_account import ServiceAccountCredentials
+            
+            scope = ['https://spreadsheets.google.com/feeds', 
+                     'https://www.googleapis.com/auth/drive']
+            
+            if GOOGLE_CREDS:
+                creds = ServiceAccountCredentials.from_json_keyfile_dict(json.loads(GOOGLE_CREDS), scope)
+            else:
+                creds = ServiceAccountCredentials.from_json_keyfile_name('credentials.json', scope)
+            
+            _client = gspread.authorize(creds)
+    return _client
+
+# ============ ДОСТУП К SHEETS: ПОВТОРЫ, КВОТА, ПРЕДОХРАНИТЕЛЬ ============
+# Все вызовы Google API идут через sheets_call(): ошибки 429/5xx/сеть
+# повторяются с экспоненциальной задержкой и джиттером, число запросов
+# в минуту ограничено, а после серии сбоев предохранитель размыкается
+# и бот работает с последними известными данными.
+SHEETS_BUDGET_PER_MIN = int(os.environ.get('SHEETS_BUDGET_PER_MIN', 50))
+SHEETS_MAX_RETRIES = int(os.environ.get('SHEETS_MAX_RETRIES', 3))
+SHEETS_BACKOFF_CAP = 8.0
+BREAKER_THRESHOLD = int(os.environ.get('BREAKER_THRESHOLD', 5))
+BREAKER_COOLDOWN = int(os.environ.get('BREAKER_COOLDOWN', 60))
+
+RETRYABLE_ERRORS = {'quota', 'server', 'network'}
+
+class SheetsUnavailable(Exception):
+    """Google Sheets недоступны: предохранитель разомкнут, квота исчерпана или повторы не помогли"""
+
+def classify_error(error):
+    """Тип ошибки Google API: quota, server, client, network или unknown"""
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status == 429:
+        return 'quota'
+    if status is not None and status >= 500:
+        return 'server'
+    if status is not None:
+        return 'client'
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)):
+        return 'network'
+    return 'unknown'
+
+class RateBudget:
+    """Не больше limit запросов за скользящее окно window секунд"""
     
-    return gspread.authorize(creds)
+    def __init__(self, limit, window=60):
+        self.limit = limit
+        self.window = window
+        self.calls = collections.deque()
+        self.lock = threading.Lock()
+    
+    def acquire(self, max_wait=2.0):
+        """Занять слот; ждём не дольше max_wait секунд, иначе False"""
+        with self.lock:
+            now = time.monotonic()
+            while self.calls and now - self.calls[0] >= self.window:
+                self.calls.popleft()
+            if len(self.calls) < self.limit:
+                self.calls.append(now)
+                return True
+            wait = self.window - (now - self.calls[0])
+        
+        if wait > max_wait:
+            return False
+        time.sleep(wait)
+        return self.acquire(max_wait=0)
+
+class CircuitBreaker:
+    """Предохранитель: после threshold сбоев подряд не ходим в API cooldown секунд"""
+    
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+    
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return 'open'
+        return 'half_open'
+    
+    def allow(self):
+        """Можно ли делать запрос; в half_open пропускаем ровно один пробный"""
+        with self.lock:
+            state = self.state
+            if state == 'half_open':
+                self.opened_at = time.monotonic()
+                return True
+            return state == 'closed'
+    
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+    
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold or self.opened_at is not None:
+                if self.opened_at is None:
+                    print(f"Sheets circuit opened after {self.failures} failures", flush=True)
+                self.opened_at = time.monotonic()
+
+sheets_budget = RateBudget(SHEETS_BUDGET_PER_MIN)
+sheets_breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+
+def sheets_call(func, *args, **kwargs):
+    """Вызов Google API с повторами, бюджетом запросов и предохранителем"""
+    if not sheets_breaker.allow():
+        raise SheetsUnavailable('circuit open')
+    
+    for attempt in range(SHEETS_MAX_RETRIES + 1):
+        if not sheets_budget.acquire():
+            raise SheetsUnavailable('request budget exhausted')
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            kind = classify_error(e)
+            print(f"Sheets error ({kind}, attempt {attempt + 1}): {e}", flush=True)
+            if kind not in RETRYABLE_ERRORS:
+                raise
+            if attempt == SHEETS_MAX_RETRIES:
+                sheets_breaker.record_failure()
+                raise SheetsUnavailable(str(e)) from e
+            # Полный джиттер; при исчерпании квоты ждём дольше
+            base = 2.0 if kind == 'quota' else 0.5
+            time.sleep(random.uniform(0, min(SHEETS_BACKOFF_CAP, base * 2 ** attempt)))
+            continue
+        sheets_breaker.record_success()
+        return result
+
+def sheets_call_once(func, *args, **kwargs):
+    """Неидемпотентный вызов (удаление строк) без повторов: после сетевой ошибки
+    неизвестно, выполнился ли он, а повтор удалил бы уже другие строки"""
+    if not sheets_breaker.allow():
+        raise SheetsUnavailable('circuit open')
+    if not sheets_budget.acquire():
+        raise SheetsUnavailable('request budget exhausted')
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        kind = classify_error(e)
+        print(f"Sheets error ({kind}, no retry): {e}", flush=True)
+        if kind not in RETRYABLE_ERRORS:
+            raise
+        sheets_breaker.record_failure()
+        raise SheetsUnavailable(str(e)) from e
+    sheets_breaker.record_success()
+    return result
+
+def get_spreadsheet():
+    """Хэндл таблицы текущей клиники (кэшируется между запросами)"""
+    t = tenant()
+    if t.spreadsheet is None:
+        t.spreadsheet = sheets_call(get_client().open_by_key, t.sheet_id)
+    return t.spreadsheet
 
 def get_sheet(sheet_name='Ввод_бот'):
-    """Получить конкретный лист"""
+    """Получить конкретный лист (хэндл кэшируется между запросами)"""
+    worksheets = tenant().worksheets
+    sheet = worksheets.get(sheet_name)
+    if sheet is not None:
+        return sheet
     try:
-        client = get_client()
-        return client.open_by_key(SHEET_ID).worksheet(sheet_name)
+        sheet = sheets_call(get_spreadsheet().worksheet, sheet_name)
+    except SheetsUnavailable:
+        raise
     except Exception as e:
         print(f"Error getting sheet {sheet_name}: {e}", flush=True)
         return None
+    worksheets[sheet_name] = sheet
+    return sheet
+
+def list_sheet_titles():
+    """Названия всех листов таблицы (метаданные кэшируются на SHEET_TITLES_TTL)"""
+    t = tenant()
+    if t.sheet_titles['titles'] and time.time() - t.sheet_titles['loaded_at'] < SHEET_TITLES_TTL:
+        return t.sheet_titles['titles']
+    try:
+        worksheets = sheets_call(get_spreadsheet().worksheets)
+    except Exception as e:
+        print(f"Error listing worksheets: {e}", flush=True)
+        return t.sheet_titles['titles'] or list(t.records_cache) or ['Ввод_бот']
+    for sheet in worksheets:
+        t.worksheets.setdefault(sheet.title, sheet)
+    t.sheet_titles['titles'] = [sheet.title for sheet in worksheets]
+    t.sheet_titles['loaded_at'] = time.time()
+    return t.sheet_titles['titles']
+
+def parse_values(values):
+    """Значения листа (первая строка — заголовки) в строки одинаковой ширины
+    с числами, приведёнными так же, как в get_all_records"""
+    from gspread.utils import numericise_all
+    
+    if not values:
+        return [], []
+    headers = values[0]
+    width = len(headers)
+    rows = []
+    for row in values[1:]:
+        row = list(row[:width]) + [''] * (width - len(row))
+        rows.append(numericise_all(row))
+    return headers, rows
+
+def fetch_many(sheet_names):
+    """Скачать несколько листов одним запросом values:batchGet.
+    Возвращает {имя листа: (заголовки, строки)}"""
+    ranges = ["'{}'".format(name.replace("'", "''")) for name in sheet_names]
+    response = sheets_call(get_spreadsheet().values_batch_get, ranges)
+    return {
+        name: parse_values(value_range.get('values', []))
+        for name, value_range in zip(sheet_names, response.get('valueRanges', []))
+    }
+
+def fetch_records(sheet_name='Ввод_бот'):
+    """Скачать все записи листа из Google Sheets (без кэша)"""
+    headers, rows = fetch_many([sheet_name])[sheet_name]
+    return [dict(zip(headers, row)) for row in rows]
+
+# ============ ЧТЕНИЕ ОТДЕЛЬНЫХ СТОЛБЦОВ И НОВЫХ СТРОК ============
+def quote_sheet(sheet_name):
+    return "'{}'".format(sheet_name.replace("'", "''"))
+
+def column_letter(idx):
+    """Индекс столбца с нуля -> буква A1 (0 -> A, 26 -> AA)"""
+    letters = ''
+    idx += 1
+    while idx:
+        idx, rem = divmod(idx - 1, 26)
+        letters = chr(ord('A') + rem) + letters
+    return letters
+
+def get_header_map(sheet_name='Ввод_бот'):
+    """Карта заголовков листа: из кэша листа или одной строкой 1:1"""
+    t = tenant()
+    entry = t.records_cache.get(sheet_name)
+    if entry and entry.get('columns'):
+        return entry['columns']
+    if sheet_name not in t.header_maps:
+        response = sheets_call(get_spreadsheet().values_batch_get, [f"{quote_sheet(sheet_name)}!1:1"])
+        values = response['valueRanges'][0].get('values', [[]])
+        t.header_maps[sheet_name] = {name: idx for idx, name in enumerate(values[0]) if name}
+    return t.header_maps[sheet_name]
+
+def fetch_columns(sheet_name, columns, start_row=2):
+    """Прочитать только указанные столбцы (по заголовкам) начиная со строки start_row.
+    Один запрос batchGet с диапазонами вида 'Лист'!C2:C; отсутствующие столбцы пропускаются"""
+    from gspread.utils import numericise_all
+    
+    header_map = get_header_map(sheet_name)
+    present = [name for name in columns if name in header_map]
+    if not present:
+        return []
+    
+    ranges = []
+    for name in present:
+        letter = column_letter(header_map[name])
+        ranges.append(f"{quote_sheet(sheet_name)}!{letter}{start_row}:{letter}")
+    response = sheets_call(get_spreadsheet().values_batch_get, ranges,
+                           params={'majorDimension': 'COLUMNS'})
+    
+    columns_values = []
+    for value_range in response.get('valueRanges', []):
+        values = value_range.get('values', [])
+        columns_values.append(numericise_all(values[0]) if values else [])
+    height = max((len(values) for values in columns_values), default=0)
+    
+    return [
+        {name: values[i] if i < len(values) else '' for name, values in zip(present, columns_values)}
+        for i in range(height)
+    ]
+
+def fetch_appended(sheet_names, known_rows):
+    """Строки, добавленные после известного числа записей, для нескольких листов
+    одним batchGet. known_rows — {лист: число записей, совпадающих с листом}.
+    Последняя известная запись читается ещё раз (первой строкой результата), чтобы
+    проверить, что лист не сдвинулся; при known_rows = 0 — строки с начала листа"""
+    records_cache = tenant().records_cache
+    ranges = []
+    for name in sheet_names:
+        width = len(records_cache[name]['headers'])
+        ranges.append(f"{quote_sheet(name)}!A{max(known_rows[name] + 1, 2)}:{column_letter(width - 1)}")
+    response = sheets_call(get_spreadsheet().values_batch_get, ranges)
+    
+    fetched = {}
+    for name, value_range in zip(sheet_names, response.get('valueRanges', [])):
+        headers = records_cache[name]['headers']
+        fetched[name] = parse_values([headers] + value_range.get('values', []))[1]  # строки
+    return fetched
+
+def appended_row_number(response):
+    """Номер строки листа, с которой легла дозапись (updates.updatedRange ответа append); None — неизвестно"""
+    updated = (response or {}).get('updates', {}).get('updatedRange', '') if isinstance(response, dict) else ''
+    match = re.search(r'!\$?[A-Z]+\$?(\d+)', updated)
+    return int(match.group(1)) if match else None
+
+# ============ КОЛОНОЧНОЕ ХРАНИЛИЩЕ ЗАПИСЕЙ ============
+# Вместо списка dict (17 ключей в каждой строке) храним лист по столбцам:
+# повторяющиеся значения — кодами в array, уникальный текст — одним
+# UTF-8 буфером со смещениями, числа — в array('q').
+CATEGORICAL_COLUMNS = {'Вид_животного', 'Пол', 'Канал', 'Статус_обработки'}
+
+# Ключ записи для кнопок и команд: по нему строка находится в кэше без чтения листа
+RECORD_KEY_COLUMNS = ('ФИО', 'Телефон', 'Кличка', 'Тип_прививки', 'Дата_прививки')
+
+def record_key(values):
+    """Короткий ключ записи (8 hex-символов) по значениям RECORD_KEY_COLUMNS"""
+    return format(zlib.crc32('\x1f'.join(str(value) for value in values).encode('utf-8')), '08x')
+
+# Владелец определяется телефоном, а если телефона нет или он неверный — по ФИО
+OWNER_COLUMNS = ('Телефон', 'ФИО')
+
+def normalize_fio(fio):
+    """ФИО для сравнения: регистр, лишние пробелы и ё не важны"""
+    return ' '.join(str(fio).lower().replace('ё', 'е').split())
+
+def owner_key(phone, fio):
+    """Ключ владельца: '+7XXXXXXXXXX' или 'фио:иванов иван иванович'; None — ни того, ни другого"""
+    phone, error = DataValidator.validate_phone(str(phone))
+    if not error:
+        return phone
+    fio = normalize_fio(fio)
+    return f"фио:{fio}" if fio else None
+
+class DictColumn:
+    """Словарное кодирование: уникальные значения в списке, строки — коды"""
+    
+    def __init__(self):
+        self.values = []
+        self.index = {}
+        self.codes = array('H')
+    
+    def append(self, value):
+        key = (value.__class__, value)
+        code = self.index.get(key)
+        if code is None:
+            code = len(self.values)
+            self.values.append(sys.intern(value) if isinstance(value, str) else value)
+            self.index[key] = code
+            if code > 0xFFFF and self.codes.typecode == 'H':
+                self.codes = array('I', self.codes)
+        self.codes.append(code)
+    
+    def set(self, i, value):
+        self.append(value)
+        self.codes[i] = self.codes.pop()
+    
+    def truncate(self, size):
+        del self.codes[size:]
+    
+    def get(self, i):
+        return self.values[self.codes[i]]
+    
+    def matches(self, query):
+        codes = {code for code, value in enumerate(self.values) if query in str(value).lower()}
+        if not codes:
+            return []
+        return [i for i, code in enumerate(self.codes) if code in codes]
+    
+    def nbytes(self):
+        return (sys.getsizeof(self.values) + sys.getsizeof(self.index) + sys.getsizeof(self.codes)
+                + sum(sys.getsizeof(value) for value in self.values)
+                + sys.getsizeof((None, None)) * len(self.index))
+    
+    def dump(self):
+        """Вид, данные и словарь столбца для снимка"""
+        return f"dict:{self.codes.typecode}", self.codes.tobytes(), json.dumps(self.values, ensure_ascii=False)
+    
+    @classmethod
+    def restore(cls, kind, data, extra):
+        column = cls()
+        column.values = [sys.intern(value) if isinstance(value, str) else value for value in json.loads(extra)]
+        column.index = {(value.__class__, value): code for code, value in enumerate(column.values)}
+        column.codes = array(kind.split(':')[1])
+        column.codes.frombytes(data)
+        return column
+
+class TextColumn:
+    """Строки в одном UTF-8 буфере со смещениями — без объекта str на ячейку"""
+    
+    def __init__(self):
+        self.blob = bytearray()
+        self.offsets = array('I', [0])
+    
+    def append(self, value):
+        if not isinstance(value, str):
+            raise TypeError(value)
+        self.blob += value.encode('utf-8')
+        self.offsets.append(len(self.blob))
+    
+    def set(self, i, value):
+        """Заменить значение: правка буфера и сдвиг последующих смещений"""
+        if not isinstance(value, str):
+            raise TypeError(value)
+        encoded = value.encode('utf-8')
+        start, end = self.offsets[i], self.offsets[i + 1]
+        self.blob[start:end] = encoded
+        delta = len(encoded) - (end - start)
+        if delta:
+            for j in range(i + 1, len(self.offsets)):
+                self.offsets[j] += delta
+    
+    def truncate(self, size):
+        del self.blob[self.offsets[size]:]
+        del self.offsets[size + 1:]
+    
+    def get(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+    
+    def matches(self, query):
+        lowered = self.blob.decode('utf-8').lower().encode('utf-8')
+        if len(lowered) != len(self.blob):
+            # Редкие символы меняют длину при lower() — сравниваем по ячейкам
+            return [i for i in range(len(self.offsets) - 1) if query in self.get(i).lower()]
+        
+        needle = query.encode('utf-8')
+        hits = []
+        pos = lowered.find(needle)
+        while pos != -1:
+            row = bisect_right(self.offsets, pos) - 1
+            if pos + len(needle) <= self.offsets[row + 1] and (not hits or hits[-1] != row):
+                hits.append(row)
+            pos = lowered.find(needle, pos + 1)
+        return hits
+    
+    def nbytes(self):
+        return sys.getsizeof(self.blob) + sys.getsizeof(self.offsets)
+    
+    def dump(self):
+        return 'text', bytes(self.blob), self.offsets.tobytes()
+    
+    @classmethod
+    def restore(cls, kind, data, extra):
+        column = cls()
+        column.blob = bytearray(data)
+        column.offsets = array('I')
+        column.offsets.frombytes(extra)
+        return column
+
+class IntColumn:
+    """Целые числа (например, телефоны после numericise) в array('q')"""
+    
+    def __init__(self):
+        self.values = array('q')
+    
+    def append(self, value):
+        if value.__class__ is not int:
+            raise TypeError(value)
+        self.values.append(value)
+    
+    def set(self, i, value):
+        if value.__class__ is not int:
+            raise TypeError(value)
+        self.values[i] = value
+    
+    def truncate(self, size):
+        del self.values[size:]
+    
+    def get(self, i):
+        return self.values[i]
+    
+    def matches(self, query):
+        if query.strip('0123456789-'):
+            return []
+        return [i for i, value in enumerate(self.values) if query in str(value)]
+    
+    def nbytes(self):
+        return sys.getsizeof(self.values)
+    
+    def dump(self):
+        return 'int', self.values.tobytes(), None
+    
+    @classmethod
+    def restore(cls, kind, data, extra):
+        column = cls()
+        column.values.frombytes(data)
+        return column
+
+class ObjectColumn:
+    """Запасной вариант для столбцов со смешанными типами"""
+    
+    def __init__(self):
+        self.values = []
+    
+    def append(self, value):
+        self.values.append(sys.intern(value) if isinstance(value, str) else value)
+    
+    def set(self, i, value):
+        self.values[i] = sys.intern(value) if isinstance(value, str) else value
+    
+    def truncate(self, size):
+        del self.values[size:]
+    
+    def get(self, i):
+        return self.values[i]
+    
+    def matches(self, query):
+        return [i for i, value in enumerate(self.values) if query in str(value).lower()]
+    
+    def nbytes(self):
+        unique = {id(value): value for value in self.values}
+        return sys.getsizeof(self.values) + sum(sys.getsizeof(value) for value in unique.values())
+    
+    def dump(self):
+        return 'object', json.dumps(self.values, ensure_ascii=False).encode('utf-8'), None
+    
+    @classmethod
+    def restore(cls, kind, data, extra):
+        column = cls()
+        column.values = [sys.intern(value) if isinstance(value, str) else value for value in json.loads(data)]
+        return column
+
+# Вид столбца в снимке -> класс (для DictColumn вид дополняется типом кодов: 'dict:H')
+COLUMN_KINDS = {'dict': DictColumn, 'text': TextColumn, 'int': IntColumn, 'object': ObjectColumn}
+
+class RecordView:
+    """Строка хранилища с интерфейсом dict только для чтения"""
+    __slots__ = ('_store', '_idx')
+    
+    def __init__(self, store, idx):
+        self._store = store
+        self._idx = idx
+    
+    @property
+    def row_index(self):
+        """Номер записи в листе (0 — первая строка после заголовков)"""
+        return self._idx
+    
+    @property
+    def key(self):
+        """Ключ записи (см. record_key)"""
+        return self._store.key(self._idx)
+    
+    def get(self, key, default=None):
+        col = self._store.columns.get(key)
+        if col is None:
+            return default
+        return self._store.data[col].get(self._idx)
+    
+    def __getitem__(self, key):
+        col = self._store.columns.get(key)
+        if col is None:
+            raise KeyError(key)
+        return self._store.data[col].get(self._idx)
+    
+    def __contains__(self, key):
+        return key in self._store.columns
+    
+    def __iter__(self):
+        return iter(self._store.headers)
+    
+    def __len__(self):
+        return len(self._store.headers)
+    
+    def keys(self):
+        return list(self._store.headers)
+    
+    def values(self):
+        return [column.get(self._idx) for column in self._store.data]
+    
+    def items(self):
+        return list(zip(self._store.headers, self.values()))
+    
+    def to_dict(self):
+        return dict(self.items())
+    
+    def __repr__(self):
+        return f"RecordView({self.to_dict()!r})"
+
+class RecordStore:
+    """Колоночное хранилище строк одного листа"""
+    _ids = itertools.count(1)
+    
+    def __init__(self, headers):
+        self.headers = list(headers)
+        self.columns = {name: idx for idx, name in enumerate(self.headers) if name}
+        self.data = [DictColumn() if name in CATEGORICAL_COLUMNS else TextColumn() for name in self.headers]
+        self.size = 0
+        self.key_index = None  # ключ записи -> номер строки, строится при первом поиске по ключу
+        self.owner_index = None  # ключ владельца -> номера его строк, так же лениво
+        self.fio_index = None  # ФИО -> ключи владельцев с таким ФИО (строится вместе с owner_index)
+        self.id = next(RecordStore._ids)
+        self.version = 0  # растёт при каждом изменении — по нему снимок пропускает неизменные листы
+    
+    @classmethod
+    def from_rows(cls, headers, rows):
+        """Построить хранилище, выбрав кодирование каждого столбца по его данным"""
+        store = cls(headers)
+        for col, name in enumerate(store.headers):
+            values = [row[col] for row in rows]
+            distinct = len(set((value.__class__, value) for value in values))
+            if name in CATEGORICAL_COLUMNS or distinct * 4 <= len(values):
+                column = DictColumn()
+            elif all(value.__class__ is int and -2 ** 63 <= value < 2 ** 63 for value in values):
+                column = IntColumn()
+            elif all(isinstance(value, str) for value in values):
+                column = TextColumn()
+            else:
+                column = ObjectColumn()
+            for value in values:
+                column.append(value)
+            store.data[col] = column
+        store.size = len(rows)
+        return store
+    
+    @classmethod
+    def restore(cls, headers, size, columns):
+        """Хранилище из столбцов снимка: [(вид, данные, доп. данные)] в порядке заголовков"""
+        store = cls(headers)
+        store.data = [COLUMN_KINDS[kind.split(':')[0]].restore(kind, data, extra) for kind, data, extra in columns]
+        store.size = size
+        return store
+    
+    def dump(self):
+        return [column.dump() for column in self.data]
+    
+    def append(self, row):
+        """Добавить строку (значения в порядке заголовков)"""
+        row = list(row[:len(self.headers)]) + [''] * (len(self.headers) - len(row))
+        for col, value in enumerate(row):
+            column = self.data[col]
+            try:
+                column.append(value)
+            except (TypeError, OverflowError):
+                self.to_objects(col).append(value)
+        self.size += 1
+        self.version += 1
+        if self.key_index is not None:
+            self.key_index.setdefault(self.key(self.size - 1), self.size - 1)
+        if self.owner_index is not None:
+            self.index_owner(self.size - 1)
+    
+    def set(self, idx, name, value):
+        """Изменить одну ячейку (после успешной записи в лист)"""
+        col = self.columns[name]
+        try:
+            self.data[col].set(idx, value)
+        except (TypeError, OverflowError):
+            self.to_objects(col).set(idx, value)
+        self.version += 1
+        if name in RECORD_KEY_COLUMNS:
+            self.key_index = None
+        if name in OWNER_COLUMNS:
+            self.owner_index = self.fio_index = None
+    
+    def truncate(self, size):
+        """Оставить первые size строк (хвост заменяется строками, перечитанными из листа)"""
+        if size >= self.size:
+            return
+        for column in self.data:
+            column.truncate(size)
+        self.size = size
+        self.version += 1
+        self.key_index = self.owner_index = self.fio_index = None
+    
+    def to_objects(self, col):
+        """Тип значения не подходит кодированию столбца — переводим столбец в список"""
+        column = self.data[col]
+        fallback = ObjectColumn()
+        for i in range(self.size):
+            fallback.append(column.get(i))
+        self.data[col] = fallback
+        return fallback
+    
+    def __len__(self):
+        return self.size
+    
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.size
+        if not 0 <= idx < self.size:
+            raise IndexError(idx)
+        return RecordView(self, idx)
+    
+    def __iter__(self):
+        for idx in range(self.size):
+            yield RecordView(self, idx)
+    
+    def row(self, idx):
+        """Значения строки списком в порядке заголовков"""
+        return [column.get(idx) for column in self.data]
+    
+    def rows(self):
+        for idx in range(self.size):
+            yield self.row(idx)
+    
+    def key(self, idx):
+        """Ключ записи idx (см. record_key)"""
+        return record_key([self.data[self.columns[name]].get(idx) if name in self.columns else ''
+                           for name in RECORD_KEY_COLUMNS])
+    
+    def find_key(self, key):
+        """Номер строки по ключу записи или None; при дублях — первая строка"""
+        if self.key_index is None:
+            index = {}
+            for idx in range(self.size):
+                index.setdefault(self.key(idx), idx)
+            self.key_index = index
+        return self.key_index.get(key)
+    
+    def owner(self, idx):
+        """Ключ владельца записи idx (см. owner_key)"""
+        phone, fio = (self.data[self.columns[name]].get(idx) if name in self.columns else ''
+                      for name in OWNER_COLUMNS)
+        return owner_key(phone, fio)
+    
+    def index_owner(self, idx):
+        owner = self.owner(idx)
+        self.owner_index.setdefault(owner, []).append(idx)
+        fio = normalize_fio(self.data[self.columns['ФИО']].get(idx)) if 'ФИО' in self.columns else ''
+        if fio:
+            self.fio_index.setdefault(fio, {})[owner] = None
+    
+    def build_owner_index(self):
+        if self.owner_index is None:
+            self.owner_index, self.fio_index = {}, {}
+            for idx in range(self.size):
+                self.index_owner(idx)
+    
+    def find_owner(self, owner):
+        """Номера строк владельца по возрастанию; индекс строится один раз и дополняется при append"""
+        self.build_owner_index()
+        return self.owner_index.get(owner, [])
+    
+    def find_owners_by_fio(self, fio):
+        """Ключи владельцев с таким ФИО (у владельца с телефоном ключ — телефон)"""
+        self.build_owner_index()
+        return list(self.fio_index.get(normalize_fio(fio), ()))
+    
+    def search(self, query):
+        """Номера строк, где подстрока query встречается в любом столбце"""
+        query = query.lower()
+        if not query:
+            return list(range(self.size))
+        hits = set()
+        for column in self.data:
+            hits.update(column.matches(query))
+        return sorted(hit for hit in hits if hit < self.size)
+    
+    def memory_usage(self):
+        """Оценка занимаемой памяти в байтах"""
+        return (sys.getsizeof(self.headers) + sys.getsizeof(self.columns)
+                + sum(column.nbytes() for column in self.data))
+
+def dicts_memory_usage(records):
+    """Оценка памяти того же набора в виде списка dict — для сравнения с RecordStore"""
+    total = sys.getsizeof(records)
+    seen = set()
+    for record in records:
+        total += sys.getsizeof(record)
+        for value in record.values():
+            if id(value) not in seen:
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+    return total
+
+# ============ КЭШ И СНИМОК НА ДИСКЕ ============
+# Данные листов держим в памяти и сохраняем в SQLite-снимок, чтобы после
+# засыпания на Render первый поиск не ждал полной выгрузки таблицы.
+SNAPSHOT_VERSION = 8
+
+# Кэш листов, очередь записей и т.п. — у каждой клиники свои (см. Tenant)
+media_cache = {}     # путь к файлу -> Telegram file_id (общий для всех клиник)
+cache_lock = threading.Lock()
+snapshot_lock = threading.Lock()
+
+# Состояние готовности для /readyz: откуда данные и зарегистрирован ли вебхук
+readiness = {'data': None, 'webhook': None, 'listening_ms': None}
+
+def set_cached_records(sheet_name, headers, rows, loaded_at=None):
+    """Положить строки листа в кэш (колоночное хранилище + карта заголовков)"""
+    return cache_store(sheet_name, RecordStore.from_rows(headers, rows), loaded_at)
+
+def cache_store(sheet_name, store, loaded_at=None, sheet_rows=None):
+    """Положить готовое хранилище листа в кэш. sheet_rows — сколько первых записей
+    точно совпадают со строками листа (по умолчанию все); записи после них добавил бот,
+    и при догрузке они заменяются тем, что вернёт лист"""
+    t = tenant()
+    entry = {
+        'records': store,
+        'headers': store.headers,
+        'columns': store.columns,
+        'loaded_at': loaded_at or time.time(),
+        'sheet_rows': len(store) if sheet_rows is None else sheet_rows
+    }
+    entry['full_at'] = entry['loaded_at']
+    with cache_lock:
+        t.records_cache[sheet_name] = entry
+    return entry
+
+def refresh_sheets(sheet_names, full=False):
+    """Обновить листы из Google Sheets и сохранить снимок.
+    Листы, давно не перечитывавшиеся целиком, скачиваются одним batch-запросом;
+    у остальных одним запросом догружаются только строки, добавленные в конец"""
+    t = tenant()
+    flush_pending_writes()
+    now = time.time()
+    incremental = [] if full else [
+        name for name in sheet_names
+        if name in t.records_cache and t.records_cache[name]['headers']
+        and now - t.records_cache[name]['full_at'] < FULL_REFRESH_INTERVAL
+    ]
+    complete = [name for name in sheet_names if name not in incremental]
+    
+    if incremental:
+        with cache_lock:
+            known = {name: (t.records_cache[name]['sheet_rows'], t.records_cache[name]['records'].version)
+                     for name in incremental}
+        try:
+            appended = fetch_appended(incremental, {name: rows for name, (rows, _) in known.items()})
+        except Exception as e:
+            print(f"Error getting new rows from {', '.join(incremental)}: {e}", flush=True)
+            return False
+        for sheet_name, rows in appended.items():
+            if extend_cached_records(sheet_name, rows, *known[sheet_name]) is None:
+                # Последняя известная строка в листе другая: строки удаляли или вставляли выше
+                print(f"Cache out of line with {sheet_name}, re-reading it", flush=True)
+                complete.append(sheet_name)
+    
+    try:
+        fetched = fetch_many(complete) if complete else {}
+    except Exception as e:
+        print(f"Error getting records from {', '.join(complete)}: {e}", flush=True)
+        return False
+    
+    for sheet_name, (headers, rows) in fetched.items():
+        set_cached_records(sheet_name, headers, rows)
+        apply_pending_writes(sheet_name)
+        print(f"Cache refreshed: {sheet_name}, {len(rows)} records", flush=True)
+    
+    readiness['data'] = 'sheets'
+    enforce_memory_limit(t)
+    save_snapshot()
+    return True
+
+def extend_cached_records(sheet_name, rows, known, version):
+    """Догрузка листа: записи кэша после known (добавленные ботом и ещё не перечитанные)
+    заменяются строками листа, затем снова дописываются строки из очереди.
+    rows начинаются с последней известной записи (если known > 0) — она должна совпасть с кэшем.
+    False — кэш успел измениться (следующее обновление всё выровняет);
+    None — лист не совпадает с кэшем, его нужно перечитать целиком"""
+    t = tenant()
+    with cache_lock:
+        entry = t.records_cache.get(sheet_name)
+        if not entry or entry['records'].version != version:
+            return False
+        store = entry['records']
+        if known:
+            if not rows or rows[0] != store.row(known - 1):
+                return None
+            rows = rows[1:]
+        replaced = len(store) - known
+        store.truncate(known)
+        for row in rows:
+            store.append(row)
+        entry['sheet_rows'] = len(store)
+        entry['loaded_at'] = time.time()
+    apply_pending_writes(sheet_name)
+    if rows or replaced:
+        print(f"Cache topped up: {sheet_name}, +{len(rows)} records from sheet"
+              + (f" (replaced {replaced} added by bot)" if replaced else ""), flush=True)
+    return True
+
+def apply_pending_writes(sheet_name):
+    """Снова внести в кэш строки и правки из очереди: в только что прочитанном листе их ещё нет"""
+    t = tenant()
+    with cache_lock:
+        still_pending = [w for w in t.pending_writes if w['sheet'] == sheet_name]
+    for write in still_pending:
+        if 'row' in write:
+            append_cached_record(sheet_name, write['row'], save=False)
+        else:
+            apply_cached_edit(sheet_name, write['key'], write['fields'])
+
+def apply_cached_edit(sheet_name, key, fields):
+    """Изменить запись в кэше по ключу (значения приводятся так же, как при чтении листа)"""
+    from gspread.utils import numericise_all
+    
+    t = tenant()
+    with cache_lock:
+        entry = t.records_cache.get(sheet_name)
+        idx = entry['records'].find_key(key) if entry else None
+        if idx is None:
+            return False
+        for field, value in fields.items():
+            if field in entry['columns']:
+                entry['records'].set(idx, field, numericise_all([str(value)])[0])
+    return True
+
+def refresh_records(sheet_name='Ввод_бот'):
+    """Перечитать один лист"""
+    return refresh_sheets([sheet_name])
+
+def refresh_sheets_async(sheet_names, full=False):
+    """Обновить кэш листов в фоне (лист, который уже обновляется, пропускаем)"""
+    t = tenant()
+    with cache_lock:
+        names = [name for name in sheet_names if name not in t.refreshing]
+        t.refreshing.update(names)
+    if not names:
+        return
+    
+    def worker():
+        try:
+            refresh_sheets(names, full=full)
+        finally:
+            with cache_lock:
+                t.refreshing.difference_update(names)
+    
+    start_thread(worker)
+
+def refresh_records_async(sheet_name='Ввод_бот'):
+    """Обновить кэш листа в фоне"""
+    refresh_sheets_async([sheet_name])
+
+def get_cached_entries(sheet_names):
+    """Записи кэша нескольких листов: отсутствующие читаем одним batch-запросом,
+    устаревшие обновляем в фоне тоже одним запросом"""
+    t = tenant()
+    missing = [name for name in sheet_names if name not in t.records_cache]
+    if missing:
+        refresh_sheets(missing)
+    
+    now = time.time()
+    stale = [name for name in sheet_names
+             if name in t.records_cache and now - t.records_cache[name]['loaded_at'] > CACHE_TTL]
+    if stale:
+        refresh_sheets_async(stale)
+    entries = {name: t.records_cache[name] for name in sheet_names if name in t.records_cache}
+    for entry in entries.values():
+        entry['used_at'] = now
+    return entries
+
+def get_cached_entry(sheet_name='Ввод_бот'):
+    """Запись кэша листа; при пустом кэше читаем синхронно, при устаревшем — обновляем в фоне"""
+    t = tenant()
+    entry = t.records_cache.get(sheet_name)
+    if entry is None:
+        if not refresh_records(sheet_name):
+            return None
+        return t.records_cache.get(sheet_name)
+    entry['used_at'] = time.time()
+    if entry['used_at'] - entry['loaded_at'] > CACHE_TTL:
+        refresh_records_async(sheet_name)
+    return entry
 
 def get_all_records(sheet_name='Ввод_бот'):
     """Получить все записи из указанного листа"""
+    entry = get_cached_entry(sheet_name)
+    return entry['records'] if entry else []
+
+def append_cached_record(sheet_name, row, save=True, row_number=None):
+    """Добавить только что записанную строку в кэш без перечитывания листа.
+    row_number — номер строки листа из ответа append: если строка легла сразу за известными
+    записями, кэш остаётся копией листа; если дальше — в лист добавляли строки мимо бота"""
+    from gspread.utils import numericise_all
+    
+    t = tenant()
+    aligned = True
+    with cache_lock:
+        entry = t.records_cache.get(sheet_name)
+        if not entry or not entry['headers']:
+            t.records_cache.pop(sheet_name, None)
+            return
+        store = entry['records']
+        # Числа приводим так же, как при чтении листа, чтобы не ломать кодирование столбцов
+        store.append(numericise_all([str(value) for value in row]))
+        if row_number is not None:
+            aligned = row_number == sheet_row(entry['sheet_rows'])
+            if aligned and len(store) == entry['sheet_rows'] + 1:
+                entry['sheet_rows'] += 1
+    if not aligned:
+        refresh_records_async(sheet_name)
+    if save:
+        schedule_snapshot()
+
+def known_sheet_rows(sheet_name):
+    """Сколько записей листа точно есть в таблице: записи кэша, совпадающие с листом"""
+    t = tenant()
+    with cache_lock:
+        entry = t.records_cache.get(sheet_name)
+        return entry['sheet_rows'] if entry else 0
+
+def sheet_rows_removed(sheet_name, count):
+    """Из листа удаляются строки: кэш больше не копия листа (следующая догрузка прочитает
+    его заново), а отложенные записи сверяются с листом начиная с меньшего номера строки"""
+    t = tenant()
+    with cache_lock:
+        entry = t.records_cache.get(sheet_name)
+        if entry:
+            entry['sheet_rows'] = 0
+        for write in t.pending_writes:
+            if write['sheet'] == sheet_name and write.get('after') is not None:
+                write['after'] = max(0, write['after'] - count)
+
+def queue_write(sheet_name, row, check=False):
+    """Отложить запись строки до восстановления доступа к Sheets.
+    check — запрос уже отправлялся и мог пройти: перед повтором сверимся с листом"""
+    t = tenant()
+    after = known_sheet_rows(sheet_name) if check else None
+    with cache_lock:
+        t.pending_writes.append({'sheet': sheet_name, 'row': row, 'after': after})
+    print(f"Write queued for {sheet_name}, pending: {len(t.pending_writes)}", flush=True)
+    append_cached_record(sheet_name, row)
+
+def queue_edits(sheet_name, edits):
+    """Отложить правки записей [(ключ, {поле: значение})] до восстановления доступа к Sheets.
+    В кэше они видны сразу; строку в листе при отправке найдём по ключу заново"""
+    t = tenant()
+    with cache_lock:
+        t.pending_writes.extend({'sheet': sheet_name, 'key': key, 'fields': fields} for key, fields in edits)
+    print(f"Edits queued for {sheet_name}, pending: {len(t.pending_writes)}", flush=True)
+    for key, fields in edits:
+        apply_cached_edit(sheet_name, key, fields)
+    schedule_snapshot()
+
+def written_already(sheet_name, writes):
+    """Отложенные строки, которые уже есть в листе (дозапись прошла, а ответ потерялся).
+    Сверяем ключи записей в строках после 'after' — числа записей, известных до отправки"""
+    from gspread.utils import numericise_all
+    
+    if not writes:
+        return []
+    header_map = get_header_map(sheet_name)
+    start_row = min(w['after'] for w in writes) + 2
+    found = collections.Counter(
+        record_key([record.get(name, '') for name in RECORD_KEY_COLUMNS])
+        for record in fetch_columns(sheet_name, RECORD_KEY_COLUMNS, start_row)
+    )
+    done = []
+    for write in writes:
+        values = numericise_all([str(value) for value in write['row']])
+        key = record_key([values[header_map[name]] if header_map.get(name, len(values)) < len(values) else ''
+                          for name in RECORD_KEY_COLUMNS])
+        if found[key]:
+            found[key] -= 1
+            done.append(write)
+    return done
+
+def flush_pending_writes():
+    """Отправить очередь: новые строки — одним append_rows на лист, затем правки — одним
+    batch_update на лист. Очередь отправляется по порядку; при сбое остаток ждёт следующего раза"""
+    t = tenant()
+    with cache_lock:
+        batch = list(t.pending_writes)
+    if not batch:
+        return True
+    
+    by_sheet = {}
+    for write in batch:
+        by_sheet.setdefault(write['sheet'], []).append(write)
+    
+    for sheet_name, writes in by_sheet.items():
+        rows = [w for w in writes if 'row' in w]
+        edits = [w for w in writes if 'fields' in w]
+        if rows and not flush_pending_rows(sheet_name, rows):
+            return False
+        if edits and not flush_pending_edits(sheet_name, edits):
+            return False
+    
+    save_snapshot()
+    return True
+
+def flush_pending_rows(sheet_name, writes):
+    """Дописать отложенные строки листа одним append_rows. Дозапись не повторяется
+    автоматически: после сбоя строки сверяются с листом перед следующей отправкой"""
+    t = tenant()
+    known = known_sheet_rows(sheet_name)
     try:
         sheet = get_sheet(sheet_name)
-        if sheet:
-            return sheet.get_all_records()
-        return []
+        if not sheet:
+            return False
+        done = {id(w) for w in written_already(sheet_name, [w for w in writes if w.get('after') is not None])}
+        rows = [w['row'] for w in writes if id(w) not in done]
+        if rows:
+            sheets_call_once(sheet.append_rows, rows)
     except Exception as e:
-        print(f"Error getting records from {sheet_name}: {e}", flush=True)
-        return []
+        print(f"Error flushing pending writes to {sheet_name}: {e}", flush=True)
+        with cache_lock:
+            for write in writes:
+                if write.get('after') is None:
+                    write['after'] = known
+        return False
+    with cache_lock:
+        for write in writes:
+            t.pending_writes.remove(write)
+    print(f"Flushed {len(rows)} pending writes to {sheet_name}"
+          + (f", {len(done)} already there" if done else ""), flush=True)
+    return True
 
-# ============ ПОИСК ============
-def search_all_sheets(query):
-    """Глобальный поиск по всем полям таблицы"""
-    query_lower = query.lower().strip()
-    results = []
+def flush_pending_edits(sheet_name, edits):
+    """Внести отложенные правки одним batch_update. Строку записи ищем по ключу в самом
+    листе (кэш мог устареть), под write_lock — чтобы строки не сдвинулись до записи.
+    Правки записей, которых в листе больше нет, отбрасываются"""
+    from gspread.utils import numericise_all
+    
+    t = tenant()
+    try:
+        sheet = get_sheet(sheet_name)
+        if not sheet:
+            return False
+        header_map = get_header_map(sheet_name)
+        with t.write_lock:
+            records = fetch_columns(sheet_name, RECORD_KEY_COLUMNS)
+            index = {}
+            for i, record in enumerate(records):
+                index.setdefault(record_key([record.get(name, '') for name in RECORD_KEY_COLUMNS]), i)
+            data, lost = [], []
+            for edit in edits:
+                i = index.get(edit['key'])
+                if i is None:
+                    lost.append(edit)
+                    continue
+                for field, value in edit['fields'].items():
+                    if field in header_map:
+                        data.append({'range': f"{column_letter(header_map[field])}{sheet_row(i)}", 'values': [[value]]})
+                    if field in RECORD_KEY_COLUMNS:
+                        records[i][field] = numericise_all([str(value)])[0]
+                # Следующие правки той же записи адресованы уже новым ключом
+                index.setdefault(record_key([records[i].get(name, '') for name in RECORD_KEY_COLUMNS]), i)
+            if data:
+                sheets_call(sheet.batch_update, data)
+    except Exception as e:
+        print(f"Error flushing pending edits to {sheet_name}: {e}", flush=True)
+        return False
+    with cache_lock:
+        for edit in edits:
+            t.pending_writes.remove(edit)
+    print(f"Flushed {len(edits) - len(lost)} pending edits to {sheet_name}"
+          + (f", {len(lost)} records no longer in sheet" if lost else ""), flush=True)
+    return True
+
+def data_age_note(sheet_name='Ввод_бот'):
+    """Пометка «данные на ЧЧ:ММ», если показываем не свежие данные"""
+    t = tenant()
+    entry = t.records_cache.get(sheet_name)
+    if not entry:
+        return ''
+    if sheets_breaker.state == 'closed' and time.time() - entry['loaded_at'] <= CACHE_TTL * 2:
+        return ''
+    loaded = datetime.fromtimestamp(entry['loaded_at'])
+    fmt = '%H:%M' if loaded.date() == datetime.now().date() else '%d.%m %H:%M'
+    return f"\n\n{EMOJI['clock']} Данные на {loaded.strftime(fmt)}"
+
+def readiness_report():
+    """Состояние для /readyz"""
+    ready = readiness['data'] is not None
+    tenants_state = {
+        t.id: {'sheets': len(t.records_cache), 'cache_bytes': t.memory_usage(),
+               'pending_writes': len(t.pending_writes)}
+        for t in list(tenants.values())
+    }
+    return ready, {'ready': ready, **readiness, 'sheets': sheets_breaker.state, 'tenants': tenants_state,
+                   'dispatch': dispatch_report()}
+
+def snapshot_matches(path, sheet_id):
+    """Снимок на диске текущей версии и той же таблицы — его можно дописывать на месте"""
+    if not os.path.exists(path):
+        return False
+    try:
+        conn = sqlite3.connect(path)
+        try:
+            meta = dict(conn.execute("SELECT key, value FROM meta"))
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+    return meta.get('version') == str(SNAPSHOT_VERSION) and meta.get('sheet_id') == sheet_id
+
+def create_snapshot_tables(conn):
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("CREATE TABLE sheets (name TEXT PRIMARY KEY, loaded_at REAL, headers TEXT, size INTEGER, "
+                 "sheet_rows INTEGER)")
+    conn.execute("CREATE TABLE columns (sheet TEXT, col INTEGER, kind TEXT, data BLOB, extra BLOB)")
+    conn.execute("CREATE INDEX columns_sheet ON columns (sheet)")
+    conn.execute("CREATE TABLE media (path TEXT PRIMARY KEY, file_id TEXT)")
+    conn.execute("CREATE TABLE pending (idx INTEGER, sheet TEXT, row TEXT, after INTEGER, edit TEXT)")
+    conn.execute("CREATE TABLE sms (key TEXT PRIMARY KEY, data TEXT)")
+
+def save_snapshot():
+    """Сохранить кэш листов и file_id медиа в SQLite-снимок.
+    Столбцы хранилища пишутся как есть (коды, буферы, массивы), и только у листов,
+    изменившихся с прошлого сохранения; остальное дописывается в тот же файл"""
+    t = tenant()
+    with snapshot_lock:
+        fresh = not snapshot_matches(t.snapshot_path, t.sheet_id)
+        with cache_lock:
+            sheets = {name: (entry['headers'], entry['loaded_at'], entry['records'].size, entry['sheet_rows'])
+                      for name, entry in t.records_cache.items()}
+            changed = {name: ((entry['records'].id, entry['records'].version), entry['records'].dump())
+                       for name, entry in t.records_cache.items()
+                       if fresh or t.saved_sheets.get(name) != (entry['records'].id, entry['records'].version)}
+            media = dict(media_cache)
+            pending = list(t.pending_writes)
+            sms_log = dict(t.sms_log)
+        
+        path = f"{t.snapshot_path}.tmp" if fresh else t.snapshot_path
+        try:
+            if fresh and os.path.exists(path):
+                os.remove(path)
+            conn = sqlite3.connect(path)
+            with conn:
+                if fresh:
+                    create_snapshot_tables(conn)
+                    conn.executemany("INSERT INTO meta VALUES (?, ?)",
+                                     [('version', str(SNAPSHOT_VERSION)), ('sheet_id', t.sheet_id)])
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('saved_at', ?)", (str(time.time()),))
+                gone = [name for name, in conn.execute("SELECT name FROM sheets") if name not in sheets]
+                for name in gone + list(changed):
+                    conn.execute("DELETE FROM columns WHERE sheet = ?", (name,))
+                conn.executemany("DELETE FROM sheets WHERE name = ?", ((name,) for name in gone))
+                conn.executemany(
+                    "INSERT OR REPLACE INTO sheets VALUES (?, ?, ?, ?, ?)",
+                    ((name, loaded_at, json.dumps(headers, ensure_ascii=False), size, sheet_rows)
+                     for name, (headers, loaded_at, size, sheet_rows) in sheets.items())
+                )
+                for name, (_, columns) in changed.items():
+                    conn.executemany("INSERT INTO columns VALUES (?, ?, ?, ?, ?)",
+                                     ((name, col, kind, data, extra) for col, (kind, data, extra) in enumerate(columns)))
+                conn.execute("DELETE FROM media")
+                conn.executemany("INSERT INTO media VALUES (?, ?)", media.items())
+                conn.execute("DELETE FROM pending")
+                conn.executemany(
+                    "INSERT INTO pending VALUES (?, ?, ?, ?, ?)",
+                    ((idx, w['sheet'], json.dumps(w['row'], ensure_ascii=False) if 'row' in w else None, w.get('after'),
+                      None if 'row' in w else json.dumps({'key': w['key'], 'fields': w['fields']}, ensure_ascii=False))
+                     for idx, w in enumerate(pending))
+                )
+                conn.execute("DELETE FROM sms")
+                conn.executemany("INSERT INTO sms VALUES (?, ?)",
+                                 ((key, json.dumps(item)) for key, item in sms_log.items()))
+            conn.close()
+            if fresh:
+                os.replace(path, t.snapshot_path)
+                t.saved_sheets.clear()
+            for name in gone:
+                t.saved_sheets.pop(name, None)
+            t.saved_sheets.update((name, version) for name, (version, _) in changed.items())
+            return True
+        except Exception as e:
+            print(f"Error saving snapshot: {e}", flush=True)
+            return False
+
+def schedule_snapshot():
+    """Сохранить снимок через SNAPSHOT_DEBOUNCE секунд: все изменения за это время
+    (дозаписи, правки, file_id) попадут в одно сохранение"""
+    t = tenant()
+    with cache_lock:
+        if t.snapshot_due:
+            return
+        t.snapshot_due = True
     
-    records = get_all_records('Ввод_бот')
-    print(f"DEBUG: Total records in Ввод_бот: {len(records)}", flush=True)
+    def worker():
+        time.sleep(SNAPSHOT_DEBOUNCE)
+        with cache_lock:
+            t.snapshot_due = False
+        save_snapshot()
+    
+    start_thread(worker)
+
+def load_snapshot():
+    """Загрузить снимок клиники с диска в кэш; несовместимый или чужой снимок игнорируется"""
+    t = tenant()
+    t.loaded = True
+    if not os.path.exists(t.snapshot_path):
+        print("Snapshot not found, starting with empty cache", flush=True)
+        return False
     
-    for idx, record in enumerate(records):
-        record_str = json.dumps(record, ensure_ascii=False).lower()
+    started = time.perf_counter()
+    try:
+        conn = sqlite3.connect(t.snapshot_path)
+        meta = dict(conn.execute("SELECT key, value FROM meta"))
+        if meta.get('version') != str(SNAPSHOT_VERSION) or meta.get('sheet_id') != t.sheet_id:
+            print(f"Snapshot ignored: version={meta.get('version')}", flush=True)
+            if meta.get('sheet_id') == t.sheet_id:
+                restore_pending_writes(conn)
+            conn.close()
+            return False
         
-        if query_lower in record_str:
-            print(f"DEBUG: Match at row {idx + 2}", flush=True)
-            results.append({
-                'source': 'Ввод_бот',
-                'data': record
-            })
+        saved = {}
+        sheets = conn.execute("SELECT name, loaded_at, headers, size, sheet_rows FROM sheets").fetchall()
+        for name, loaded_at, headers, size, sheet_rows in sheets:
+            columns = conn.execute("SELECT kind, data, extra FROM columns WHERE sheet = ? ORDER BY col", (name,))
+            store = RecordStore.restore(json.loads(headers), size, columns.fetchall())
+            cache_store(name, store, loaded_at, sheet_rows)
+            saved[name] = (store.id, store.version)
+        t.saved_sheets = saved
+        media_cache.update(conn.execute("SELECT path, file_id FROM media"))
+        with cache_lock:
+            # Очередь в памяти новее снимка, если клиника была только выгружена
+            if not t.pending_writes:
+                for sheet, row, after, edit in conn.execute("SELECT sheet, row, after, edit FROM pending ORDER BY idx"):
+                    if edit is None:
+                        t.pending_writes.append({'sheet': sheet, 'row': json.loads(row), 'after': after})
+                    else:
+                        t.pending_writes.append({'sheet': sheet, **json.loads(edit)})
+            if not t.sms_log:
+                t.sms_log.update((key, json.loads(data)) for key, data in conn.execute("SELECT key, data FROM sms"))
+        conn.close()
+    except Exception as e:
+        print(f"Error loading snapshot: {e}", flush=True)
+        return False
+    
+    if t.records_cache and readiness['data'] is None:
+        readiness['data'] = 'snapshot'
+    elapsed = (time.perf_counter() - started) * 1000
+    print(f"Snapshot loaded ({t.id}): {len(t.records_cache)} sheets, {elapsed:.1f} ms", flush=True)
+    return True
+
+def restore_pending_writes(conn):
+    """Очередь записей и журнал SMS из снимка старой версии (кэш листов просто перечитаем).
+    Строки очереди сверяем перед отправкой с листом целиком: неизвестно, доходили ли они"""
+    t = tenant()
+    try:
+        rows = conn.execute("SELECT sheet, row FROM pending WHERE row IS NOT NULL ORDER BY idx").fetchall()
+        sms = conn.execute("SELECT key, data FROM sms").fetchall()
+    except sqlite3.Error:
+        return
+    with cache_lock:
+        if not t.pending_writes:
+            t.pending_writes.extend({'sheet': sheet, 'row': json.loads(row), 'after': 0} for sheet, row in rows)
+        if not t.sms_log:
+            t.sms_log.update((key, json.loads(data)) for key, data in sms)
+    if rows:
+        print(f"Restored {len(rows)} pending writes from old snapshot", flush=True)
+
+def ensure_snapshot_loaded():
+    """Снимок текущей клиники в памяти: при фоновой загрузке после старта
+    апдейт дожидается её, а не читает лист сам и не грузит снимок второй раз"""
+    t = tenant()
+    with t.load_lock:
+        if not t.loaded:
+            load_snapshot()
+
+def load_in_background():
+    """После того как сервер слушает порт: снимки клиник с диска, затем сверка с Google Sheets.
+    Пока данных нет, /readyz отвечает 503"""
+    def worker():
+        for t in list(tenants.values()):
+            run_for_tenant(t, ensure_snapshot_loaded)
+        reconcile_in_background()
+    
+    threading.Thread(target=worker, daemon=True).start()
+
+def reconcile_in_background():
+    """Сверить кэши из снимков с Google Sheets после старта"""
+    for t in tenants.values():
+        if t.records_cache or t is DEFAULT_TENANT:
+            # Архивы не перечитываем: они нужны только по запросу истории
+            names = [name for name in t.records_cache if not is_archive_sheet(name)]
+            run_for_tenant(t, refresh_sheets_async, names or ['Ввод_бот'], True)
+
+# ============ ПОИСК ============
+def search_sheet_names():
+    """Листы для глобального поиска: SEARCH_SHEETS или все листы, кроме архивов, «Ввод_бот» первым"""
+    names = SEARCH_SHEETS or [name for name in list_sheet_titles() if not is_archive_sheet(name)]
+    return sorted(names, key=lambda name: name != 'Ввод_бот')
+
+def search_parts(query, sheet_names):
+    """Совпадения по всем полям листов: [(лист, RecordStore, номера записей)]"""
+    query_lower = query.lower().strip()
+    entries = get_cached_entries(sheet_names)
+    if not entries:
+        raise SheetsUnavailable('no data for search')
     
+    parts = []
+    for sheet_name, entry in entries.items():
+        store = entry['records']
+        print(f"DEBUG: Total records in {sheet_name}: {len(store)}", flush=True)
+        indexes = store.search(query_lower)
+        if indexes:
+            parts.append((sheet_name, store, indexes))
+    return parts
+
+def find_matches(query, archive=False):
+    """Совпадения в оперативных листах; архивы — по явному запросу или если там пусто"""
+    parts = [] if archive else search_parts(query, search_sheet_names())
+    if not parts:
+        archives = archive_sheet_names()
+        parts = search_parts(query, archives) if archives else []
+    return parts
+
+def search_all_sheets(query, archive=False):
+    """Глобальный поиск по всем полям всех листов таблицы (архивы — см. find_matches)"""
+    results = [
+        {'source': sheet_name, 'data': store[idx], 'row': sheet_row(idx)}
+        for sheet_name, store, indexes in find_matches(query, archive) for idx in indexes
+    ]
     print(f"DEBUG: Total matches: {len(results)}", flush=True)
     return results
 
@@ -355,6 +1870,14 @@ def format_search_results(results):
     
     for i, result in enumerate(results[:5], 1):
         record = result['data']
+        source = result.get('source', 'Ввод_бот')
+        
+        # Справочные и прочие листы со своей структурой — показываем поля как есть
+        if 'ФИО' not in record and 'Кличка' not in record:
+            fields = [f"{key}: {value}" for key, value in record.items() if key and value != ''][:6]
+            text += f"{i}. {EMOJI['list']} {source}\n"
+            text += ''.join(f"   {field}\n" for field in fields) + "\n"
+            continue
         
         fio = record.get('ФИО', 'Не указано')
         phone = record.get('Телефон', '')
@@ -401,7 +1924,13 @@ def format_search_results(results):
         if channel:
             text += f"   {EMOJI['bell']} Канал: {channel}\n"
         
-        text += f"   Статус: {status}\n\n"
+        text += f"   Статус: {status}"
+        if source == EDITABLE_SHEET and result.get('row'):
+            text += f" · стр. {result['row']}"
+        text += "\n"
+        if source != 'Ввод_бот':
+            text += f"   {EMOJI['list']} Лист: {source}\n"
+        text += "\n"
     
     if len(results) > 5:
         text += f"... и ещё {len(results) - 5} результатов"
@@ -409,23 +1938,36 @@ def format_search_results(results):
     return text
 
 # ============ МОИ ЗАПИСИ ============
+# Столбцы для фильтра (сотрудник, дата) и для вывода списка
+MY_RECORDS_COLUMNS = ['Сотрудник_TG', 'staff_tg', 'Дата_прививки', 'Кличка', 'Вид_животного', 'Тип_прививки']
+
 def get_my_records(user_identifier):
-    """Получить записи пользователя за сегодня из Ввод_бот"""
-    records = get_all_records('Ввод_бот')
+    """Получить записи пользователя за сегодня из Ввод_бот.
+    Если лист ещё не в кэше, читаем только нужные столбцы, а не всю таблицу"""
+    if 'Ввод_бот' in tenant().records_cache:
+        records = get_cached_entry('Ввод_бот')['records']
+    else:
+        try:
+            records = fetch_columns('Ввод_бот', MY_RECORDS_COLUMNS)
+        except Exception as e:
+            raise SheetsUnavailable(f'no data for Ввод_бот: {e}') from e
     today = datetime.now().strftime('%Y-%m-%d')
     
     my_records = []
     for record in records:
-        staff = str(record.get('Сотрудник_TG', record.get('staff_tg', ''))).lower()
-        user_id = user_identifier.lower().replace('@', '')
-        
-        if staff == user_identifier.lower() or staff == f"@{user_id}" or user_id in staff:
+        if is_staff_record(record, user_identifier):
             record_date = str(record.get('Дата_прививки', ''))
             if today in record_date:
                 my_records.append(record)
     
     return my_records
 
+def is_staff_record(record, user_identifier):
+    """Запись внесена этим сотрудником"""
+    staff = str(record.get('Сотрудник_TG', record.get('staff_tg', ''))).lower()
+    user_id = user_identifier.lower().replace('@', '')
+    return staff == user_identifier.lower() or staff == f"@{user_id}" or user_id in staff
+
 def format_records_summary(records):
     """Форматировать сводку записей"""
     if not records:
@@ -450,9 +1992,489 @@ def get_records_details(records):
     
     return "\n".join(details)
 
-# ============ TELEGRAM API ============
-def send_message(chat_id, text, keyboard=None, parse_mode=None):
-    url = f'https://api.telegram.org/bot{TOKEN}/sendMessage'
+# ============ КАРТОЧКА ВЛАДЕЛЬЦА ============
+# Все записи владельца (по телефону, иначе по ФИО) одной карточкой: питомцы,
+# история прививок и когда следующая. Строки берутся из индекса владельцев
+# RecordStore, поэтому карточка открывается за число строк этого владельца.
+CARD_SOON_DAYS = 30  # «скоро» — срок истекает в ближайшие дни
+CARD_MAX_LENGTH = 4000  # лимит Telegram — 4096 символов
+
+CARD_USAGE_TEXT = (f"{EMOJI['user']} Карточка владельца\n\n/card <телефон или ФИО>\n"
+                   f"Например: /card 89001234567")
+
+owner_choices = {}  # chat_id -> владельцы-тёзки из последнего /card по ФИО
+
+def owners_by_fio(fio):
+    """Ключи владельцев по ФИО: из «Ввод_бот», а если там нет — из архивов"""
+    entry = get_cached_entry(EDITABLE_SHEET)
+    if not entry:
+        raise SheetsUnavailable(f'no data for {EDITABLE_SHEET}')
+    owners = entry['records'].find_owners_by_fio(fio)
+    if not owners:
+        archives = archive_sheet_names()
+        entries = get_cached_entries(archives) if archives else {}
+        for name in archives:
+            if name in entries:
+                owners += [owner for owner in entries[name]['records'].find_owners_by_fio(fio) if owner not in owners]
+    return owners
+
+def owner_records(owner):
+    """Записи владельца из «Ввод_бот» в порядке строк листа"""
+    entry = get_cached_entry(EDITABLE_SHEET)
+    if not entry:
+        raise SheetsUnavailable(f'no data for {EDITABLE_SHEET}')
+    store = entry['records']
+    return [store[idx] for idx in store.find_owner(owner)]
+
+def archive_owner_records(owner):
+    """Записи владельца из листов архива, старые годы первыми"""
+    archives = archive_sheet_names()
+    entries = get_cached_entries(archives) if archives else {}
+    return [entries[name]['records'][idx] for name in archives if name in entries
+            for idx in entries[name]['records'].find_owner(owner)]
+
+def group_pets(records):
+    """{(кличка, вид): [записи по дате прививки]} в порядке первого появления питомца"""
+    pets = {}
+    for record in records:
+        name = ' '.join(str(record.get('Кличка', '')).split())
+        kind = ' '.join(str(record.get('Вид_животного', '')).split())
+        pets.setdefault((name.lower(), kind.lower()), []).append(record)
+    for items in pets.values():
+        items.sort(key=lambda record: parse_date(record.get('Дата_прививки', '')) or datetime.min.date())
+    return pets
+
+def next_vaccinations(items):
+    """Следующая прививка по каждому типу — по последней сделанной: [(тип, дата окончания)]"""
+    latest = {}
+    for record in items:
+        vaccine = str(record.get('Тип_прививки', '')).strip()
+        if vaccine:
+            latest[vaccine.lower()] = (vaccine, due_date(record))
+    return sorted((item for item in latest.values() if item[1]), key=lambda item: item[1])
+
+def due_mark(due, today):
+    """Пометка срока: истёк, скоро или в порядке"""
+    if due < today:
+        return f"{EMOJI['urgent']} просрочена"
+    if (due - today).days <= CARD_SOON_DAYS:
+        return f"{EMOJI['warning']} через {(due - today).days} дн."
+    return EMOJI['ok']
+
+def format_pet(items, today):
+    """Блок питомца: история прививок и ближайшие сроки"""
+    first = items[0]
+    pet = first.get('Кличка', '') or 'Без клички'
+    kind = first.get('Вид_животного', '')
+    text = f"{EMOJI['paw']} {pet}" + (f" ({kind})" if kind else "") + "\n"
+    for record in items:
+        line = f"   {EMOJI['syringe']} {record.get('Дата_прививки', '') or '—'} — {record.get('Тип_прививки', '')}"
+        if record.get('Срок_мес', ''):
+            line += f", {record.get('Срок_мес')} мес."
+        text += line + "\n"
+    for vaccine, due in next_vaccinations(items):
+        text += f"   {EMOJI['calendar']} {vaccine}: до {due:%d.%m.%Y} {due_mark(due, today)}\n"
+    return text
+
+def format_owner_card(records, today=None):
+    """Текст карточки владельца, не длиннее CARD_MAX_LENGTH"""
+    today = today or datetime.now().date()
+    # Контакты — из последней записи: их могли уточнить при следующем визите
+    last = records[-1]
+    text = f"{EMOJI['user']} {last.get('ФИО', '') or 'Не указано'}\n"
+    if last.get('Телефон', ''):
+        text += f"{EMOJI['phone']} {last.get('Телефон')}\n"
+    if last.get('Telegram', ''):
+        text += f"Telegram: {last.get('Telegram')}\n"
+    if last.get('Адрес', ''):
+        text += f"{EMOJI['home']} {last.get('Адрес')}\n"
+    
+    pets = list(group_pets(records).values())
+    text += f"\nПитомцев: {len(pets)} · прививок: {len(records)}\n"
+    for shown, items in enumerate(pets):
+        block = "\n" + format_pet(items, today)
+        if len(text) + len(block) > CARD_MAX_LENGTH - 50:
+            text += f"\n... и ещё питомцев: {len(pets) - shown}"
+            break
+        text += block
+    return text
+
+# ============ ИЗМЕНЕНИЕ ЗАПИСЕЙ ============
+# Строка листа адресуется номером (номер записи в кэше + 2) и ключом записи.
+# Перед записью строки перечитываются одним batchGet: если лист правили вручную
+# и строки сдвинулись, чужую запись не трогаем.
+EDITABLE_SHEET = 'Ввод_бот'
+STATUSES = ['Новый', 'Обработан', 'Напомнено']
+# Больше строк одной командой не меняем; диапазоны проверяются до разворачивания
+MAX_CHANGE_ROWS = int(os.environ.get('MAX_CHANGE_ROWS', 1000))
+
+# Поля, которые можно исправить из бота, и проверка значения из VALIDATORS (None — только очистка текста)
+EDITABLE_FIELDS = {
+    'ФИО': 'fio',
+    'Телефон': 'phone',
+    'Telegram': 'telegram',
+    'Адрес': 'address',
+    'Вид_животного': None,
+    'Кличка': 'nickname',
+    'Пол': None,
+    'Возраст_или_ДР': 'age',
+    'Тип_прививки': None,
+    'Дата_прививки': 'vaccine_date',
+    'Срок_мес': 'term_months',
+    'Канал': None,
+    'Комментарий': None,
+}
+
+class RecordChanged(Exception):
+    """Строка в листе не совпадает с записью из кэша"""
+
+def sheet_row(idx):
+    """Номер записи в кэше -> номер строки листа (заголовок + счёт с единицы)"""
+    return idx + 2
+
+def parse_row_numbers(text, last_row=None):
+    """'12, 15, 20-25' -> [12, 15, 20, 21, ...]; None при ошибке.
+    Ошибка и строка после last_row (последней известной строки листа), и больше MAX_CHANGE_ROWS строк"""
+    rows = set()
+    for part in re.split(r'[,\s]+', text.strip()):
+        if not part:
+            continue
+        match = re.fullmatch(r'(\d+)(?:-(\d+))?', part)
+        if not match:
+            return None
+        first, last = int(match.group(1)), int(match.group(2) or match.group(1))
+        if first < 2 or last < first or (last_row is not None and last > last_row):
+            return None
+        if last - first >= MAX_CHANGE_ROWS:
+            return None
+        rows.update(range(first, last + 1))
+        if len(rows) > MAX_CHANGE_ROWS:
+            return None
+    return sorted(rows) or None
+
+def last_cached_row(sheet_name=EDITABLE_SHEET):
+    """Номер последней строки листа по кэшу; None — кэша нет (проверит keys_for_rows)"""
+    entry = tenant().records_cache.get(sheet_name)
+    return sheet_row(len(entry['records']) - 1) if entry else None
+
+def match_status(text):
+    """Статус из списка STATUSES по началу слова без учёта регистра"""
+    text = text.strip().lower()
+    for status in STATUSES:
+        if text and status.lower().startswith(text):
+            return status
+    return None
+
+def validate_field(field, text):
+    """Проверить новое значение поля тем же валидатором, что и в опросе"""
+    validate = EDITABLE_FIELDS.get(field)
+    if validate:
+        return VALIDATORS[validate](text)
+    value = DataValidator.clean_text(text)
+    return (value, None) if value else (None, "Пустое значение")
+
+def locate_record(store, row, key):
+    """Номер записи в кэше: по номеру строки, а если строки сдвинулись — по индексу ключей"""
+    idx = row - 2
+    if 0 <= idx < len(store) and store.key(idx) == key:
+        return idx
+    return store.find_key(key)
+
+def row_spans(rows):
+    """Сгруппировать номера строк в непрерывные диапазоны: [2, 3, 4, 9] -> [(2, 4), (9, 9)]"""
+    spans = []
+    for row in sorted(rows):
+        if spans and spans[-1][1] == row - 1:
+            spans[-1][1] = row
+        else:
+            spans.append([row, row])
+    return [tuple(span) for span in spans]
+
+def fetch_rows(sheet_name, headers, rows):
+    """Строки листа по номерам одним batchGet (подряд идущие — одним диапазоном).
+    Возвращает {номер строки: значения в порядке headers}"""
+    last = column_letter(len(headers) - 1)
+    spans = row_spans(rows)
+    ranges = [f"{quote_sheet(sheet_name)}!A{first}:{last}{end}" for first, end in spans]
+    response = sheets_call(get_spreadsheet().values_batch_get, ranges)
+    
+    actual = {}
+    for (first, end), value_range in zip(spans, response.get('valueRanges', [])):
+        values = value_range.get('values', [])
+        values += [[]] * (end - first + 1 - len(values))
+        for offset, row in enumerate(parse_values([headers] + values)[1]):
+            actual[first + offset] = row
+    return actual
+
+def verify_rows(sheet_name, headers, expected):
+    """Сверить строки листа с ключами из кэша одним batchGet.
+    expected — {номер строки: ключ}; возвращает номера несовпавших строк"""
+    columns = {name: idx for idx, name in enumerate(headers) if name}
+    actual = {
+        row: record_key([values[columns[name]] if name in columns else '' for name in RECORD_KEY_COLUMNS])
+        for row, values in fetch_rows(sheet_name, headers, expected).items()
+    }
+    return [row for row, key in expected.items() if actual.get(row) != key]
+
+def update_records(changes, sheet_name=EDITABLE_SHEET):
+    """Записать изменения записей: одна проверка строк и один batch_update на все ячейки.
+    changes — [(номер строки, ключ, {поле: значение})]. Возвращает число изменённых записей
+    или 'queued', если Sheets недоступны и правки поставлены в очередь"""
+    from gspread.utils import numericise_all
+    
+    entry = get_cached_entry(sheet_name)
+    if not entry:
+        raise SheetsUnavailable(f'no data for {sheet_name}')
+    store, columns = entry['records'], entry['columns']
+    
+    located = []
+    for row, key, fields in changes:
+        idx = locate_record(store, row, key)
+        if idx is None:
+            raise RecordChanged(f'record {key} not found')
+        located.append((idx, key, fields))
+    
+    data = [
+        {'range': f"{column_letter(columns[field])}{sheet_row(idx)}", 'values': [[value]]}
+        for idx, _, fields in located for field, value in fields.items()
+    ]
+    try:
+        # Сначала очередь: отложенная правка не должна перезаписать более новую
+        if not flush_pending_writes():
+            raise SheetsUnavailable('pending writes not flushed')
+        with tenant().write_lock:
+            mismatched = verify_rows(sheet_name, entry['headers'], {sheet_row(idx): key for idx, key, _ in located})
+            if mismatched:
+                refresh_sheets_async([sheet_name], full=True)
+                raise RecordChanged(f'rows changed: {mismatched}')
+            sheet = get_sheet(sheet_name)
+            if not sheet:
+                raise SheetsUnavailable(f'no sheet {sheet_name}')
+            sheets_call(sheet.batch_update, data)
+            
+            with cache_lock:
+                for idx, _, fields in located:
+                    for field, value in fields.items():
+                        store.set(idx, field, numericise_all([str(value)])[0])
+    except SheetsUnavailable as e:
+        print(f"Sheets unavailable, queueing edits: {e}", flush=True)
+        queue_edits(sheet_name, [(key, fields) for _, key, fields in located])
+        return 'queued'
+    schedule_snapshot()
+    print(f"Updated {len(located)} records in {sheet_name} ({len(data)} cells)", flush=True)
+    return len(located)
+
+def set_status(targets, status, sheet_name=EDITABLE_SHEET):
+    """Сменить статус нескольких записей одним запросом. targets — [(номер строки, ключ)]"""
+    return update_records([(row, key, {'Статус_обработки': status}) for row, key in targets], sheet_name)
+
+def keys_for_rows(rows, sheet_name=EDITABLE_SHEET):
+    """Ключи записей по номерам строк из кэша (для команд с номерами строк)"""
+    entry = get_cached_entry(sheet_name)
+    if not entry:
+        raise SheetsUnavailable(f'no data for {sheet_name}')
+    store = entry['records']
+    missing = [row for row in rows if not 0 <= row - 2 < len(store)]
+    if missing:
+        raise RecordChanged(f'rows out of range: {missing}')
+    return [(row, store.key(row - 2)) for row in rows]
+
+# ============ ЭКСПОРТ CSV / XLSX ============
+# Строки идут генератором прямо из колоночного кэша во временный файл
+# порциями по EXPORT_CHUNK — в памяти не собирается ни список строк, ни файл.
+# Большие выгрузки готовятся в фоне, файл приходит отдельным сообщением.
+EXPORT_BACKGROUND_ROWS = int(os.environ.get('EXPORT_BACKGROUND_ROWS', 2000))
+EXPORT_CHUNK = 1000
+EXPORT_PERIODS = [7, 30]  # кнопки «Мои записи»: выгрузка за N дней
+
+last_queries = {}  # chat_id -> (последний поисковый запрос, искали ли в архиве) для выгрузки
+
+DATE_FORMATS = ['%Y-%m-%d', '%d.%m.%Y', '%d/%m/%Y', '%d-%m-%Y']
+
+def parse_date(value):
+    """Дата из ячейки или ввода ('2025-02-15', '15.02.2025', ...) или None"""
+    text = str(value).strip()[:10]
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+def xlsx_available():
+    """openpyxl — необязательная зависимость, без неё выгружаем CSV"""
+    import importlib.util
+    return importlib.util.find_spec('openpyxl') is not None
+
+def iter_export_rows(parts):
+    """Строки выгрузки по одной: заголовок, затем записи.
+    parts — [(имя листа, RecordStore, номера записей)]; при нескольких листах
+    столбцы объединяются, а первым идёт столбец «Лист»"""
+    headers = []
+    for _, store, _ in parts:
+        headers += [name for name in store.headers if name and name not in headers]
+    with_sheet = len(parts) > 1
+    yield (['Лист'] if with_sheet else []) + headers
+    
+    for sheet_name, store, indexes in parts:
+        columns = [store.data[store.columns[name]] if name in store.columns else None for name in headers]
+        for idx in indexes:
+            row = [column.get(idx) if column is not None else '' for column in columns]
+            yield [sheet_name] + row if with_sheet else row
+
+def write_csv(path, rows):
+    """CSV для Excel: UTF-8 с BOM, разделитель «;», запись порциями"""
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f, delimiter=';')
+        while True:
+            chunk = list(itertools.islice(rows, EXPORT_CHUNK))
+            if not chunk:
+                break
+            writer.writerows(chunk)
+
+def write_xlsx(path, rows):
+    """XLSX в режиме write_only: openpyxl сбрасывает строки на диск по мере записи"""
+    from openpyxl import Workbook
+    
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet('Записи')
+    for row in rows:
+        worksheet.append(row)
+    workbook.save(path)
+
+def build_export(parts, fmt):
+    """Записать выгрузку во временный файл и вернуть путь"""
+    fd, path = tempfile.mkstemp(prefix='bdpj-export-', suffix=f'.{fmt}')
+    os.close(fd)
+    try:
+        if fmt == 'xlsx':
+            write_xlsx(path, iter_export_rows(parts))
+        else:
+            write_csv(path, iter_export_rows(parts))
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+def send_export(chat_id, parts, fmt, filename, caption):
+    """Собрать файл и отправить документом; временный файл удаляется после отправки"""
+    started = time.perf_counter()
+    try:
+        path = build_export(parts, fmt)
+    except Exception as e:
+        print(f"Error building export: {e}", flush=True)
+        send_message(chat_id, f"{EMOJI['cross']} Не удалось подготовить файл. Попробуйте позже.", main_inline_keyboard())
+        return None
+    print(f"Export built: {filename}, {os.path.getsize(path)} bytes, "
+          f"{(time.perf_counter() - started) * 1000:.0f} ms", flush=True)
+    return send_document(chat_id, path, filename, caption, main_inline_keyboard())
+
+def start_export(chat_id, parts, fmt, filename, caption):
+    """Выгрузка: небольшие — сразу, большие — в фоне с уведомлением"""
+    count = sum(len(indexes) for _, _, indexes in parts)
+    if not count:
+        send_message(chat_id, f"{EMOJI['warning']} Нет записей для выгрузки", main_inline_keyboard())
+        return 'ok'
+    if fmt == 'xlsx' and not xlsx_available():
+        fmt = 'csv'
+        caption += "\n(XLSX недоступен — выгружено в CSV)"
+    filename = f"{filename}.{fmt}"
+    caption = f"{caption}\nСтрок: {count}"
+    
+    if count > EXPORT_BACKGROUND_ROWS:
+        send_message(chat_id, f"{EMOJI['clock']} Готовлю файл ({count} строк) — пришлю, когда будет готов.")
+        start_thread(send_export, chat_id, parts, fmt, filename, caption)
+    else:
+        send_export(chat_id, parts, fmt, filename, caption)
+    return 'ok'
+
+def search_export_parts(query, archive=False):
+    """Полный набор результатов поиска для выгрузки (без ограничения в 5 записей)"""
+    return find_matches(query, archive)
+
+def my_records_export_parts(user_identifier, date_from, date_to):
+    """Записи сотрудника с датой прививки в диапазоне [date_from, date_to];
+    архивы читаются только за годы, попавшие в период"""
+    archives = [name for name in archive_sheet_names()
+                if archive_year(name) and date_from.year <= archive_year(name) <= date_to.year]
+    entries = get_cached_entries(['Ввод_бот'] + archives)
+    if 'Ввод_бот' not in entries:
+        raise SheetsUnavailable('no data for Ввод_бот')
+    parts = []
+    for sheet_name in archives + ['Ввод_бот']:
+        if sheet_name not in entries:
+            continue
+        store = entries[sheet_name]['records']
+        indexes = array('I')
+        for record in store:
+            if not is_staff_record(record, user_identifier):
+                continue
+            date = parse_date(record.get('Дата_прививки', ''))
+            if date and date_from <= date <= date_to:
+                indexes.append(record.row_index)
+        if indexes or sheet_name == 'Ввод_бот':
+            parts.append((sheet_name, store, indexes))
+    return parts
+
+# ============ TELEGRAM API ============
+# В async-режиме вызовы Bot API не выполняются сразу, а складываются в очередь
+# текущего апдейта и отправляются асинхронным клиентом после обработки.
+_outbox = contextvars.ContextVar('telegram_outbox', default=None)
+
+# Один пул HTTP-соединений к Bot API на весь процесс (все клиники)
+http_session = requests.Session()
+
+def encode_form(payload):
+    """Поля multipart-запроса: вложенные объекты — в JSON, остальное — строками"""
+    return {k: json.dumps(v) if isinstance(v, (dict, list)) else str(v) for k, v in payload.items()}
+
+def open_uploads(files):
+    """{поле: путь или (путь, имя файла)} -> файлы для multipart (requests и httpx)"""
+    uploads = {}
+    for field, spec in files.items():
+        path, filename = spec if isinstance(spec, tuple) else (spec, os.path.basename(spec))
+        uploads[field] = (filename, open(path, 'rb'))
+    return uploads
+
+def close_uploads(uploads, files, remove):
+    """Закрыть файлы загрузки; remove — удалить временные файлы после отправки"""
+    for _, handle in uploads.values():
+        handle.close()
+    if remove:
+        for spec in files.values():
+            path = spec[0] if isinstance(spec, tuple) else spec
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Error removing {path}: {e}", flush=True)
+
+def telegram_request(method, payload, files=None, timeout=10, on_result=None, remove_files=False):
+    """Вызов метода Bot API; files — {поле: путь к файлу или (путь, имя файла)},
+    remove_files — удалить эти файлы после отправки"""
+    outbox = _outbox.get()
+    if outbox is not None:
+        outbox.append({'method': method, 'payload': payload, 'files': files,
+                       'timeout': timeout, 'on_result': on_result, 'remove_files': remove_files})
+        return None
+    
+    url = f'https://api.telegram.org/bot{TOKEN}/{method}'
+    if files:
+        uploads = {}
+        try:
+            uploads = open_uploads(files)
+            response = http_session.post(url, files=uploads, data=encode_form(payload), timeout=timeout)
+        finally:
+            close_uploads(uploads, files, remove_files)
+    else:
+        response = http_session.post(url, json=payload, timeout=timeout)
+    
+    print(f"{method}: chat={payload.get('chat_id')}, status={response.status_code}", flush=True)
+    result = response.json()
+    if on_result:
+        on_result(result)
+    return result
+
+def send_message(chat_id, text, keyboard=None, parse_mode=None):
     payload = {
         'chat_id': chat_id,
         'text': text,
@@ -462,30 +2484,44 @@ def send_message(chat_id, text, keyboard=None, parse_mode=None):
         payload['parse_mode'] = parse_mode
     
     try:
-        response = requests.post(url, json=payload, timeout=10)
-        print(f"send_message: chat={chat_id}, status={response.status_code}", flush=True)
-        return response.json()
+        return telegram_request('sendMessage', payload)
     except Exception as e:
         print(f"Error sending message: {e}", flush=True)
         return None
 
 def send_animation(chat_id, animation_path, caption=None, keyboard=None):
-    """Отправить анимацию (GIF/MP4)"""
-    url = f'https://api.telegram.org/bot{TOKEN}/sendAnimation'
-    
-    try:
-        with open(animation_path, 'rb') as animation_file:
-            files = {'animation': animation_file}
-            data = {
-                'chat_id': chat_id,
-                'caption': caption or '',
-            }
-            if keyboard:
-                data['reply_markup'] = json.dumps(keyboard)
-            
-            response = requests.post(url, files=files, data=data, timeout=30)
-            print(f"send_animation: chat={chat_id}, status={response.status_code}", flush=True)
-            return response.json()
+    """Отправить анимацию (GIF/MP4); после первой загрузки используем file_id"""
+    data = {
+        'chat_id': chat_id,
+        'caption': caption or '',
+    }
+    if keyboard:
+        data['reply_markup'] = keyboard
+    
+    file_id = media_cache.get(animation_path)
+    if file_id:
+        def forget_file_id(result):
+            if not result.get('ok'):
+                media_cache.pop(animation_path, None)
+        
+        try:
+            result = telegram_request('sendAnimation', {**data, 'animation': file_id},
+                                      on_result=forget_file_id)
+            if result is None or result.get('ok'):
+                return result
+        except Exception as e:
+            print(f"Error sending animation by file_id: {e}", flush=True)
+    
+    def remember_file_id(result):
+        message = result.get('result') or {}
+        media = message.get('animation') or message.get('document') or message.get('video')
+        if media and media.get('file_id'):
+            media_cache[animation_path] = media['file_id']
+            schedule_snapshot()
+    
+    try:
+        return telegram_request('sendAnimation', data, files={'animation': animation_path},
+                                timeout=30, on_result=remember_file_id)
     except FileNotFoundError:
         print(f"Error: Animation file not found: {animation_path}", flush=True)
         return None
@@ -493,6 +2529,21 @@ def send_animation(chat_id, animation_path, caption=None, keyboard=None):
         print(f"Error sending animation: {e}", flush=True)
         return None
 
+def send_document(chat_id, path, filename, caption=None, keyboard=None):
+    """Отправить файл документом; path — временный файл, удаляется после отправки"""
+    data = {
+        'chat_id': chat_id,
+        'caption': caption or '',
+    }
+    if keyboard:
+        data['reply_markup'] = keyboard
+    try:
+        return telegram_request('sendDocument', data, files={'document': (path, filename)},
+                                timeout=60, remove_files=True)
+    except Exception as e:
+        print(f"Error sending document: {e}", flush=True)
+        return None
+
 # ============ INLINE КЛАВИАТУРЫ ============
 def main_inline_keyboard():
     return {
@@ -565,68 +2616,203 @@ def vaccine_type_inline_keyboard():
         ]
     }
 
+def search_results_keyboard(results):
+    """Кнопки показанных записей «Ввод_бот»: статус и правка, карточка владельца + главное меню"""
+    rows = []
+    for i, result in enumerate(results[:5], 1):
+        record = result['data']
+        if result.get('source') != EDITABLE_SHEET or not isinstance(record, RecordView):
+            continue
+        rows.append([
+            {'text': f"{i}. {EMOJI['edit']} {record.get('Кличка', '')}",
+             'callback_data': f"rec:{result['row']}:{record.key}"},
+            {'text': f"{i}. {EMOJI['user']} Владелец",
+             'callback_data': f"owner:{result['row']}:{record.key}"}
+        ])
+    if results:
+        rows.append([
+            {'text': f"{EMOJI['list']} Все в CSV", 'callback_data': 'exp_search:csv'},
+            {'text': f"{EMOJI['list']} Все в XLSX", 'callback_data': 'exp_search:xlsx'}
+        ])
+    if results and not is_archive_sheet(results[0]['source']) and archive_sheet_names():
+        rows.append([{'text': f"{EMOJI['archive']} Искать в архиве", 'callback_data': 'arch_search'}])
+    return {'inline_keyboard': rows + main_inline_keyboard()['inline_keyboard']}
+
+def owner_choice_keyboard(owners):
+    """Тёзки по /card: кнопка с телефоном на каждого + главное меню"""
+    rows = [[{'text': f"{EMOJI['phone']} {owner if owner.startswith('+') else 'без телефона'}",
+              'callback_data': f"card:{n}"}] for n, owner in enumerate(owners[:10])]
+    return {'inline_keyboard': rows + main_inline_keyboard()['inline_keyboard']}
+
+def owner_card_keyboard(row, key):
+    """Карточка владельца: история из архива + главное меню"""
+    return {'inline_keyboard': [
+        [{'text': f"{EMOJI['archive']} История из архива", 'callback_data': f"owner_arch:{row}:{key}"}]
+    ] + main_inline_keyboard()['inline_keyboard']}
+
+def my_records_inline_keyboard():
+    """Выгрузка своих записей за период + главное меню"""
+    exports = [{'text': f"{EMOJI['list']} Выгрузка за {days} дн.", 'callback_data': f"exp_my:{days}"}
+               for days in EXPORT_PERIODS]
+    return {'inline_keyboard': [exports] + main_inline_keyboard()['inline_keyboard']}
+
+def record_inline_keyboard(row, key, status):
+    """Действия с записью: смена статуса и правка поля"""
+    statuses = [{'text': name, 'callback_data': f"st:{row}:{key}:{code}"}
+                for code, name in enumerate(STATUSES) if name != status]
+    return {
+        'inline_keyboard': [
+            statuses,
+            [{'text': f"{EMOJI['edit']} Изменить поле", 'callback_data': f"ef:{row}:{key}"}],
+            [{'text': f"{EMOJI['cancel']} Отмена", 'callback_data': 'cancel'}]
+        ]
+    }
+
+def fields_inline_keyboard(row, key, columns):
+    """Выбор поля записи для правки (по два в ряд)"""
+    buttons = [{'text': field, 'callback_data': f"fld:{row}:{key}:{columns[field]}"}
+               for field in EDITABLE_FIELDS if field in columns]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    rows.append([{'text': f"{EMOJI['cancel']} Отмена", 'callback_data': 'cancel'}])
+    return {'inline_keyboard': rows}
+
+def confirm_inline_keyboard():
+    """Подтверждение записи: сохранить, исправить поле N, назад, отмена"""
+    numbers = [{'text': str(i), 'callback_data': f"edit_step:{i - 1}"} for i in range(1, len(STEPS) + 1)]
+    return {
+        'inline_keyboard': [
+            [{'text': f"{EMOJI['ok']} Сохранить", 'callback_data': 'confirm'}],
+            *[numbers[i:i + 7] for i in range(0, len(numbers), 7)],
+            [
+                {'text': '◀ Назад', 'callback_data': 'back'},
+                {'text': f"{EMOJI['cancel']} Отмена", 'callback_data': 'cancel'}
+            ]
+        ]
+    }
+
 # ============ ДАННЫЕ ОПРОСА ============
 STEPS = [
-    {'key': 'fio', 'ask': f"{EMOJI['user']} ФИО владельца\n\nВведите полностью фамилию, имя и отчество", 'kb': None, 'validate': 'fio'},
-    {'key': 'phone', 'ask': f"{EMOJI['phone']} Телефон\n\nНапример:\n• +79001234567\n• 89001234567\n• 7-900-123-45-67", 'kb': None, 'validate': 'phone'},
-    {'key': 'telegram', 'ask': f"{EMOJI['paw']} Telegram (необязательно)\n\nВведите @username или напишите «-» если нет", 'kb': None, 'validate': 'telegram'},
-    {'key': 'address', 'ask': f"{EMOJI['home']} Адрес\n\nГде проживаете?\nГород, улица, дом, квартира", 'kb': None, 'validate': 'address'},
-    {'key': 'consent', 'ask': f"{EMOJI['bell']} Согласие на уведомления\n\nМожем ли мы присылать напоминания о прививках?", 'kb': 'yes_no', 'validate': None},
-    {'key': 'animal_type', 'ask': f"{EMOJI['paw']} Вид животного", 'kb': 'animal', 'validate': None},
-    {'key': 'nickname', 'ask': f"{EMOJI['heart']} Кличка питомца", 'kb': None, 'validate': 'nickname'},
-    {'key': 'sex', 'ask': "Пол", 'kb': 'sex', 'validate': None},
-    {'key': 'age_or_dob', 'ask': f"{EMOJI['calendar']} Возраст или дата рождения\n\nПримеры:\n• 3 года\n• 2.5 месяца\n• 15.05.2020\n• 2020-05-15", 'kb': None, 'validate': 'age'},
-    {'key': 'vaccine_type', 'ask': f"{EMOJI['syringe']} Тип прививки", 'kb': 'vaccine', 'validate': None},
-    {'key': 'vaccine_date', 'ask': f"{EMOJI['calendar']} Дата прививки\n\n• Сегодня\n• 15.02.2025\n• 2025-02-15", 'kb': None, 'validate': 'vaccine_date'},
-    {'key': 'term_months', 'ask': f"Срок действия (месяцев)\n\n• 12 — бешенство\n• 36 — комплексная\n• Можно дробные: 6, 12, 18", 'kb': None, 'validate': 'term_months'},
-    {'key': 'channel', 'ask': f"{EMOJI['bell']} Канал напоминаний", 'kb': 'channel', 'validate': None},
+    {'key': 'fio', 'title': 'ФИО', 'ask': f"{EMOJI['user']} ФИО владельца\n\nВведите полностью фамилию, имя и отчество", 'kb': None, 'validate': 'fio'},
+    {'key': 'phone', 'title': 'Телефон', 'ask': f"{EMOJI['phone']} Телефон\n\nНапример:\n• +79001234567\n• 89001234567\n• 7-900-123-45-67", 'kb': None, 'validate': 'phone'},
+    {'key': 'telegram', 'title': 'Telegram', 'ask': f"{EMOJI['paw']} Telegram (необязательно)\n\nВведите @username или напишите «-» если нет", 'kb': None, 'validate': 'telegram'},
+    {'key': 'address', 'title': 'Адрес', 'ask': f"{EMOJI['home']} Адрес\n\nГде проживаете?\nГород, улица, дом, квартира", 'kb': None, 'validate': 'address'},
+    {'key': 'consent', 'title': 'Согласие', 'ask': f"{EMOJI['bell']} Согласие на уведомления\n\nМожем ли мы присылать напоминания о прививках?", 'kb': 'yes_no', 'validate': None},
+    {'key': 'animal_type', 'title': 'Вид животного', 'ask': f"{EMOJI['paw']} Вид животного", 'kb': 'animal', 'validate': None},
+    {'key': 'nickname', 'title': 'Кличка', 'ask': f"{EMOJI['heart']} Кличка питомца", 'kb': None, 'validate': 'nickname'},
+    {'key': 'sex', 'title': 'Пол', 'ask': "Пол", 'kb': 'sex', 'validate': None},
+    {'key': 'age_or_dob', 'title': 'Возраст / ДР', 'ask': f"{EMOJI['calendar']} Возраст или дата рождения\n\nПримеры:\n• 3 года\n• 2.5 месяца\n• 15.05.2020\n• 2020-05-15", 'kb': None, 'validate': 'age'},
+    {'key': 'vaccine_type', 'title': 'Прививка', 'ask': f"{EMOJI['syringe']} Тип прививки", 'kb': 'vaccine', 'validate': None},
+    {'key': 'vaccine_date', 'title': 'Дата прививки', 'ask': f"{EMOJI['calendar']} Дата прививки\n\n• Сегодня\n• 15.02.2025\n• 2025-02-15", 'kb': None, 'validate': 'vaccine_date'},
+    {'key': 'term_months', 'title': 'Срок, мес.', 'ask': "Срок действия (месяцев)\n\n• 12 — бешенство\n• 36 — комплексная\n• Можно дробные: 6, 12, 18", 'kb': None, 'validate': 'term_months'},
+    {'key': 'channel', 'title': 'Канал', 'ask': f"{EMOJI['bell']} Канал напоминаний", 'kb': 'channel', 'validate': None},
 ]
 
+# Опрос описан данными: шаг с кнопками берёт значения из STEP_CHOICES,
+# текстовый ответ проверяется по VALIDATORS. OTHER — кнопка «Другое»:
+# значение вводится текстом, вопрос и подсказка об ошибке — в OTHER_PROMPTS.
+OTHER = object()
+
+STEP_CHOICES = {
+    'yes_no': {'yes': 'Да', 'no': 'Нет'},
+    'animal': {'dog': 'Собака', 'cat': 'Кошка', 'other_animal': OTHER},
+    'sex': {'male': 'М', 'female': 'Ж'},
+    'vaccine': {'vaccine_rabies': 'Бешенство', 'vaccine_complex': 'Комплексная', 'vaccine_other': OTHER},
+    'channel': {'sms': 'SMS', 'telegram': 'Telegram'},
+}
+
+OTHER_PROMPTS = {
+    'animal': (f"{EMOJI['paw']} Укажите вид животного\n\nНапример: кролик, хомяк, попугай...",
+               "Слишком коротко. Введите вид животного полностью."),
+    'vaccine': (f"{EMOJI['syringe']} Укажите тип прививки",
+                "Слишком коротко. Введите тип прививки полностью."),
+}
+
+STEP_KEYBOARDS = {
+    'yes_no': yes_no_inline_keyboard,
+    'animal': animal_inline_keyboard,
+    'sex': sex_inline_keyboard,
+    'channel': channel_inline_keyboard,
+    'vaccine': vaccine_type_inline_keyboard,
+}
+
+VALIDATORS = {
+    'fio': DataValidator.validate_fio,
+    'phone': DataValidator.validate_phone,
+    'telegram': DataValidator.validate_telegram,
+    'address': DataValidator.validate_address,
+    'nickname': DataValidator.validate_nickname,
+    'age': DataValidator.validate_age,
+    'vaccine_date': DataValidator.validate_vaccine_date,
+    'term_months': DataValidator.validate_term_months,
+    None: lambda text: (DataValidator.clean_text(text), None),
+}
+
+# callback_data кнопки выбора -> (клавиатура, значение)
+CHOICE_ROUTES = {data: (kb, value) for kb, choices in STEP_CHOICES.items() for data, value in choices.items()}
+
 user_states = {}
 
-def get_step_keyboard(step_type):
-    if step_type == 'yes_no':
-        return yes_no_inline_keyboard()
-    elif step_type == 'animal':
-        return animal_inline_keyboard()
-    elif step_type == 'sex':
-        return sex_inline_keyboard()
-    elif step_type == 'channel':
-        return channel_inline_keyboard()
-    elif step_type == 'vaccine':
-        return vaccine_type_inline_keyboard()
-    return None
+def step_keyboard(state):
+    """Клавиатура шага: кнопки выбора (если есть), «◀ Назад» и «Отмена»"""
+    step = STEPS[state['step']]
+    if step['kb'] and not state.get('waiting_for'):
+        keyboard = STEP_KEYBOARDS[step['kb']]()
+    else:
+        keyboard = {'inline_keyboard': [[{'text': f"{EMOJI['cancel']} Отмена", 'callback_data': 'cancel'}]]}
+    if state['step'] > 0 or state.get('editing') or state.get('waiting_for'):
+        keyboard['inline_keyboard'][-1].insert(0, {'text': '◀ Назад', 'callback_data': 'back'})
+    return keyboard
+
+def format_confirmation(data):
+    """Сводка записи перед сохранением: поля с номерами для исправления"""
+    lines = [f"{EMOJI['list']} Проверьте запись\n"]
+    for i, step in enumerate(STEPS, 1):
+        lines.append(f"{i}. {step['title']}: {data.get(step['key']) or '—'}")
+    lines.append("\nВсё верно? Нажмите «Сохранить» или номер поля, чтобы исправить.")
+    return '\n'.join(lines)
 
 # ============ СОХРАНЕНИЕ ============
 def save_to_sheet(data):
+    """Записать строку; при недоступности Sheets — поставить в очередь.
+    Возвращает 'saved', 'queued' или None при ошибке"""
+    row = [
+        data.get('date_visit', ''),
+        data.get('staff_tg', ''),
+        data.get('fio', ''),
+        data.get('phone', ''),
+        data.get('telegram', ''),
+        data.get('address', ''),
+        data.get('consent', ''),
+        data.get('animal_type', ''),
+        data.get('nickname', ''),
+        data.get('sex', ''),
+        data.get('age_or_dob', ''),
+        data.get('vaccine_type', ''),
+        data.get('vaccine_date', ''),
+        data.get('term_months', ''),
+        data.get('channel', ''),
+        'Новый',
+        data.get('comment', '')
+    ]
     try:
         sheet = get_sheet('Ввод_бот')
-        row = [
-            data.get('date_visit', ''),
-            data.get('staff_tg', ''),
-            data.get('fio', ''),
-            data.get('phone', ''),
-            data.get('telegram', ''),
-            data.get('address', ''),
-            data.get('consent', ''),
-            data.get('animal_type', ''),
-            data.get('nickname', ''),
-            data.get('sex', ''),
-            data.get('age_or_dob', ''),
-            data.get('vaccine_type', ''),
-            data.get('vaccine_date', ''),
-            data.get('term_months', ''),
-            data.get('channel', ''),
-            'Новый',
-            data.get('comment', '')
-        ]
-        sheet.append_row(row)
-        return True
+        if not sheet:
+            return None
+        # Без автоматических повторов: после таймаута строка могла уже записаться
+        response = sheets_call_once(sheet.append_row, row)
+        append_cached_record('Ввод_бот', row, row_number=appended_row_number(response))
+        return 'saved'
+    except SheetsUnavailable as e:
+        print(f"Sheets unavailable, queueing write: {e}", flush=True)
+        queue_write('Ввод_бот', row, check=True)
+        return 'queued'
     except Exception as e:
         print(f"Error saving: {e}", flush=True)
-        return False
+        return None
 
 # ============ ОБРАБОТКА ============
+SHEETS_UNAVAILABLE_TEXT = f"{EMOJI['warning']} Google Таблицы временно недоступны\n\nПопробуйте через пару минут."
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
     sys.stdout.flush()
@@ -635,82 +2821,69 @@ def webhook():
     
     try:
         data = request.get_json(force=True)
+    except Exception as e:
+        print(f"Bad webhook payload: {e}", flush=True)
+        return 'ok'
+    if profile_requested(request.headers.get('X-Profile-Secret')):
+        return run_profiled(update_kind(data), process_update, data)
+    return process_update(data)
+
+def format_user(sender):
+    """@username сотрудника или его имя, если username нет"""
+    username = sender.get('username', '')
+    return f'@{username}' if username else sender.get('first_name', 'сотрудник')
+
+def route_update(data):
+    """Выбрать клинику для апдейта и проверить, что сотрудник в её списке"""
+    if 'callback_query' in data:
+        callback = data['callback_query']
+        chat_id, user = callback['message']['chat']['id'], format_user(callback['from'])
+    elif 'message' in data:
+        chat_id, user = data['message']['chat']['id'], format_user(data['message']['from'])
+    else:
+        return True
+    
+    t = route_tenant(chat_id, user)
+    if t is None or not t.allows(user):
+        print(f"Access denied: chat={chat_id}, user={user}, tenant={t.id if t else None}", flush=True)
+        if 'callback_query' in data:
+            answer_callback(data['callback_query']['id'])
+        send_message(chat_id, f"{EMOJI['warning']} Нет доступа. Обратитесь к администратору клиники.")
+        return False
+    
+    activate_tenant(t)
+    print(f"Tenant: {t.id}", flush=True)
+    return True
+
+def process_update(data):
+    """Обработка апдейта Telegram — общая для WSGI и ASGI режимов.
+    Обработчик находится поиском по словарям маршрутов (см. конец раздела)"""
+    try:
         print(f"Received data: {json.dumps(data, ensure_ascii=False)}", flush=True)
         
         if not data:
             print("Empty data received", flush=True)
             return 'ok'
         
-        if 'callback_query' in data:
-            print("Processing callback_query", flush=True)
-            return handle_callback(data['callback_query'])
-        
-        if 'message' not in data:
-            print(f"No 'message' in data. Keys: {list(data.keys())}", flush=True)
-            return 'ok'
-        
-        msg = data['message']
-        chat_id = msg['chat']['id']
-        text = msg.get('text', '').strip()
-        username = msg['from'].get('username', '')
-        first_name = msg['from'].get('first_name', 'сотрудник')
-        user = f'@{username}' if username else first_name
-        
-        print(f"Message from {user} (chat_id: {chat_id}): '{text}'", flush=True)
-        
-        if text == '/start':
-            print("Processing /start command", flush=True)
-            user_states.pop(chat_id, None)
-            
-            # Отправляем песочные часы
-            url = f'https://api.telegram.org/bot{TOKEN}/sendMessage'
-            try:
-                resp = requests.post(url, json={
-                    'chat_id': chat_id,
-                    'text': '⌛️',
-                    'reply_markup': {'remove_keyboard': True}
-                }, timeout=5)
-                print(f"Remove keyboard response: {resp.status_code}", flush=True)
-            except Exception as e:
-                print(f"Error removing keyboard: {e}", flush=True)
-            
-            # Отправляем logo.mp4
-            logo_path = 'images/logo.mp4'
-            print(f"Sending logo animation from {logo_path}", flush=True)
-            send_animation(chat_id, logo_path)
-            
-            # Отправляем приветственное сообщение с меню
-            welcome_caption = f"""{EMOJI['logo']} БДПЖ Боровск
-
-База данных привитых животных
-
-Выберите действие 👇"""
-            
-            print(f"Sending welcome message to {chat_id}", flush=True)
-            result = send_message(chat_id, welcome_caption, main_inline_keyboard())
-            print(f"Welcome message result: {result}", flush=True)
-            return 'ok'
-        
-        if text == '/cancel':
-            print("Processing /cancel command", flush=True)
-            user_states.pop(chat_id, None)
-            send_message(chat_id, f"{EMOJI['ok']} Ок, отменено.\n\nЧто дальше?", main_inline_keyboard())
+        if not route_update(data):
             return 'ok'
         
-        if chat_id in user_states and user_states[chat_id].get('mode') == 'search':
-            print(f"Processing search query: {text}", flush=True)
-            del user_states[chat_id]['mode']
-            results = search_all_sheets(text)
-            print(f"Search results: {len(results)} found", flush=True)
-            send_message(chat_id, format_search_results(results), main_inline_keyboard())
+        if 'callback_query' in data:
+            answer_callback(data['callback_query']['id'])
+            resolve, payload = resolve_callback, data['callback_query']
+        elif 'message' in data:
+            resolve, payload = resolve_message, data['message']
+        else:
+            print(f"No 'message' in data. Keys: {list(data.keys())}", flush=True)
             return 'ok'
         
-        if chat_id in user_states:
-            print(f"Processing input for state: {user_states[chat_id]}", flush=True)
-            return handle_input(chat_id, text, user)
-        
-        print("No state found, showing main menu", flush=True)
-        send_message(chat_id, f"{EMOJI['paw']} Нажмите кнопку в меню выше или отправьте /start", main_inline_keyboard())
+        started = time.perf_counter()
+        route, handler, args = resolve(payload)
+        resolved = time.perf_counter()
+        print(f"Update from {args[1]} (chat_id: {args[0]}): route {route}", flush=True)
+        if handler is not None:
+            handler(*args)
+        record_dispatch(route, resolved - started, time.perf_counter() - resolved)
         
     except Exception as e:
         print(f"CRITICAL ERROR in webhook: {e}", flush=True)
@@ -720,195 +2893,461 @@ def webhook():
     print("=" * 50, flush=True)
     return 'ok'
 
-def handle_callback(callback):
-    """Обработка нажатий на inline кнопки"""
-    chat_id = callback['message']['chat']['id']
-    data = callback['data']
-    username = callback['from'].get('username', '')
-    first_name = callback['from'].get('first_name', 'сотрудник')
-    user = f'@{username}' if username else first_name
-    
-    print(f"Callback from {user}: data={data}", flush=True)
-    
-    answer_callback(callback['id'])
-    
-    if data == 'new_record':
-        user_states[chat_id] = {
-            'step': 0,
-            'data': {
-                'date_visit': datetime.now().strftime('%Y-%m-%d'),
-                'staff_tg': user
-            }
+def resolve_callback(callback):
+    """Обработчик кнопки — по префиксу callback_data до «:»"""
+    payload = callback.get('data', '')
+    name = payload.split(':', 1)[0]
+    handler = CALLBACK_ROUTES.get(name)
+    args = (callback['message']['chat']['id'], format_user(callback['from']), payload)
+    return (f"callback:{name}" if handler else 'callback:unknown'), handler, args
+
+def resolve_message(msg):
+    """Обработчик сообщения: команда, ввод в текущем режиме (поиск, правка, опрос) или подсказка"""
+    chat_id = msg['chat']['id']
+    text = msg.get('text', '').strip()
+    user = format_user(msg['from'])
+    
+    command, _, args = text.partition(' ')
+    if command in COMMAND_ROUTES:
+        return command, COMMAND_ROUTES[command], (chat_id, user, args)
+    state = user_states.get(chat_id)
+    if state is not None:
+        mode = state.get('mode', 'wizard')
+        return f"input:{mode}", TEXT_ROUTES.get(mode), (chat_id, user, text)
+    return 'menu', on_menu_hint, (chat_id, user, text)
+
+# Время поиска обработчика и обработки по маршрутам (для /readyz)
+dispatch_stats = {}
+dispatch_lock = threading.Lock()
+
+def record_dispatch(route, resolve_seconds, handle_seconds):
+    resolve_us, handle_ms = resolve_seconds * 1e6, handle_seconds * 1000
+    with dispatch_lock:
+        stats = dispatch_stats.setdefault(route, {'count': 0, 'resolve_us': 0.0, 'handle_ms': 0.0, 'max_ms': 0.0})
+        stats['count'] += 1
+        stats['resolve_us'] += resolve_us
+        stats['handle_ms'] += handle_ms
+        stats['max_ms'] = max(stats['max_ms'], handle_ms)
+    print(f"Dispatch {route}: resolve {resolve_us:.1f} us, handler {handle_ms:.1f} ms", flush=True)
+
+def dispatch_report():
+    with dispatch_lock:
+        return {
+            route: {'count': stats['count'],
+                    'avg_resolve_us': round(stats['resolve_us'] / stats['count'], 2),
+                    'avg_ms': round(stats['handle_ms'] / stats['count'], 1),
+                    'max_ms': round(stats['max_ms'], 1)}
+            for route, stats in dispatch_stats.items()
         }
-        step = STEPS[0]
-        kb = get_step_keyboard(step['kb'])
-        send_message(chat_id, step['ask'], kb)
-        return 'ok'
+
+# ---------- Команды и главное меню ----------
+def on_start(chat_id, user, args):
+    user_states.pop(chat_id, None)
     
-    if data == 'search':
-        user_states[chat_id] = {'mode': 'search'}
-        send_message(chat_id, f"{EMOJI['search']} Поиск")
-        return 'ok'
+    # Отправляем песочные часы
+    try:
+        telegram_request('sendMessage', {
+            'chat_id': chat_id,
+            'text': '⌛️',
+            'reply_markup': {'remove_keyboard': True}
+        }, timeout=5)
+    except Exception as e:
+        print(f"Error removing keyboard: {e}", flush=True)
     
-    if data == 'my_records':
-        records = get_my_records(user)
-        summary = format_records_summary(records)
-        details = get_records_details(records)
-        
-        text = f"{EMOJI['list']} Мои записи\n\n{summary}\n\n{details}"
-        send_message(chat_id, text, main_inline_keyboard())
-        return 'ok'
+    # Отправляем logo.mp4
+    logo_path = 'images/logo.mp4'
+    print(f"Sending logo animation from {logo_path}", flush=True)
+    send_animation(chat_id, logo_path)
     
-    if data == 'contacts':
-        send_message(chat_id, f"{EMOJI['paw']} Ветеринарная клиника\n\n{EMOJI['phone']} +7 (XXX) XXX-XX-XX\n{EMOJI['clock']} Пн-Пт: 9:00-18:00\n{EMOJI['clock']} Сб: 9:00-14:00")
-        return 'ok'
+    # Отправляем приветственное сообщение с меню
+    welcome_caption = f"""{EMOJI['logo']} БДПЖ Боровск
+
+База данных привитых животных
+
+Выберите действие 👇"""
     
-    if data == 'cancel':
-        user_states.pop(chat_id, None)
-        send_message(chat_id, f"{EMOJI['ok']} Ок, отменено.\n\nЧто дальше?", main_inline_keyboard())
+    print(f"Sending welcome message to {chat_id}", flush=True)
+    result = send_message(chat_id, welcome_caption, main_inline_keyboard())
+    print(f"Welcome message result: {result}", flush=True)
+    return 'ok'
+
+def on_cancel(chat_id, user, payload):
+    """Кнопка «Отмена» и команда /cancel"""
+    user_states.pop(chat_id, None)
+    send_message(chat_id, f"{EMOJI['ok']} Ок, отменено.\n\nЧто дальше?", main_inline_keyboard())
+    return 'ok'
+
+def on_menu_hint(chat_id, user, text):
+    send_message(chat_id, f"{EMOJI['paw']} Нажмите кнопку в меню выше или отправьте /start", main_inline_keyboard())
+    return 'ok'
+
+def on_search(chat_id, user, payload):
+    user_states[chat_id] = {'mode': 'search'}
+    send_message(chat_id, f"{EMOJI['search']} Поиск")
+    return 'ok'
+
+def on_search_query(chat_id, user, text):
+    print(f"Processing search query: {text}", flush=True)
+    user_states.pop(chat_id, None)
+    try:
+        results = search_all_sheets(text)
+    except SheetsUnavailable as e:
+        print(f"Search unavailable: {e}", flush=True)
+        send_message(chat_id, SHEETS_UNAVAILABLE_TEXT, main_inline_keyboard())
         return 'ok'
-    
-    if chat_id in user_states and 'step' in user_states[chat_id]:
-        state = user_states[chat_id]
-        step_idx = state['step']
-        
-        if step_idx < len(STEPS):
-            step = STEPS[step_idx]
-            
-            if step['kb'] == 'yes_no':
-                if data in ['yes', 'no']:
-                    state['data'][step['key']] = 'Да' if data == 'yes' else 'Нет'
-                    state['step'] += 1
-            elif step['kb'] == 'animal':
-                if data == 'dog':
-                    state['data'][step['key']] = 'Собака'
-                    state['step'] += 1
-                elif data == 'cat':
-                    state['data'][step['key']] = 'Кошка'
-                    state['step'] += 1
-                elif data == 'other_animal':
-                    state['waiting_for'] = 'other_animal'
-                    send_message(chat_id, f"{EMOJI['paw']} Укажите вид животного\n\nНапример: кролик, хомяк, попугай...")
-                    return 'ok'
-            elif step['kb'] == 'sex':
-                if data in ['male', 'female']:
-                    state['data'][step['key']] = 'М' if data == 'male' else 'Ж'
-                    state['step'] += 1
-            elif step['kb'] == 'vaccine':
-                if data == 'vaccine_rabies':
-                    state['data'][step['key']] = 'Бешенство'
-                    state['step'] += 1
-                elif data == 'vaccine_complex':
-                    state['data'][step['key']] = 'Комплексная'
-                    state['step'] += 1
-                elif data == 'vaccine_other':
-                    state['waiting_for'] = 'other_vaccine'
-                    send_message(chat_id, f"{EMOJI['syringe']} Укажите тип прививки")
-                    return 'ok'
-            elif step['kb'] == 'channel':
-                if data in ['sms', 'telegram']:
-                    channel_map = {'sms': 'SMS', 'telegram': 'Telegram'}
-                    state['data'][step['key']] = channel_map[data]
-                    state['step'] += 1
-            
-            if state['step'] >= len(STEPS):
-                return finish_record(chat_id, state)
-            else:
-                next_step = STEPS[state['step']]
-                kb = get_step_keyboard(next_step['kb'])
-                send_message(chat_id, next_step['ask'], kb)
-    
+    print(f"Search results: {len(results)} found", flush=True)
+    last_queries[chat_id] = (text, False)
+    send_message(chat_id, format_search_results(results) + data_age_note(), search_results_keyboard(results))
     return 'ok'
 
-def handle_input(chat_id, text, user):
-    """Обработка текстового ввода с валидацией"""
-    state = user_states[chat_id]
-    validator = DataValidator()
+def on_archive_search(chat_id, user, payload):
+    """Кнопка «Искать в архиве»: тот же запрос по листам «Архив_ГГГГ»"""
+    query, _ = last_queries.get(chat_id, (None, False))
+    if query is None:
+        send_message(chat_id, f"{EMOJI['warning']} Сначала выполните поиск", main_inline_keyboard())
+        return 'ok'
+    try:
+        results = search_all_sheets(query, archive=True)
+    except SheetsUnavailable as e:
+        print(f"Archive search unavailable: {e}", flush=True)
+        send_message(chat_id, SHEETS_UNAVAILABLE_TEXT, main_inline_keyboard())
+        return 'ok'
+    last_queries[chat_id] = (query, True)
+    send_message(chat_id, f"{EMOJI['archive']} Архив\n\n" + format_search_results(results),
+                 search_results_keyboard(results))
+    return 'ok'
+
+def on_my_records(chat_id, user, payload):
+    try:
+        records = get_my_records(user)
+    except SheetsUnavailable as e:
+        print(f"My records unavailable: {e}", flush=True)
+        send_message(chat_id, SHEETS_UNAVAILABLE_TEXT, main_inline_keyboard())
+        return 'ok'
+    summary = format_records_summary(records)
+    details = get_records_details(records)
     
-    # Обработка специальных ожиданий (другой вид/прививка)
-    if state.get('waiting_for') == 'other_animal':
-        animal_type = validator.clean_text(text)
-        if len(animal_type) < 2:
-            send_message(chat_id, f"{EMOJI['warning']} Слишком коротко. Введите вид животного полностью.")
-            return 'ok'
-        state['data']['animal_type'] = animal_type.capitalize()
-        state.pop('waiting_for')
-        state['step'] += 1
-        
-        if state['step'] >= len(STEPS):
-            return finish_record(chat_id, state)
-        else:
-            next_step = STEPS[state['step']]
-            kb = get_step_keyboard(next_step['kb'])
-            send_message(chat_id, next_step['ask'], kb)
+    text = f"{EMOJI['list']} Мои записи\n\n{summary}\n\n{details}{data_age_note()}"
+    send_message(chat_id, text, my_records_inline_keyboard())
+    return 'ok'
+
+def on_contacts(chat_id, user, payload):
+    send_message(chat_id, tenant().contacts)
+    return 'ok'
+
+# ---------- Опрос «Новая запись» ----------
+# Состояние: step — номер шага (len(STEPS) — экран подтверждения), data — ответы,
+# waiting_for — клавиатура, для которой ждём свой вариант вместо «Другое»,
+# editing — шаг открыт с экрана подтверждения и после ответа вернёмся туда.
+def wizard_state(chat_id):
+    state = user_states.get(chat_id)
+    return state if state and 'step' in state else None
+
+def ask_step(chat_id, state):
+    """Задать вопрос текущего шага или показать подтверждение после последнего"""
+    if state['step'] >= len(STEPS):
+        send_message(chat_id, format_confirmation(state['data']), confirm_inline_keyboard())
+        return 'ok'
+    step = STEPS[state['step']]
+    if state.get('waiting_for'):
+        text = OTHER_PROMPTS[state['waiting_for']][0]
+    else:
+        text = step['ask']
+        if state.get('editing'):
+            text += f"\n\nСейчас: {state['data'].get(step['key']) or '—'}"
+    send_message(chat_id, text, step_keyboard(state))
+    return 'ok'
+
+def advance(chat_id, state, value):
+    """Записать ответ шага и перейти к следующему; после исправления — к подтверждению"""
+    state['data'][STEPS[state['step']]['key']] = value
+    state.pop('waiting_for', None)
+    state['step'] = len(STEPS) if state.pop('editing', False) else state['step'] + 1
+    return ask_step(chat_id, state)
+
+def on_new_record(chat_id, user, payload):
+    user_states[chat_id] = {
+        'step': 0,
+        'data': {
+            'date_visit': datetime.now().strftime('%Y-%m-%d'),
+            'staff_tg': user
+        }
+    }
+    return ask_step(chat_id, user_states[chat_id])
+
+def on_choice(chat_id, user, payload):
+    """Кнопка выбора на шаге опроса; кнопки чужого шага игнорируются"""
+    state = wizard_state(chat_id)
+    if not state or state['step'] >= len(STEPS):
+        return 'ok'
+    kb, value = CHOICE_ROUTES[payload]
+    if STEPS[state['step']]['kb'] != kb:
+        return 'ok'
+    if value is OTHER:
+        state['waiting_for'] = kb
+        return ask_step(chat_id, state)
+    return advance(chat_id, state, value)
+
+def on_back(chat_id, user, payload):
+    """«◀ Назад»: из «Другое» — к кнопкам, из исправления — к подтверждению, иначе на шаг назад"""
+    state = wizard_state(chat_id)
+    if not state:
         return 'ok'
+    if state.pop('waiting_for', None):
+        pass
+    elif state.pop('editing', False):
+        state['step'] = len(STEPS)
+    elif state['step'] > 0:
+        state['step'] -= 1
+    return ask_step(chat_id, state)
+
+def on_confirm(chat_id, user, payload):
+    state = wizard_state(chat_id)
+    if not state or state['step'] < len(STEPS):
+        return 'ok'
+    return finish_record(chat_id, state)
+
+def on_edit_step(chat_id, user, payload):
+    """«Исправить поле N» с экрана подтверждения"""
+    state = wizard_state(chat_id)
+    if not state or state['step'] < len(STEPS):
+        return 'ok'
+    state['step'] = int(payload.split(':', 1)[1]) % len(STEPS)
+    state['editing'] = True
+    return ask_step(chat_id, state)
+
+def handle_input(chat_id, user, text):
+    """Текстовый ответ на шаге опроса с валидацией"""
+    state = user_states[chat_id]
+    if state['step'] >= len(STEPS):
+        return ask_step(chat_id, state)
     
-    if state.get('waiting_for') == 'other_vaccine':
-        vaccine_type = validator.clean_text(text)
-        if len(vaccine_type) < 2:
-            send_message(chat_id, f"{EMOJI['warning']} Слишком коротко. Введите тип прививки полностью.")
+    # Свой вариант вместо кнопки «Другое»
+    if state.get('waiting_for'):
+        value = DataValidator.clean_text(text)
+        if len(value) < 2:
+            send_message(chat_id, f"{EMOJI['warning']} {OTHER_PROMPTS[state['waiting_for']][1]}")
             return 'ok'
-        state['data']['vaccine_type'] = vaccine_type.capitalize()
-        state.pop('waiting_for')
-        state['step'] += 1
-        
-        if state['step'] >= len(STEPS):
-            return finish_record(chat_id, state)
-        else:
-            next_step = STEPS[state['step']]
-            kb = get_step_keyboard(next_step['kb'])
-            send_message(chat_id, next_step['ask'], kb)
-        return 'ok'
-    
-    step_idx = state['step']
-    if step_idx >= len(STEPS):
-        user_states.pop(chat_id, None)
-        return 'ok'
-    
-    step = STEPS[step_idx]
-    validate_type = step.get('validate')
-    
-    # Валидация данных
-    value = None
-    error = None
-    
-    if validate_type == 'fio':
-        value, error = validator.validate_fio(text)
-    elif validate_type == 'phone':
-        value, error = validator.validate_phone(text)
-    elif validate_type == 'telegram':
-        value, error = validator.validate_telegram(text)
-    elif validate_type == 'address':
-        value, error = validator.validate_address(text)
-    elif validate_type == 'nickname':
-        value, error = validator.validate_nickname(text)
-    elif validate_type == 'age':
-        value, error = validator.validate_age(text)
-    elif validate_type == 'vaccine_date':
-        value, error = validator.validate_vaccine_date(text)
-    elif validate_type == 'term_months':
-        value, error = validator.validate_term_months(text)
-    else:
-        value = validator.clean_text(text)
+        return advance(chat_id, state, value.capitalize())
     
-    # Если есть ошибка валидации
+    value, error = VALIDATORS[STEPS[state['step']]['validate']](text)
     if error:
         send_message(chat_id, f"{EMOJI['warning']} {error}\n\nПопробуйте ещё раз:")
         return 'ok'
+    return advance(chat_id, state, value)
+
+# ---------- Изменение записей, выгрузки и карточка владельца ----------
+RECORD_CHANGED_TEXT = f"{EMOJI['warning']} Запись в таблице изменилась или не найдена\n\nПовторите поиск и попробуйте ещё раз."
+STATUS_USAGE_TEXT = (f"{EMOJI['edit']} Смена статуса\n\n/status <строки> <статус>\n"
+                     f"Например: /status 12,15,20-25 обработан\n\nСтатусы: {', '.join(STATUSES)}\n"
+                     f"Не больше {MAX_CHANGE_ROWS} строк за раз")
+EDIT_USAGE_TEXT = (f"{EMOJI['edit']} Правка поля\n\n/edit <строка> <поле> <значение>\n"
+                   f"Например: /edit 15 Телефон 89001234567\n\nПоля: {', '.join(EDITABLE_FIELDS)}")
+
+def run_record_change(chat_id, change, success_text):
+    """Выполнить изменение записей и ответить пользователю"""
+    try:
+        result = change()
+    except SheetsUnavailable as e:
+        print(f"Record change unavailable: {e}", flush=True)
+        send_message(chat_id, SHEETS_UNAVAILABLE_TEXT, main_inline_keyboard())
+        return 'ok'
+    except RecordChanged as e:
+        print(f"Record change rejected: {e}", flush=True)
+        send_message(chat_id, RECORD_CHANGED_TEXT, main_inline_keyboard())
+        return 'ok'
+    if result == 'queued':
+        success_text += f"\n\n{EMOJI['clock']} Google Таблицы сейчас недоступны — изменение сохранено и будет внесено в таблицу автоматически."
+    send_message(chat_id, success_text, main_inline_keyboard())
+    return 'ok'
+
+def handle_record_callback(chat_id, user, payload):
+    """Кнопки записи: rec — меню записи, st — смена статуса, ef — список полей, fld — правка поля"""
+    action, row, key, *rest = payload.split(':')
+    row = int(row)
     
-    # Сохраняем валидированное значение
-    state['data'][step['key']] = value
-    state['step'] += 1
+    if action == 'st':
+        status = STATUSES[int(rest[0])]
+        return run_record_change(chat_id, lambda: set_status([(row, key)], status),
+                                 f"{EMOJI['ok']} Статус изменён: {status} (стр. {row})")
     
-    if state['step'] >= len(STEPS):
-        return finish_record(chat_id, state)
-    else:
-        next_step = STEPS[state['step']]
-        kb = get_step_keyboard(next_step['kb'])
-        send_message(chat_id, next_step['ask'], kb)
+    entry = get_cached_entry(EDITABLE_SHEET)
+    if not entry:
+        send_message(chat_id, SHEETS_UNAVAILABLE_TEXT, main_inline_keyboard())
+        return 'ok'
+    idx = locate_record(entry['records'], row, key)
+    if idx is None:
+        send_message(chat_id, RECORD_CHANGED_TEXT, main_inline_keyboard())
+        return 'ok'
+    record = entry['records'][idx]
     
+    if action == 'rec':
+        status = record.get('Статус_обработки', '') or 'Новый'
+        text = (f"{EMOJI['user']} {record.get('ФИО', '')}\n{EMOJI['paw']} {record.get('Кличка', '')}, "
+                f"{record.get('Тип_прививки', '')} ({record.get('Дата_прививки', '')})\n"
+                f"Статус: {status} · стр. {sheet_row(idx)}")
+        send_message(chat_id, text, record_inline_keyboard(sheet_row(idx), key, status))
+    elif action == 'ef':
+        send_message(chat_id, f"{EMOJI['edit']} Какое поле изменить?",
+                     fields_inline_keyboard(sheet_row(idx), key, entry['columns']))
+    elif action == 'fld':
+        col = int(rest[0])
+        field = entry['headers'][col] if 0 <= col < len(entry['headers']) else None
+        if field not in EDITABLE_FIELDS:
+            send_message(chat_id, f"{EMOJI['warning']} Это поле нельзя изменить из бота", main_inline_keyboard())
+            return 'ok'
+        user_states[chat_id] = {'mode': 'edit', 'row': sheet_row(idx), 'key': key, 'field': field}
+        send_message(chat_id, f"{EMOJI['edit']} {field}\n\nСейчас: {record.get(field, '')}\n\nВведите новое значение:")
+    return 'ok'
+
+def handle_edit_input(chat_id, user, text):
+    """Новое значение поля после кнопки «Изменить поле»"""
+    state = user_states[chat_id]
+    field = state['field']
+    value, error = validate_field(field, text)
+    if error:
+        send_message(chat_id, f"{EMOJI['warning']} {error}\n\nПопробуйте ещё раз:")
+        return 'ok'
+    user_states.pop(chat_id, None)
+    return run_record_change(chat_id, lambda: update_records([(state['row'], state['key'], {field: value})]),
+                             f"{EMOJI['ok']} {field}: {value} (стр. {state['row']})")
+
+def handle_status_command(chat_id, user, args):
+    """/status 12,15,20-25 обработан — смена статуса нескольких строк одним запросом"""
+    parts = args.rsplit(maxsplit=1)
+    rows = parse_row_numbers(parts[0], last_cached_row()) if len(parts) == 2 else None
+    status = match_status(parts[1]) if len(parts) == 2 else None
+    if not rows or not status:
+        send_message(chat_id, STATUS_USAGE_TEXT)
+        return 'ok'
+    return run_record_change(chat_id, lambda: set_status(keys_for_rows(rows), status),
+                             f"{EMOJI['ok']} Статус «{status}»: {len(rows)} записей")
+
+def handle_edit_command(chat_id, user, args):
+    """/edit 15 Телефон 89001234567 — правка одного поля"""
+    parts = args.split(maxsplit=2)
+    rows = parse_row_numbers(parts[0], last_cached_row()) if len(parts) == 3 else None
+    field = next((name for name in EDITABLE_FIELDS if len(parts) == 3 and name.lower() == parts[1].lower()), None)
+    if not rows or len(rows) != 1 or not field:
+        send_message(chat_id, EDIT_USAGE_TEXT)
+        return 'ok'
+    value, error = validate_field(field, parts[2])
+    if error:
+        send_message(chat_id, f"{EMOJI['warning']} {error}")
+        return 'ok'
+    row = rows[0]
+    return run_record_change(chat_id, lambda: update_records([target + ({field: value},) for target in keys_for_rows(rows)]),
+                             f"{EMOJI['ok']} {field}: {value} (стр. {row})")
+
+EXPORT_USAGE_TEXT = (f"{EMOJI['list']} Выгрузка своих записей\n\n/export <с> <по> [xlsx]\n"
+                     f"Например: /export 01.01.2025 31.01.2025 xlsx")
+
+def handle_search_export(chat_id, user, payload):
+    """Выгрузить все результаты последнего поиска (exp_search:csv | exp_search:xlsx)"""
+    fmt = payload.split(':', 1)[1]
+    query, archive = last_queries.get(chat_id, (None, False))
+    if query is None:
+        send_message(chat_id, f"{EMOJI['warning']} Сначала выполните поиск", main_inline_keyboard())
+        return 'ok'
+    try:
+        parts = search_export_parts(query, archive)
+    except SheetsUnavailable as e:
+        print(f"Export unavailable: {e}", flush=True)
+        send_message(chat_id, SHEETS_UNAVAILABLE_TEXT, main_inline_keyboard())
+        return 'ok'
+    return start_export(chat_id, parts, fmt, f"poisk_{datetime.now():%Y%m%d_%H%M}",
+                        f"{EMOJI['search']} Поиск: {query}")
+
+def handle_my_export(chat_id, user, date_from, date_to, fmt):
+    """Выгрузить свои записи за период"""
+    try:
+        parts = my_records_export_parts(user, date_from, date_to)
+    except SheetsUnavailable as e:
+        print(f"Export unavailable: {e}", flush=True)
+        send_message(chat_id, SHEETS_UNAVAILABLE_TEXT, main_inline_keyboard())
+        return 'ok'
+    return start_export(chat_id, parts, fmt, f"zapisi_{date_from:%Y%m%d}-{date_to:%Y%m%d}",
+                        f"{EMOJI['list']} Мои записи {date_from:%d.%m.%Y} — {date_to:%d.%m.%Y}")
+
+def handle_my_export_button(chat_id, user, payload):
+    """Выгрузка своих записей за последние N дней (exp_my:N)"""
+    date_to = datetime.now().date()
+    date_from = date_to - timedelta(days=int(payload.split(':', 1)[1]) - 1)
+    return handle_my_export(chat_id, user, date_from, date_to, 'csv')
+
+def handle_export_command(chat_id, user, args):
+    """/export 01.01.2025 31.01.2025 [xlsx]"""
+    parts = args.split()
+    fmt = 'xlsx' if parts and parts[-1].lower() == 'xlsx' else 'csv'
+    if parts and parts[-1].lower() in ('csv', 'xlsx'):
+        parts = parts[:-1]
+    dates = [parse_date(part) for part in parts]
+    if len(dates) != 2 or None in dates or dates[0] > dates[1]:
+        send_message(chat_id, EXPORT_USAGE_TEXT)
+        return 'ok'
+    return handle_my_export(chat_id, user, dates[0], dates[1], fmt)
+
+def send_owner_card(chat_id, owner, archive=False):
+    """Отправить карточку владельца по его ключу. Архив читаем по кнопке
+    «История из архива» или если в «Ввод_бот» записей владельца нет"""
+    try:
+        records = owner_records(owner) if owner else []
+        from_archive = bool(owner) and (archive or not records)
+        if from_archive:
+            records = archive_owner_records(owner) + records
+    except SheetsUnavailable as e:
+        print(f"Owner card unavailable: {e}", flush=True)
+        send_message(chat_id, SHEETS_UNAVAILABLE_TEXT, main_inline_keyboard())
+        return 'ok'
+    if not records:
+        send_message(chat_id, f"{EMOJI['warning']} Владелец не найден", main_inline_keyboard())
+        return 'ok'
+    keyboard = main_inline_keyboard()
+    if not from_archive and archive_sheet_names():
+        keyboard = owner_card_keyboard(sheet_row(records[0].row_index), records[0].key)
+    send_message(chat_id, format_owner_card(records) + data_age_note(), keyboard)
     return 'ok'
 
+def on_owner_card(chat_id, user, payload):
+    """Кнопки «Владелец» у результата поиска и «История из архива» (owner[_arch]:строка:ключ)"""
+    action, row, key = payload.split(':')
+    entry = get_cached_entry(EDITABLE_SHEET)
+    if not entry:
+        send_message(chat_id, SHEETS_UNAVAILABLE_TEXT, main_inline_keyboard())
+        return 'ok'
+    idx = locate_record(entry['records'], int(row), key)
+    if idx is None:
+        send_message(chat_id, RECORD_CHANGED_TEXT, main_inline_keyboard())
+        return 'ok'
+    return send_owner_card(chat_id, entry['records'].owner(idx), archive=action == 'owner_arch')
+
+def handle_card_command(chat_id, user, args):
+    """/card 89001234567 или /card Иванов Иван Иванович"""
+    if not args.strip():
+        send_message(chat_id, CARD_USAGE_TEXT)
+        return 'ok'
+    phone, error = DataValidator.validate_phone(args)
+    if not error:
+        return send_owner_card(chat_id, phone)
+    try:
+        owners = owners_by_fio(args)
+    except SheetsUnavailable as e:
+        print(f"Owner card unavailable: {e}", flush=True)
+        send_message(chat_id, SHEETS_UNAVAILABLE_TEXT, main_inline_keyboard())
+        return 'ok'
+    if len(owners) > 1:
+        owner_choices[chat_id] = owners
+        send_message(chat_id, f"{EMOJI['user']} Владельцев с таким ФИО: {len(owners)}. Выберите по телефону:",
+                     owner_choice_keyboard(owners))
+        return 'ok'
+    return send_owner_card(chat_id, owners[0] if owners else None)
+
+def on_owner_choice(chat_id, user, payload):
+    """Выбор одного из тёзок после /card по ФИО (card:N)"""
+    owners = owner_choices.get(chat_id, [])
+    n = int(payload.split(':', 1)[1])
+    return send_owner_card(chat_id, owners[n] if n < len(owners) else None)
+
 def format_fio_short(fio):
     """Преобразует ФИО в формат: Фамилия И.О. (с инициалами)"""
     if not fio or fio == 'Не указано':
@@ -932,7 +3371,8 @@ def format_fio_short(fio):
 
 def finish_record(chat_id, state):
     """Завершение записи"""
-    if save_to_sheet(state['data']):
+    saved = save_to_sheet(state['data'])
+    if saved:
         # Получаем данные для форматирования
         fio_raw = state['data'].get('fio', 'Не указано')
         fio = format_fio_short(fio_raw)
@@ -953,6 +3393,8 @@ def finish_record(chat_id, state):
 Срок: {term_months} мес.
 
 {EMOJI['bell']} Напоминание придёт за 3 дня до окончания срока."""
+        if saved == 'queued':
+            success_text += f"\n\n{EMOJI['clock']} Google Таблицы сейчас недоступны — запись сохранена и будет отправлена в таблицу автоматически."
         
         send_message(chat_id, success_text, main_inline_keyboard())
     else:
@@ -961,12 +3403,817 @@ def finish_record(chat_id, state):
     return 'ok'
 
 def answer_callback(callback_id):
-    url = f'https://api.telegram.org/bot{TOKEN}/answerCallbackQuery'
     try:
-        requests.post(url, json={'callback_query_id': callback_id}, timeout=5)
+        telegram_request('answerCallbackQuery', {'callback_query_id': callback_id}, timeout=5)
     except Exception as e:
         print(f"Error answering callback: {e}", flush=True)
 
+# ---------- Маршруты ----------
+# Один поиск в словаре на апдейт, сколько бы ни было шагов и сценариев.
+# Обработчики вызываются как handler(chat_id, user, payload)
+CALLBACK_ROUTES = {
+    'new_record': on_new_record,
+    'search': on_search,
+    'my_records': on_my_records,
+    'contacts': on_contacts,
+    'cancel': on_cancel,
+    'back': on_back,
+    'confirm': on_confirm,
+    'edit_step': on_edit_step,
+    'rec': handle_record_callback,
+    'st': handle_record_callback,
+    'ef': handle_record_callback,
+    'fld': handle_record_callback,
+    'exp_search': handle_search_export,
+    'exp_my': handle_my_export_button,
+    'owner': on_owner_card,
+    'owner_arch': on_owner_card,
+    'card': on_owner_choice,
+    'arch_search': on_archive_search,
+    **{data: on_choice for data in CHOICE_ROUTES},
+}
+
+COMMAND_ROUTES = {
+    '/start': on_start,
+    '/cancel': on_cancel,
+    '/status': handle_status_command,
+    '/edit': handle_edit_command,
+    '/export': handle_export_command,
+    '/card': handle_card_command,
+}
+
+# Текст вне команд — по режиму состояния чата
+TEXT_ROUTES = {
+    'wizard': handle_input,
+    'search': on_search_query,
+    'edit': handle_edit_input,
+}
+
+# ============ SMS-НАПОМИНАНИЯ ============
+# Провайдер подключается через SMS_PROVIDER; сообщения уходят пачками —
+# один HTTP-запрос на пачку, а не на номер. Задание напоминаний запускается
+# извне (cron) через /admin/sms-reminders и отмечает записи «Напомнено»
+# одним batch_update (см. set_status).
+SMS_PROVIDER = os.environ.get('SMS_PROVIDER', 'stub')  # stub | smsru
+SMS_API_ID = os.environ.get('SMS_API_ID', '')
+SMS_SENDER = os.environ.get('SMS_SENDER', '')
+SMS_RATE_PER_MIN = int(os.environ.get('SMS_RATE_PER_MIN', 30))  # запросов к провайдеру в минуту
+SMS_TEMPLATE = os.environ.get(
+    'SMS_TEMPLATE',
+    'Напоминание: {date} заканчивается срок прививки «{vaccine}» у питомца {pet}. Ждём вас в клинике!'
+)
+REMIND_DAYS_BEFORE = int(os.environ.get('REMIND_DAYS_BEFORE', 3))
+REMIND_OVERDUE_DAYS = int(os.environ.get('REMIND_OVERDUE_DAYS', 14))  # напоминать и о недавно истёкших
+SMS_LOG_DAYS = 400  # сколько хранить журнал отправок
+ADMIN_SECRET = os.environ.get('ADMIN_SECRET', '')
+# Столбец согласия на уведомления: по заголовку из SMS_CONSENT_COLUMN, иначе по позиции —
+# save_to_sheet пишет ответ шага «Согласие» в столбец G. Без согласия «Да» SMS не отправляется
+SMS_CONSENT_COLUMN = os.environ.get('SMS_CONSENT_COLUMN', '')
+CONSENT_COLUMN_INDEX = 6
+CONSENT_YES = {'да', 'yes', 'true', '1', '+'}
+
+def add_months(date, months):
+    """Дата + срок в месяцах; дробная часть месяца считается по 30 дней"""
+    months = float(str(months).replace(',', '.'))
+    whole = int(months)
+    year, month = divmod(date.month - 1 + whole, 12)
+    year, month = date.year + year, month + 1
+    day = min(date.day, calendar.monthrange(year, month)[1])
+    return date.replace(year=year, month=month, day=day) + timedelta(days=round((months - whole) * 30))
+
+def due_date(record):
+    """Дата окончания действия прививки: Дата_прививки + Срок_мес, или None"""
+    vaccinated = parse_date(record.get('Дата_прививки', ''))
+    if vaccinated is None:
+        return None
+    try:
+        return add_months(vaccinated, record.get('Срок_мес', ''))
+    except (ValueError, OverflowError):
+        return None
+
+def sms_phone(value):
+    """Телефон из таблицы в виде +7XXXXXXXXXX (как после validate_phone) или None"""
+    phone, error = DataValidator.validate_phone(str(value))
+    return None if error else phone
+
+class SmsProvider:
+    """Провайдер SMS: отправка пачками (один запрос на пачку) и опрос статусов доставки.
+    Статусы сообщений: sent — принято провайдером, delivered, failed, deferred — не хватило лимита"""
+    name = 'base'
+    batch_size = 100
+    
+    def __init__(self, rate_per_min=SMS_RATE_PER_MIN):
+        self.budget = RateBudget(rate_per_min)
+    
+    def send_batch(self, messages):
+        """[{'phone', 'text'}] -> [{'id', 'status', 'error'}] в том же порядке"""
+        raise NotImplementedError
+    
+    def fetch_statuses(self, ids):
+        """Статусы пачки сообщений: {id: 'sent' | 'delivered' | 'failed'}"""
+        raise NotImplementedError
+    
+    def send(self, messages):
+        """Отправить все сообщения пачками в пределах лимита провайдера"""
+        results = []
+        for start in range(0, len(messages), self.batch_size):
+            batch = messages[start:start + self.batch_size]
+            if not self.budget.acquire(max_wait=self.budget.window):
+                results += [{'id': None, 'status': 'deferred', 'error': 'rate limit'} for _ in batch]
+                continue
+            try:
+                results += self.send_batch(batch)
+            except Exception as e:
+                print(f"SMS batch failed ({self.name}): {e}", flush=True)
+                results += [{'id': None, 'status': 'failed', 'error': str(e)} for _ in batch]
+        return results
+    
+    def poll(self, ids):
+        """Опросить статусы пачками; при исчерпании лимита — остаток в следующий раз"""
+        statuses = {}
+        for start in range(0, len(ids), self.batch_size):
+            if not self.budget.acquire():
+                break
+            try:
+                statuses.update(self.fetch_statuses(ids[start:start + self.batch_size]))
+            except Exception as e:
+                print(f"SMS status poll failed ({self.name}): {e}", flush=True)
+                break
+        return statuses
+
+class StubSmsProvider(SmsProvider):
+    """Локальный провайдер для проверки: ничего не отправляет, пишет сообщения в лог"""
+    name = 'stub'
+    
+    def __init__(self, rate_per_min=SMS_RATE_PER_MIN):
+        super().__init__(rate_per_min)
+        self.sent = []
+        self.counter = itertools.count(1)
+    
+    def send_batch(self, messages):
+        results = []
+        for message in messages:
+            sms_id = f"stub-{next(self.counter)}"
+            self.sent.append({**message, 'id': sms_id})
+            print(f"SMS (stub) to {message['phone']}: {message['text']}", flush=True)
+            results.append({'id': sms_id, 'status': 'sent', 'error': None})
+        return results
+    
+    def fetch_statuses(self, ids):
+        return {sms_id: 'delivered' for sms_id in ids}
+
+class SmsRuProvider(SmsProvider):
+    """sms.ru: до 100 сообщений с разным текстом одним запросом (multi[номер]=текст)"""
+    name = 'smsru'
+    api_url = 'https://sms.ru'
+    
+    def __init__(self, rate_per_min=SMS_RATE_PER_MIN):
+        super().__init__(rate_per_min)
+        if not SMS_API_ID:
+            raise RuntimeError('SMS_API_ID is not set')
+        self.session = requests.Session()
+    
+    def send_batch(self, messages):
+        data = {'api_id': SMS_API_ID, 'json': 1}
+        if SMS_SENDER:
+            data['from'] = SMS_SENDER
+        for message in messages:
+            data[f"multi[{message['phone'].lstrip('+')}]"] = message['text']
+        response = self.session.post(f'{self.api_url}/sms/send', data=data, timeout=30).json()
+        if response.get('status') != 'OK':
+            raise RuntimeError(response.get('status_text', 'sms.ru error'))
+        
+        sms = response.get('sms', {})
+        results = []
+        for message in messages:
+            item = sms.get(message['phone'].lstrip('+'), {})
+            if item.get('status') == 'OK':
+                results.append({'id': str(item['sms_id']), 'status': 'sent', 'error': None})
+            else:
+                results.append({'id': None, 'status': 'failed', 'error': item.get('status_text', 'no response')})
+        return results
+    
+    def fetch_statuses(self, ids):
+        response = self.session.post(f'{self.api_url}/sms/status', timeout=30,
+                                     data={'api_id': SMS_API_ID, 'sms_id': ','.join(ids), 'json': 1}).json()
+        statuses = {}
+        for sms_id, item in response.get('sms', {}).items():
+            code = int(item.get('status_code', 0))
+            # 100–102 — в очереди/отправляется, 103 — доставлено, остальное — ошибка
+            statuses[sms_id] = 'delivered' if code == 103 else 'sent' if code in (100, 101, 102) else 'failed'
+        return statuses
+
+SMS_PROVIDERS = {
+    'stub': StubSmsProvider,
+    'smsru': SmsRuProvider,
+}
+
+_sms_provider = None
+sms_job_lock = threading.Lock()
+sms_job = {'running': False, 'last': None}
+
+def get_sms_provider():
+    """Провайдер из SMS_PROVIDER (один на процесс: общий лимит для всех клиник)"""
+    global _sms_provider
+    if _sms_provider is None:
+        _sms_provider = SMS_PROVIDERS[SMS_PROVIDER]()
+    return _sms_provider
+
+def consent_column(headers):
+    """Заголовок столбца согласия или None, если такого столбца в листе нет"""
+    if SMS_CONSENT_COLUMN:
+        return SMS_CONSENT_COLUMN if SMS_CONSENT_COLUMN in headers else None
+    if len(headers) > CONSENT_COLUMN_INDEX and headers[CONSENT_COLUMN_INDEX]:
+        return headers[CONSENT_COLUMN_INDEX]
+    return None
+
+def reminder_candidates(today):
+    """Записи с каналом SMS и согласием, у которых срок прививки скоро истекает
+    и напоминание ещё не отправлялось. Возвращает {телефон: [(запись, дата окончания)]}"""
+    entry = get_cached_entry(EDITABLE_SHEET)
+    if not entry:
+        raise SheetsUnavailable(f'no data for {EDITABLE_SHEET}')
+    sms_log = tenant().sms_log
+    consent = consent_column(entry['headers'])
+    if consent is None:
+        print(f"SMS reminders skipped: no consent column in {EDITABLE_SHEET}", flush=True)
+        return {}
+    
+    by_phone = {}
+    for record in entry['records']:
+        if str(record.get('Канал', '')).lower() != 'sms':
+            continue
+        if str(record.get(consent, '')).strip().lower() not in CONSENT_YES:
+            continue
+        if record.get('Статус_обработки', '') == 'Напомнено':
+            continue
+        due = due_date(record)
+        if due is None or not -REMIND_OVERDUE_DAYS <= (due - today).days <= REMIND_DAYS_BEFORE:
+            continue
+        phone = sms_phone(record.get('Телефон', ''))
+        if phone and record.key not in sms_log:
+            by_phone.setdefault(phone, []).append((record, due))
+    return by_phone
+
+def reminder_text(items):
+    """Одно SMS на владельца, даже если питомцев или прививок несколько"""
+    pets = ', '.join(dict.fromkeys(str(record.get('Кличка', '')) for record, _ in items))
+    vaccines = ', '.join(dict.fromkeys(str(record.get('Тип_прививки', '')) for record, _ in items))
+    due = min(due for _, due in items)
+    return SMS_TEMPLATE.format(pet=pets, vaccine=vaccines, date=due.strftime('%d.%m.%Y'))
+
+def run_sms_reminders():
+    """Напоминания текущей клиники: опрос статусов отправленных ранее,
+    отправка новых пачками и отметка «Напомнено» одним запросом к таблице"""
+    t = tenant()
+    ensure_snapshot_loaded()
+    provider = get_sms_provider()
+    now = time.time()
+    
+    with cache_lock:
+        for key in [key for key, item in t.sms_log.items() if now - item['sent_at'] > SMS_LOG_DAYS * 86400]:
+            del t.sms_log[key]
+        waiting = list(dict.fromkeys(item['id'] for item in t.sms_log.values()
+                                     if item['status'] == 'sent' and item['provider'] == provider.name))
+    statuses = provider.poll(waiting)
+    with cache_lock:
+        for item in t.sms_log.values():
+            if item['id'] in statuses:
+                item['status'] = statuses[item['id']]
+    
+    groups = reminder_candidates(datetime.now().date())
+    phones = list(groups)
+    results = provider.send([{'phone': phone, 'text': reminder_text(groups[phone])} for phone in phones])
+    
+    reminded = []
+    with cache_lock:
+        for phone, result in zip(phones, results):
+            if result['status'] != 'sent':
+                continue
+            for record, _ in groups[phone]:
+                t.sms_log[record.key] = {'phone': phone, 'provider': provider.name, 'id': result['id'],
+                                         'status': 'sent', 'sent_at': now}
+                reminded.append((sheet_row(record.row_index), record.key))
+    
+    report = {'tenant': t.id, 'provider': provider.name, 'polled': len(statuses),
+              **collections.Counter(result['status'] for result in results),
+              'records_reminded': len(reminded)}
+    if reminded:
+        try:
+            set_status(reminded, 'Напомнено')
+        except (SheetsUnavailable, RecordChanged) as e:
+            # Повторной отправки не будет: записи уже в журнале отправок
+            print(f"Reminder status update failed: {e}", flush=True)
+            report['status_error'] = str(e)
+    save_snapshot()
+    print(f"SMS reminders: {report}", flush=True)
+    return report
+
+def run_admin_job(lock, job, func):
+    """Фоновое задание по всем клиникам; параллельно второе такое же не запускается"""
+    if not lock.acquire(blocking=False):
+        return
+    job['running'] = True
+    try:
+        reports = []
+        for t in list(tenants.values()):
+            try:
+                reports.append(run_for_tenant(t, func))
+            except Exception as e:
+                print(f"{func.__name__} failed for {t.id}: {e}", flush=True)
+                reports.append({'tenant': t.id, 'error': str(e)})
+        job['last'] = {'finished_at': datetime.now().isoformat(timespec='seconds'), 'reports': reports}
+    finally:
+        job['running'] = False
+        lock.release()
+
+def admin_job_response(job, runner, method, secret):
+    """Админский маршрут: POST — запустить задание в фоне, GET — итог последнего запуска.
+    Без ADMIN_SECRET или с неверным секретом маршрута как будто нет"""
+    if not ADMIN_SECRET or secret != ADMIN_SECRET:
+        return 404, 'not found', 'text/plain; charset=utf-8'
+    if method == 'POST':
+        started = not job['running']
+        if started:
+            start_thread(runner)
+        return 202, json.dumps({'started': started}), 'application/json'
+    return 200, json.dumps(job, ensure_ascii=False), 'application/json'
+
+def run_sms_reminders_all():
+    """Задание напоминаний по всем клиникам; параллельно второе не запускается"""
+    run_admin_job(sms_job_lock, sms_job, run_sms_reminders)
+
+def reminders_response(method, secret):
+    return admin_job_response(sms_job, run_sms_reminders_all, method, secret)
+
+@app.route('/admin/sms-reminders', methods=['GET', 'POST'])
+def admin_sms_reminders():
+    secret = request.headers.get('X-Admin-Secret') or request.args.get('secret', '')
+    status, body, content_type = reminders_response(request.method, secret)
+    return app.response_class(body, status=status, mimetype=content_type.split(';')[0])
+
+# ============ АРХИВ ============
+# «Ввод_бот» только растёт, а каждое чтение скачивает его целиком. Записи, у которых
+# срок прививки истёк больше ARCHIVE_AFTER_DAYS дней назад, переносятся пачками
+# в листы «Архив_ГГГГ» (по году прививки). Архивы читаются только по явному запросу
+# истории или когда в оперативных листах ничего не нашлось (см. find_matches).
+#
+# Перенос идёт по журналу в SQLite, поэтому прерванное задание продолжается
+# со следующего запуска, не теряя и не задваивая строк:
+#   planned  — в журнале пачка: ключ и номер строки каждой записи и заранее
+#              выбранные строки листов архива;
+#   written  — строки записаны в архив; повтор записи перезаписывает те же ячейки;
+#   deleting — отправлен запрос на удаление из «Ввод_бот» (ответ мог потеряться);
+#   done     — строки удалены. Записи перед удалением ищутся в свежем листе по
+#              ключу; если запись успели изменить, в архив сначала переписывается
+#              её текущее содержимое, так что в архиве остаётся ровно одна её копия.
+ARCHIVE_PREFIX = 'Архив_'
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))  # дней после окончания срока
+ARCHIVE_BATCH = int(os.environ.get('ARCHIVE_BATCH', 500))  # строк за один перенос
+ARCHIVE_MAX_BATCHES = int(os.environ.get('ARCHIVE_MAX_BATCHES', 20))  # пачек за запуск
+ARCHIVE_BATCH_COLUMN = 'Партия_архива'  # в архиве: из какой пачки строка
+
+archive_job_lock = threading.Lock()
+archive_job = {'running': False, 'last': None}
+
+def is_archive_sheet(name):
+    return name.startswith(ARCHIVE_PREFIX)
+
+def archive_year(name):
+    """Год листа «Архив_ГГГГ» или None"""
+    suffix = name[len(ARCHIVE_PREFIX):]
+    return int(suffix) if is_archive_sheet(name) and suffix.isdigit() else None
+
+def archive_sheet_names():
+    """Листы архива, старые годы первыми"""
+    return sorted(name for name in list_sheet_titles() if is_archive_sheet(name))
+
+def archive_journal_path(t):
+    root, _ = os.path.splitext(t.snapshot_path)
+    return f"{root}.archive.sqlite3"
+
+def open_archive_journal():
+    """Журнал переносов текущей клиники (отдельный файл: снимок перезаписывается целиком)"""
+    conn = sqlite3.connect(archive_journal_path(tenant()))
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS batches "
+                     "(id TEXT PRIMARY KEY, state TEXT, headers TEXT, created_at REAL, finished_at REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS moves (batch TEXT, seq INTEGER, sheet TEXT, target_row INTEGER, "
+                     "row TEXT, copies INTEGER, key TEXT, source_row INTEGER)")
+    return conn
+
+def row_content(row):
+    """Строка целиком для сравнения с журналом"""
+    return json.dumps(row, ensure_ascii=False)
+
+def archive_candidates(store, today):
+    """Записи, которые пора перенести: [(номер записи, лист архива)], не больше ARCHIVE_BATCH"""
+    found = []
+    for record in store:
+        due = due_date(record)
+        if due is None or (today - due).days <= ARCHIVE_AFTER_DAYS:
+            continue
+        vaccinated = parse_date(record.get('Дата_прививки', ''))
+        found.append((record.row_index, f"{ARCHIVE_PREFIX}{vaccinated.year}"))
+        if len(found) == ARCHIVE_BATCH:
+            break
+    return found
+
+def prepare_archive_sheet(name, headers):
+    """Лист архива с заголовками «Ввод_бот» и ARCHIVE_BATCH_COLUMN; создаётся при первом
+    переносе, новые столбцы «Ввод_бот» дописываются в конец. Возвращает (лист, заголовки)"""
+    t = tenant()
+    sheet = get_sheet(name)
+    if sheet is None:
+        sheet = sheets_call(get_spreadsheet().add_worksheet, name, 1000, len(headers) + 1)
+        t.worksheets[name] = sheet
+        t.sheet_titles['loaded_at'] = 0
+        current = []
+    else:
+        response = sheets_call(get_spreadsheet().values_batch_get, [f"{quote_sheet(name)}!1:1"])
+        current = (response['valueRanges'][0].get('values') or [[]])[0]
+    
+    wanted = current + [column for column in list(headers) + [ARCHIVE_BATCH_COLUMN]
+                        if column and column not in current]
+    if wanted != current:
+        if len(wanted) > sheet.col_count:
+            sheets_call(sheet.resize, cols=len(wanted))
+        sheets_call(sheet.batch_update, [{'range': f"A1:{column_letter(len(wanted) - 1)}1", 'values': [wanted]}])
+        t.header_maps.pop(name, None)
+    return sheet, wanted
+
+def archive_sizes(columns):
+    """Число строк в листах архива одним batchGet по столбцу партии (он заполнен всегда).
+    columns — {лист: номер столбца партии}"""
+    names = list(columns)
+    ranges = [f"{quote_sheet(name)}!{column_letter(columns[name])}2:{column_letter(columns[name])}"
+              for name in names]
+    response = sheets_call(get_spreadsheet().values_batch_get, ranges)
+    return {name: len(value_range.get('values', []))
+            for name, value_range in zip(names, response.get('valueRanges', []))}
+
+def plan_archive_batch(conn, store, today):
+    """Записать в журнал следующую пачку: какие строки и в какие строки какого архива.
+    Возвращает id пачки или None, если переносить нечего"""
+    candidates = archive_candidates(store, today)
+    if not candidates:
+        return None
+    
+    layouts = {name: prepare_archive_sheet(name, store.headers)[1]
+               for name in dict.fromkeys(name for _, name in candidates)}
+    sizes = archive_sizes({name: layout.index(ARCHIVE_BATCH_COLUMN) for name, layout in layouts.items()})
+    # Сколько строк с тем же ключом в листе: по этому числу потом видно, прошло ли удаление
+    copies = collections.Counter(store.key(idx) for idx in range(len(store)))
+    
+    batch_id = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    moves = []
+    for seq, (idx, name) in enumerate(candidates):
+        sizes[name] += 1
+        key = store.key(idx)
+        moves.append((batch_id, seq, name, sizes[name] + 1, row_content(store.row(idx)),
+                      copies[key], key, sheet_row(idx)))
+    with conn:
+        conn.execute("INSERT INTO batches VALUES (?, 'planned', ?, ?, NULL)",
+                     (batch_id, json.dumps(store.headers, ensure_ascii=False), time.time()))
+        conn.executemany("INSERT INTO moves VALUES (?, ?, ?, ?, ?, ?, ?, ?)", moves)
+    print(f"Archive batch {batch_id} planned: {len(moves)} rows", flush=True)
+    return batch_id
+
+def write_archive_rows(batch_id, headers, by_sheet):
+    """Записать строки в заданные строки листов архива (повтор перезаписывает те же ячейки).
+    by_sheet — {лист: {номер строки: значения в порядке headers или None — очистить}}"""
+    t = tenant()
+    for name, rows in by_sheet.items():
+        sheet, layout = prepare_archive_sheet(name, headers)
+        if max(rows) > sheet.row_count:
+            sheets_call(sheet.resize, rows=max(rows))
+        
+        def cells(values):
+            if values is None:
+                return [''] * len(layout)
+            record = dict(zip(headers, values))
+            return [batch_id if column == ARCHIVE_BATCH_COLUMN else record.get(column, '') for column in layout]
+        
+        last = column_letter(len(layout) - 1)
+        data = [
+            {'range': f"A{first}:{last}{end}", 'values': [cells(rows[row]) for row in range(first, end + 1)]}
+            for first, end in row_spans(rows)
+        ]
+        sheets_call(sheet.batch_update, data)
+        with cache_lock:
+            t.records_cache.pop(name, None)
+
+def write_archive_batch(conn, batch_id, headers):
+    """planned -> written: строки пачки в выбранные при планировании строки архива"""
+    by_sheet = {}
+    for name, target_row, content in conn.execute(
+            "SELECT sheet, target_row, row FROM moves WHERE batch = ? ORDER BY seq", (batch_id,)):
+        by_sheet.setdefault(name, {})[target_row] = json.loads(content)
+    write_archive_rows(batch_id, headers, by_sheet)
+    with conn:
+        conn.execute("UPDATE batches SET state = 'written' WHERE id = ?", (batch_id,))
+
+def match_archived_rows(store, moves):
+    """Найти записи пачки в свежем листе по ключу: {seq: номер записи} и seq ненайденных.
+    Строк с ключом сверх тех, что в пачку не входили, — столько записей пачки ещё в листе;
+    среди одинаковых ключей сначала берём строку на прежнем месте, затем с тем же содержимым"""
+    by_key = {}
+    for move in moves:
+        by_key.setdefault(move['key'], []).append(move)
+    found = {}
+    for idx in range(len(store)):
+        key = store.key(idx)
+        if key in by_key:
+            found.setdefault(key, []).append(idx)
+    
+    pairs, lost = {}, []
+    for key, items in by_key.items():
+        pool = found.get(key, [])
+        present = max(0, min(len(items), len(pool) - (items[0]['copies'] - len(items))))
+        waiting = list(items)
+        for same in (lambda move, idx: sheet_row(idx) == move['source_row'],
+                     lambda move, idx: row_content(store.row(idx)) == move['row'],
+                     lambda move, idx: True):
+            for move in list(waiting):
+                if len(items) - len(waiting) == present:
+                    break
+                idx = next((idx for idx in pool if same(move, idx)), None)
+                if idx is not None:
+                    pairs[move['seq']] = idx
+                    pool.remove(idx)
+                    waiting.remove(move)
+        lost += [move['seq'] for move in waiting]
+    return pairs, lost
+
+def delete_archived_rows(conn, batch_id, headers, state):
+    """written -> done: удалить перенесённые строки из «Ввод_бот» одним запросом.
+    Изменённые после записи в архив строки сначала переписываются в архив; если запись
+    не найти по ключу (ключевое поле исправили или строку удалили вручную), её копия
+    в архиве очищается — исправленная запись уедет следующей пачкой.
+    Кэш «Ввод_бот» должен быть только что перечитан целиком. Возвращает число удалённых строк"""
+    store = get_cached_entry(EDITABLE_SHEET)['records']
+    if store.headers != headers:
+        raise RecordChanged(f'{EDITABLE_SHEET} headers changed since batch {batch_id}')
+    
+    columns = ('seq', 'sheet', 'target_row', 'row', 'copies', 'key', 'source_row')
+    moves = [dict(zip(columns, values)) for values in conn.execute(
+        f"SELECT {', '.join(columns)} FROM moves WHERE batch = ? ORDER BY seq", (batch_id,))]
+    pairs, lost = match_archived_rows(store, moves)
+    if state == 'deleting' and not pairs:
+        # Удаление уже прошло, а ответ потерялся
+        return finish_archive_batch(conn, batch_id, 0)
+    
+    fixes, changed = {}, []
+    for move in moves:
+        if move['seq'] in pairs:
+            current = store.row(pairs[move['seq']])
+            if row_content(current) != move['row']:
+                fixes.setdefault(move['sheet'], {})[move['target_row']] = current
+                changed.append((row_content(current), batch_id, move['seq']))
+        elif move['seq'] in lost:
+            fixes.setdefault(move['sheet'], {})[move['target_row']] = None
+    if fixes:
+        write_archive_rows(batch_id, headers, fixes)
+        with conn:
+            conn.executemany("UPDATE moves SET row = ? WHERE batch = ? AND seq = ?", changed)
+            for move in moves:
+                if move['seq'] in lost:
+                    conn.execute("DELETE FROM moves WHERE batch = ? AND seq = ?", (batch_id, move['seq']))
+                    conn.execute("UPDATE moves SET copies = copies - 1 WHERE batch = ? AND key = ?",
+                                 (batch_id, move['key']))
+        print(f"Archive batch {batch_id}: {len(changed)} rows re-copied, {len(lost)} dropped", flush=True)
+    
+    targets = {sheet_row(idx): row_content(store.row(idx)) for idx in pairs.values()}
+    if targets:
+        sheet = get_sheet(EDITABLE_SHEET)
+        if not sheet:
+            raise SheetsUnavailable(f'no sheet {EDITABLE_SHEET}')
+        # Снизу вверх, чтобы удаление одного диапазона не сдвигало следующий
+        body = {'requests': [
+            {'deleteDimension': {'range': {'sheetId': sheet.id, 'dimension': 'ROWS',
+                                           'startIndex': first - 1, 'endIndex': end}}}
+            for first, end in reversed(row_spans(targets))
+        ]}
+        # Правки записей ждут, пока строки проверяются и удаляются
+        with tenant().write_lock:
+            # Перед удалением строки должны совпадать с архивом целиком, а не только по ключу
+            actual = fetch_rows(EDITABLE_SHEET, headers, targets)
+            mismatched = [row for row, content in targets.items() if row_content(actual.get(row, [])) != content]
+            if mismatched:
+                raise RecordChanged(f'rows changed: {mismatched}')
+            with conn:
+                conn.execute("UPDATE batches SET state = 'deleting' WHERE id = ?", (batch_id,))
+            sheet_rows_removed(EDITABLE_SHEET, len(targets))
+            sheets_call_once(get_spreadsheet().batch_update, body)
+    return finish_archive_batch(conn, batch_id, len(targets))
+
+def finish_archive_batch(conn, batch_id, removed):
+    with conn:
+        conn.execute("UPDATE batches SET state = 'done', finished_at = ? WHERE id = ?", (time.time(), batch_id))
+        conn.execute("DELETE FROM moves WHERE batch = ?", (batch_id,))
+    print(f"Archive batch {batch_id} done: {removed} rows removed from {EDITABLE_SHEET}", flush=True)
+    return removed
+
+def run_archive():
+    """Перенос истёкших записей текущей клиники: сначала дописываем прерванную пачку
+    из журнала, затем новые, пока есть что переносить (не больше ARCHIVE_MAX_BATCHES)"""
+    t = tenant()
+    ensure_snapshot_loaded()
+    today = datetime.now().date()
+    report = {'tenant': t.id, 'batches': 0, 'moved': 0, 'removed': 0}
+    conn = open_archive_journal()
+    stale = False  # кэш «Ввод_бот» не перечитан после удаления строк
+    try:
+        # Отложенные правки ищут записи по ключу — до переноса они должны попасть в лист
+        if not flush_pending_writes():
+            raise SheetsUnavailable('pending writes not flushed')
+        while report['batches'] < ARCHIVE_MAX_BATCHES:
+            # Номера строк для удаления — только по свежему листу
+            if not refresh_sheets([EDITABLE_SHEET], full=True):
+                raise SheetsUnavailable(f'no data for {EDITABLE_SHEET}')
+            stale = False
+            store = get_cached_entry(EDITABLE_SHEET)['records']
+            
+            pending = conn.execute("SELECT id, state, headers FROM batches WHERE state != 'done' "
+                                   "ORDER BY created_at LIMIT 1").fetchone()
+            if pending:
+                batch_id, state, headers = pending[0], pending[1], json.loads(pending[2])
+                print(f"Archive batch {batch_id} resumed ({state})", flush=True)
+            else:
+                batch_id, state, headers = plan_archive_batch(conn, store, today), 'planned', store.headers
+                if batch_id is None:
+                    break
+            
+            report['moved'] += conn.execute("SELECT COUNT(*) FROM moves WHERE batch = ?", (batch_id,)).fetchone()[0]
+            if state == 'planned':
+                write_archive_batch(conn, batch_id, headers)
+            removed = delete_archived_rows(conn, batch_id, headers, state)
+            stale = stale or bool(removed)
+            report['batches'] += 1
+            report['removed'] += removed
+            if not removed and not pending:
+                # Не удалили ни одной строки новой пачки — дальше планировать те же строки нельзя
+                report['error'] = f'batch {batch_id}: nothing removed'
+                break
+    except (SheetsUnavailable, RecordChanged) as e:
+        # Журнал остаётся: следующий запуск продолжит с того же шага
+        print(f"Archive interrupted: {e}", flush=True)
+        report['error'] = str(e)
+        stale = True  # удаление могло пройти без ответа
+    finally:
+        conn.close()
+    if stale:
+        refresh_sheets_async([EDITABLE_SHEET], full=True)
+    print(f"Archive: {report}", flush=True)
+    return report
+
+def run_archive_all():
+    """Задание архивации по всем клиникам; параллельно второе не запускается"""
+    run_admin_job(archive_job_lock, archive_job, run_archive)
+
+def archive_response(method, secret):
+    return admin_job_response(archive_job, run_archive_all, method, secret)
+
+@app.route('/admin/archive', methods=['GET', 'POST'])
+def admin_archive():
+    secret = request.headers.get('X-Admin-Secret') or request.args.get('secret', '')
+    status, body, content_type = archive_response(request.method, secret)
+    return app.response_class(body, status=status, mimetype=content_type.split(';')[0])
+
+# ============ ПРОФИЛИРОВАНИЕ ============
+# По требованию: каждый PROFILE_SAMPLE-й апдейт (или запрос с заголовком
+# X-Profile-Secret) выполняется под cProfile. Профили и сводка top-N самых
+# тяжёлых функций пишутся в PROFILE_DIR и доступны на /debug/profiles.
+# При выключенном профилировании на апдейт — одна проверка настроек.
+PROFILE_SAMPLE = int(os.environ.get('PROFILE_SAMPLE', 0))  # 0 — выключено
+PROFILE_SECRET = os.environ.get('PROFILE_SECRET', '')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 200))   # сколько последних профилей хранить
+PROFILE_TOP = int(os.environ.get('PROFILE_TOP', 30))
+PROFILE_SUMMARY = 'top.txt'
+
+_profile_counter = itertools.count(1)  # для выборки 1 из PROFILE_SAMPLE
+_profile_seq = itertools.count(1)      # для уникальных имён файлов
+_summary_lock = threading.Lock()
+# С Python 3.12 в процессе активен только один cProfile: пока идёт один профиль,
+# остальные выбранные апдейты обрабатываются без профилирования
+_profiler_lock = threading.Lock()
+
+def profile_requested(secret):
+    """Профилировать ли этот запрос: по секретному заголовку или 1 из PROFILE_SAMPLE"""
+    if not PROFILE_SAMPLE and not PROFILE_SECRET:
+        return False
+    if PROFILE_SECRET and secret == PROFILE_SECRET:
+        return True
+    return PROFILE_SAMPLE > 0 and next(_profile_counter) % PROFILE_SAMPLE == 0
+
+def update_kind(data):
+    """Короткая метка апдейта для имени файла профиля"""
+    if not isinstance(data, dict):
+        return 'empty'
+    if 'callback_query' in data:
+        action = str(data['callback_query'].get('data', '')).split(':', 1)[0]
+        return f"callback-{re.sub(r'[^a-z_]', '', action)[:20] or 'other'}"
+    if 'message' in data:
+        text = data['message'].get('text', '')
+        return f"command-{re.sub(r'[^a-z_]', '', text[1:].split(' ', 1)[0])[:20]}" if text.startswith('/') else 'message'
+    return 'other'
+
+def run_profiled(label, func, *args):
+    """Выполнить func под cProfile и сохранить профиль в PROFILE_DIR.
+    Если профилировщик уже занят (другим апдейтом или инструментом) — просто выполнить func"""
+    import cProfile
+    
+    if not _profiler_lock.acquire(blocking=False):
+        return func(*args)
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        _profiler_lock.release()
+        print(f"Profiling skipped: {e}", flush=True)
+        return func(*args)
+    
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+        _profiler_lock.release()
+        elapsed = (time.perf_counter() - started) * 1000
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            name = f"{datetime.now():%Y%m%d-%H%M%S}-{next(_profile_seq)}-{label}-{elapsed:.0f}ms.prof"
+            profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+            print(f"Profile saved: {name}", flush=True)
+            start_thread(update_profile_summary)
+        except Exception as e:
+            print(f"Error saving profile: {e}", flush=True)
+
+def profile_files():
+    """Сохранённые профили, от новых к старым"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    names = [name for name in os.listdir(PROFILE_DIR) if name.endswith('.prof')]
+    return sorted(names, key=lambda name: os.path.getmtime(os.path.join(PROFILE_DIR, name)), reverse=True)
+
+def update_profile_summary():
+    """Удалить старые профили и пересчитать сводку top-N по оставшимся"""
+    import io
+    import pstats
+    
+    with _summary_lock:
+        names = profile_files()
+        for name in names[PROFILE_KEEP:]:
+            os.remove(os.path.join(PROFILE_DIR, name))
+        names = names[:PROFILE_KEEP]
+        if not names:
+            return
+        
+        out = io.StringIO()
+        out.write(f"Профилей: {len(names)}\n\n")
+        stats = pstats.Stats(*(os.path.join(PROFILE_DIR, name) for name in names), stream=out)
+        stats.strip_dirs()
+        for order in ('tottime', 'cumulative'):
+            out.write(f"===== top {PROFILE_TOP} by {order} =====\n")
+            stats.sort_stats(order).print_stats(PROFILE_TOP)
+        
+        tmp_path = os.path.join(PROFILE_DIR, f"{PROFILE_SUMMARY}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(out.getvalue())
+        os.replace(tmp_path, os.path.join(PROFILE_DIR, PROFILE_SUMMARY))
+
+def profiles_response(name, secret):
+    """Ответ админского маршрута: (статус, тело, content-type).
+    Без PROFILE_SECRET или с неверным секретом маршрута как будто нет"""
+    if not PROFILE_SECRET or secret != PROFILE_SECRET:
+        return 404, 'not found', 'text/plain; charset=utf-8'
+    
+    if not name:
+        summary_path = os.path.join(PROFILE_DIR, PROFILE_SUMMARY)
+        summary = ''
+        if os.path.exists(summary_path):
+            with open(summary_path, encoding='utf-8') as f:
+                summary = f.read()
+        listing = '\n'.join(profile_files()[:50])
+        return 200, f"{summary or 'Профилей пока нет'}\n\n===== последние профили =====\n{listing}\n", 'text/plain; charset=utf-8'
+    
+    if name != os.path.basename(name) or not name.endswith('.prof'):
+        return 404, 'not found', 'text/plain; charset=utf-8'
+    path = os.path.join(PROFILE_DIR, name)
+    if not os.path.exists(path):
+        return 404, 'not found', 'text/plain; charset=utf-8'
+    with open(path, 'rb') as f:
+        return 200, f.read(), 'application/octet-stream'
+
+@app.route('/debug/profiles')
+@app.route('/debug/profiles/<name>')
+def debug_profiles(name=None):
+    """Сводка профилей и скачивание отдельных .prof (python -m pstats / snakeviz)"""
+    secret = request.headers.get('X-Profile-Secret') or request.args.get('secret', '')
+    status, body, content_type = profiles_response(name, secret)
+    return app.response_class(body, status=status, mimetype=content_type.split(';')[0])
+
 # ============ WEBHOOK SETUP ============
 def set_webhook():
     """Устанавливает вебхук в Telegram при старте сервера"""
@@ -983,23 +4230,199 @@ def set_webhook():
         'drop_pending_updates': True
     }
     
-    try:
-        response = requests.post(api_url, json=payload, timeout=10)
-        result = response.json()
-        print(f"✅ Webhook set: {webhook_url}", flush=True)
-        print(f"Response: {result}", flush=True)
-        return result.get('ok', False)
-    except Exception as e:
-        print(f"❌ Error setting webhook: {e}", flush=True)
-        return False
+    for attempt in range(1, 4):
+        try:
+            response = http_session.post(api_url, json=payload, timeout=10)
+            result = response.json()
+            print(f"✅ Webhook set: {webhook_url}", flush=True)
+            print(f"Response: {result}", flush=True)
+            readiness['webhook'] = result.get('ok', False)
+            if readiness['webhook']:
+                return True
+        except Exception as e:
+            print(f"❌ Error setting webhook (attempt {attempt}): {e}", flush=True)
+            readiness['webhook'] = False
+        if attempt < 3:
+            time.sleep(2 ** attempt)
+    return False
+
+def set_webhook_in_background():
+    """Регистрация вебхука после того, как сервер уже слушает порт"""
+    start_thread(set_webhook)
 
 @app.route('/')
 def health():
     return f"{EMOJI['logo']} БДПЖ Боровск - Бот работает!"
 
-if __name__ == '__main__':
-    set_webhook()
+@app.route('/healthz')
+def liveness():
+    """Процесс жив и отвечает на запросы"""
+    return 'ok'
+
+@app.route('/readyz')
+def readiness_check():
+    """Готов обслуживать вебхуки: данные таблицы загружены (из снимка или Sheets)"""
+    ready, report = readiness_report()
+    return app.response_class(
+        json.dumps(report, ensure_ascii=False),
+        status=200 if ready else 503,
+        mimetype='application/json'
+    )
+
+# ============ ASYNC РЕЖИМ (ASGI) ============
+# SERVE_MODE=asgi: вебхук и Bot API работают на asyncio (uvicorn + httpx),
+# а логика диалога и блокирующие вызовы gspread выполняются в ограниченном
+# пуле потоков. Логика та же, что и в Flask-режиме: process_update().
+SERVE_MODE = os.environ.get('SERVE_MODE', 'wsgi')
+SHEETS_WORKERS = int(os.environ.get('SHEETS_WORKERS', 16))
+
+_executor = None
+_async_client = None
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _executor = ThreadPoolExecutor(max_workers=SHEETS_WORKERS, thread_name_prefix='sheets')
+    return _executor
+
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        import httpx
+        _async_client = httpx.AsyncClient(
+            base_url=f'https://api.telegram.org/bot{TOKEN}/',
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=10
+        )
+    return _async_client
+
+async def run_blocking(func, *args):
+    """Выполнить блокирующую функцию в пуле потоков, сохранив contextvars"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(get_executor(), lambda: ctx.run(func, *args))
+
+async def flush_outbox(outbox):
+    """Отправить накопленные вызовы Bot API по порядку"""
+    client = get_async_client()
+    for call in outbox:
+        try:
+            if call['files']:
+                uploads = {}
+                try:
+                    uploads = open_uploads(call['files'])
+                    response = await client.post(call['method'], data=encode_form(call['payload']),
+                                                 files=uploads, timeout=call['timeout'])
+                finally:
+                    close_uploads(uploads, call['files'], call['remove_files'])
+            else:
+                response = await client.post(call['method'], json=call['payload'], timeout=call['timeout'])
+            print(f"{call['method']} (async): chat={call['payload'].get('chat_id')}, "
+                  f"status={response.status_code}", flush=True)
+            if call['on_result']:
+                call['on_result'](response.json())
+        except Exception as e:
+            print(f"Error in async {call['method']}: {e}", flush=True)
+
+async def process_update_async(data, profile=False):
+    """Обработать апдейт в пуле потоков, затем асинхронно отправить ответы.
+    Профилируется только обработка в потоке: вызовы Bot API идут уже после"""
+    outbox = []
     
-    port = int(os.environ.get('PORT', 10000))
-    app.run(host='0.0.0.0', port=port)
+    def run():
+        _outbox.set(outbox)
+        if profile:
+            return run_profiled(update_kind(data), process_update, data)
+        return process_update(data)
+    
+    await run_blocking(run)
+    await flush_outbox(outbox)
+
+async def asgi_send_response(send, status, body, content_type='text/plain; charset=utf-8'):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type.encode())]})
+    await send({'type': 'http.response.body', 'body': body if isinstance(body, bytes) else body.encode()})
+
+async def asgi_app(scope, receive, send):
+    """Минимальное ASGI-приложение: /webhook, /, /healthz, /readyz, /debug/profiles,
+    /admin/sms-reminders, /admin/archive"""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                readiness['listening_ms'] = round((time.perf_counter() - STARTED_AT) * 1000, 1)
+                print(f"ASGI startup, import-to-ready {readiness['listening_ms']} ms", flush=True)
+                set_webhook_in_background()
+                load_in_background()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if _async_client is not None:
+                    await _async_client.aclose()
+                if _executor is not None:
+                    _executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    
+    if scope['type'] != 'http':
+        return
+    
+    path = scope['path']
+    headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope.get('headers', [])}
+    if path == '/webhook' and scope['method'] == 'POST':
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        print("=" * 50, flush=True)
+        print("WEBHOOK CALLED (async)", flush=True)
+        try:
+            data = json.loads(body or b'null')
+        except ValueError as e:
+            print(f"Bad webhook payload: {e}", flush=True)
+            data = None
+        await process_update_async(data, profile_requested(headers.get('x-profile-secret')))
+        await asgi_send_response(send, 200, 'ok')
+    elif path == '/':
+        await asgi_send_response(send, 200, health())
+    elif path == '/healthz':
+        await asgi_send_response(send, 200, 'ok')
+    elif path == '/readyz':
+        ready, report = readiness_report()
+        await asgi_send_response(send, 200 if ready else 503,
+                                 json.dumps(report, ensure_ascii=False),
+                                 'application/json')
+    elif path in ('/admin/sms-reminders', '/admin/archive'):
+        from urllib.parse import parse_qs
+        query = parse_qs(scope.get('query_string', b'').decode())
+        secret = headers.get('x-admin-secret') or query.get('secret', [''])[0]
+        respond = reminders_response if path == '/admin/sms-reminders' else archive_response
+        await asgi_send_response(send, *respond(scope['method'], secret))
+    elif path == '/debug/profiles' or path.startswith('/debug/profiles/'):
+        from urllib.parse import parse_qs
+        query = parse_qs(scope.get('query_string', b'').decode())
+        secret = headers.get('x-profile-secret') or query.get('secret', [''])[0]
+        name = path[len('/debug/profiles/'):] if path.startswith('/debug/profiles/') else None
+        await asgi_send_response(send, *profiles_response(name, secret))
+    else:
+        await asgi_send_response(send, 404, 'not found')
 
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', 10000))
+    
+    if SERVE_MODE == 'asgi':
+        import uvicorn
+        uvicorn.run(asgi_app, host='0.0.0.0', port=port, lifespan='on')
+    else:
+        from werkzeug.serving import make_server
+        
+        server = make_server('0.0.0.0', port, app, threaded=True)
+        readiness['listening_ms'] = round((time.perf_counter() - STARTED_AT) * 1000, 1)
+        print(f"Listening on :{port}, import-to-listening {readiness['listening_ms']} ms", flush=True)
+        
+        set_webhook_in_background()
+        load_in_background()
+        server.serve_forever()
@@ -0,0 +1,143 @@
+"""Таблица в памяти с тем подмножеством API gspread, которым пользуется bot.py"""
+import re
+
+
+def column_index(letters):
+    idx = 0
+    for ch in letters:
+        idx = idx * 26 + ord(ch) - 64
+    return idx - 1
+
+
+def parse_a1(a1):
+    """'A2:Q' -> (строка, столбец, строка, столбец) с нуля включительно; None — до конца"""
+    match = re.fullmatch(r'\$?([A-Z]*)\$?(\d*)(?::\$?([A-Z]*)\$?(\d*))?', a1)
+    c0, r0, c1, r1 = match.groups()
+    if c1 is None and r1 is None:
+        c1, r1 = c0, r0
+    col = lambda letters: column_index(letters) if letters else None
+    row = lambda digits: int(digits) - 1 if digits else None
+    return row(r0), col(c0), row(r1), col(c1)
+
+
+class FakeWorksheet:
+    _ids = [0]
+
+    def __init__(self, spreadsheet, title, rows=1000, cols=26):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.data = []
+        self.row_count = rows
+        self.col_count = cols
+        FakeWorksheet._ids[0] += 1
+        self.id = FakeWorksheet._ids[0]
+
+    def get(self, a1=None):
+        if a1 is None:
+            return [list(row) for row in self.data]
+        r0, c0, r1, c1 = parse_a1(a1)
+        r0, c0 = r0 or 0, c0 or 0
+        r1 = len(self.data) - 1 if r1 is None else min(r1, len(self.data) - 1)
+        out = []
+        for r in range(r0, r1 + 1):
+            row = self.data[r]
+            values = row[c0:(len(row) if c1 is None else c1 + 1)]
+            while values and values[-1] == '':
+                values = values[:-1]
+            out.append(values)
+        while out and not out[-1]:
+            out.pop()
+        return out
+
+    def put(self, a1, values):
+        r0, c0, _, _ = parse_a1(a1)
+        for i, row_values in enumerate(values):
+            r = r0 + i
+            if r >= self.row_count:
+                raise Exception('exceeds grid limits')
+            while len(self.data) <= r:
+                self.data.append([])
+            row = self.data[r]
+            for j, value in enumerate(row_values):
+                while len(row) <= c0 + j:
+                    row.append('')
+                row[c0 + j] = value
+
+    def batch_update(self, data, **kwargs):
+        self.spreadsheet.calls.append(('batch_update', self.title))
+        for item in data:
+            self.put(item['range'], item['values'])
+
+    def append_row(self, row, **kwargs):
+        return self.append_rows([row], **kwargs)
+
+    def append_rows(self, rows, **kwargs):
+        first = len(self.data) + 1
+        for row in rows:
+            self.data.append([str(value) for value in row])
+        self.row_count = max(self.row_count, len(self.data))
+        updated = f"'{self.title}'!A{first}:Z{len(self.data)}"
+        return {'updates': {'updatedRange': updated, 'updatedRows': len(rows)}}
+
+    def resize(self, rows=None, cols=None):
+        if rows:
+            self.row_count = rows
+        if cols:
+            self.col_count = cols
+
+
+class FakeSpreadsheet:
+
+    def __init__(self):
+        self.sheets = {}
+        self.calls = []
+        self.fail_delete_after = False  # удаление проходит, но ответ теряется
+
+    def add(self, title, rows):
+        sheet = FakeWorksheet(self, title, max(1000, len(rows)))
+        sheet.data = [[str(value) for value in row] for row in rows]
+        self.sheets[title] = sheet
+        return sheet
+
+    def values_batch_get(self, ranges, params=None):
+        self.calls.append(('values_batch_get', len(ranges)))
+        out = []
+        for rng in ranges:
+            name, a1 = rng.split('!', 1) if '!' in rng else (rng, None)
+            values = self.sheets[name.strip("'").replace("''", "'")].get(a1)
+            if params and params.get('majorDimension') == 'COLUMNS':
+                values = [list(column) for column in zip(*values)] if values else []
+            out.append({'values': values} if values else {})
+        return {'valueRanges': out}
+
+    def worksheets(self):
+        return list(self.sheets.values())
+
+    def worksheet(self, title):
+        if title not in self.sheets:
+            raise Exception(f'WorksheetNotFound: {title}')
+        return self.sheets[title]
+
+    def add_worksheet(self, title, rows, cols, index=None):
+        sheet = FakeWorksheet(self, title, rows, cols)
+        self.sheets[title] = sheet
+        return sheet
+
+    def batch_update(self, body):
+        self.calls.append(('spreadsheet_batch_update', len(body['requests'])))
+        for request in body['requests']:
+            rng = request['deleteDimension']['range']
+            sheet = next(s for s in self.sheets.values() if s.id == rng['sheetId'])
+            del sheet.data[rng['startIndex']:rng['endIndex']]
+        if self.fail_delete_after:
+            self.fail_delete_after = False
+            raise ConnectionError('connection aborted')
+
+
+class FakeClient:
+
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open_by_key(self, key):
+        return self.spreadsheet
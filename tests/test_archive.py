@@ -0,0 +1,286 @@
+import collections
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+# bot.py читает настройки при импорте
+os.environ.setdefault('BOT_TOKEN', 'test')
+os.environ.setdefault('SHEET_ID', 'test-sheet')
+os.environ.setdefault('SNAPSHOT_PATH', os.path.join(tempfile.gettempdir(), 'bdpj_test_snapshot.sqlite3'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bot
+from fake_sheets import FakeClient, FakeSpreadsheet
+
+HEADERS = ['ФИО', 'Телефон', 'Кличка', 'Тип_прививки', 'Дата_прививки', 'Срок_мес', 'Статус_обработки']
+
+
+def record(fio, date='01.03.2019', term='12', status='Новый', pet='Бобик'):
+    """Строка «Ввод_бот»; по умолчанию срок истёк давно — запись уедет в архив"""
+    return [fio, '89001234567', pet, 'Бешенство', date, term, status]
+
+
+FRESH = record('Свежая Запись', date='01.03.2026')
+
+
+class ArchiveTestCase(unittest.TestCase):
+
+    rows = []
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.spreadsheet = FakeSpreadsheet()
+        self.hot = self.spreadsheet.add(bot.EDITABLE_SHEET, [HEADERS] + self.rows)
+        self.tenant = bot.Tenant('test', 'test-sheet', snapshot_path=os.path.join(self.tmp.name, 'snap.sqlite3'))
+        self.tenant.loaded = True
+        for patch in [
+            mock.patch.object(bot, '_client', FakeClient(self.spreadsheet)),
+            mock.patch.object(bot, 'sheets_budget', bot.RateBudget(10000)),
+            mock.patch.object(bot, 'schedule_snapshot', lambda: None),
+            mock.patch.object(bot, 'refresh_sheets_async', mock.Mock()),
+            mock.patch.object(bot, 'refresh_records_async', mock.Mock()),
+        ]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def in_tenant(self, func, *args):
+        return bot.run_for_tenant(self.tenant, func, *args)
+
+    def run_archive(self):
+        return self.in_tenant(bot.run_archive)
+
+    def batch_states(self):
+        conn = sqlite3.connect(bot.archive_journal_path(self.tenant))
+        try:
+            return [state for state, in conn.execute("SELECT state FROM batches ORDER BY created_at")]
+        finally:
+            conn.close()
+
+    def hot_rows(self):
+        return [tuple(str(value) for value in row[:len(HEADERS)]) for row in self.hot.data[1:]]
+
+    def archived_rows(self):
+        """Непустые строки всех листов архива в порядке HEADERS"""
+        rows = []
+        for name, sheet in self.spreadsheet.sheets.items():
+            if not bot.is_archive_sheet(name) or not sheet.data:
+                continue
+            header = sheet.data[0]
+            for row in sheet.data[1:]:
+                if any(str(value) for value in row):
+                    values = dict(zip(header, row))
+                    rows.append(tuple(str(values.get(column, '')) for column in HEADERS))
+        return rows
+
+    def assertMovedOnce(self, expected_hot, expected_archive):
+        """Каждая запись ровно в одном месте: в оперативном листе или в архиве"""
+        as_tuples = lambda rows: collections.Counter(tuple(str(value) for value in row) for row in rows)
+        self.assertEqual(collections.Counter(self.hot_rows()), as_tuples(expected_hot))
+        self.assertEqual(collections.Counter(self.archived_rows()), as_tuples(expected_archive))
+
+    def cached_target(self, fio):
+        """(номер строки, ключ) записи из кэша — так адресуют правки кнопки и команды"""
+        def find():
+            store = bot.get_cached_entry(bot.EDITABLE_SHEET)['records']
+            idx = next(i for i in range(len(store)) if store[i]['ФИО'] == fio)
+            return bot.sheet_row(idx), store.key(idx)
+        return self.in_tenant(find)
+
+
+class WriteLockTest(ArchiveTestCase):
+    """Правка записи и удаление перенесённых строк не перемежаются"""
+
+    rows = [record('Старая Один'), record('Старая Два'), FRESH]
+
+    def pause_after(self, name):
+        """Обернуть bot.<name>: после вызова сообщить и подождать разрешения продолжить"""
+        reached, proceed = threading.Event(), threading.Event()
+        real = getattr(bot, name)
+
+        def wrapper(*args, **kwargs):
+            result = real(*args, **kwargs)
+            reached.set()
+            proceed.wait(5)
+            return result
+
+        patch = mock.patch.object(bot, name, wrapper)
+        patch.start()
+        self.addCleanup(patch.stop)
+        return reached, proceed
+
+    def start(self, func, *args):
+        result = {}
+
+        def run():
+            try:
+                result['value'] = self.in_tenant(func, *args)
+            except Exception as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread, result
+
+    def test_archive_delete_waits_for_checked_edit(self):
+        self.in_tenant(bot.refresh_sheets, [bot.EDITABLE_SHEET], True)
+        row, key = self.cached_target('Свежая Запись')
+        checked, proceed = self.pause_after('verify_rows')
+
+        edit, edited = self.start(bot.update_records, [(row, key, {'Статус_обработки': 'Обработан'})])
+        self.assertTrue(checked.wait(5))
+        archive, _ = self.start(bot.run_archive)
+        time.sleep(0.3)
+        self.assertEqual(len(self.hot_rows()), 3, 'rows deleted between check and write of an edit')
+        proceed.set()
+        edit.join(5)
+        archive.join(5)
+
+        self.assertEqual(edited, {'value': 1})
+        self.assertMovedOnce([record('Свежая Запись', date='01.03.2026', status='Обработан')],
+                             [record('Старая Один'), record('Старая Два')])
+
+    def test_edit_after_archive_check_does_not_touch_shifted_row(self):
+        self.in_tenant(bot.refresh_sheets, [bot.EDITABLE_SHEET], True)
+        row, key = self.cached_target('Старая Два')
+        checked, proceed = self.pause_after('fetch_rows')
+
+        archive, _ = self.start(bot.run_archive)
+        self.assertTrue(checked.wait(5))
+        edit, edited = self.start(bot.update_records, [(row, key, {'Статус_обработки': 'Обработан'})])
+        time.sleep(0.3)
+        proceed.set()
+        archive.join(5)
+        edit.join(5)
+
+        # Строка уже в архиве: правка отклонена, а не записана в чужую строку
+        self.assertIsInstance(edited.get('error'), bot.RecordChanged)
+        self.assertMovedOnce([FRESH], [record('Старая Один'), record('Старая Два')])
+
+
+class ArchiveResumeTest(ArchiveTestCase):
+    """Прерванный перенос продолжается со следующего запуска, не теряя и не задваивая строк"""
+
+    # Два года — два листа архива, чтобы можно было прервать запись посередине
+    rows = [record('Иванов'), record('Петров'), record('Сидоров', date='01.03.2020'), FRESH]
+    expired = [record('Иванов'), record('Петров'), record('Сидоров', date='01.03.2020')]
+
+    def interrupted(self, name, error=None):
+        """Запуск архивации, в котором bot.<name> падает с SheetsUnavailable"""
+        with mock.patch.object(bot, name, side_effect=error or bot.SheetsUnavailable('quota exceeded')):
+            report = self.run_archive()
+        self.assertIn('error', report)
+        return report
+
+    def test_resume_from_planned_after_partial_write(self):
+        real = bot.write_archive_rows
+
+        def first_sheet_only(batch_id, headers, by_sheet):
+            name = next(iter(by_sheet))
+            real(batch_id, headers, {name: by_sheet[name]})
+            raise bot.SheetsUnavailable('quota exceeded')
+
+        self.interrupted('write_archive_rows', first_sheet_only)
+        self.assertEqual(self.batch_states(), ['planned'])
+        self.assertEqual(len(self.archived_rows()), 2)
+
+        report = self.run_archive()
+
+        self.assertNotIn('error', report)
+        self.assertEqual(self.batch_states(), ['done'])
+        self.assertMovedOnce([FRESH], self.expired)
+
+    def test_resume_from_written(self):
+        self.interrupted('delete_archived_rows')
+        self.assertEqual(self.batch_states(), ['written'])
+        self.assertEqual(len(self.hot_rows()), 4)
+
+        report = self.run_archive()
+
+        self.assertEqual(report['removed'], 3)
+        self.assertEqual(self.batch_states(), ['done'])
+        self.assertMovedOnce([FRESH], self.expired)
+
+    def test_deleting_when_delete_went_through_but_response_was_lost(self):
+        self.spreadsheet.fail_delete_after = True
+        self.run_archive()
+        self.assertEqual(self.batch_states(), ['deleting'])
+        self.assertEqual(self.hot_rows(), [tuple(FRESH)])
+
+        report = self.run_archive()
+
+        self.assertNotIn('error', report)
+        self.assertEqual(report['removed'], 0)
+        self.assertEqual(self.batch_states(), ['done'])
+        self.assertMovedOnce([FRESH], self.expired)
+
+    def test_row_edited_between_write_and_delete_is_recopied(self):
+        self.interrupted('delete_archived_rows')
+        self.hot.data[2][HEADERS.index('Статус_обработки')] = 'Обработан'
+
+        self.run_archive()
+
+        self.assertEqual(self.batch_states(), ['done'])
+        self.assertMovedOnce([FRESH], [record('Иванов'), record('Петров', status='Обработан'),
+                                       record('Сидоров', date='01.03.2020')])
+
+    def test_row_with_edited_key_is_archived_once(self):
+        self.interrupted('delete_archived_rows')
+        self.hot.data[2][HEADERS.index('ФИО')] = 'Петров Исправленный'
+
+        report = self.run_archive()
+
+        # Копия до правки в архиве очищается, исправленная запись уезжает следующей пачкой
+        self.assertEqual(self.batch_states(), ['done', 'done'])
+        self.assertEqual(report['removed'], 3)
+        self.assertMovedOnce([FRESH], [record('Иванов'), record('Петров Исправленный'),
+                                       record('Сидоров', date='01.03.2020')])
+
+
+class ArchiveDuplicateKeysTest(ArchiveTestCase):
+    """Одинаковые ключи: по числу строк с ключом видно, сколько копий ещё не удалено"""
+
+    # Две одинаковые просроченные записи и запись с тем же ключом, но долгим сроком — она остаётся
+    LONG_TERM = record('Дубль', term='120')
+    rows = [record('Дубль'), record('Дубль'), LONG_TERM, FRESH]
+
+    def test_duplicates_when_delete_response_was_lost(self):
+        self.spreadsheet.fail_delete_after = True
+        self.run_archive()
+        self.assertEqual(self.batch_states(), ['deleting'])
+
+        self.run_archive()
+
+        self.assertEqual(self.batch_states(), ['done'])
+        self.assertMovedOnce([self.LONG_TERM, FRESH], [record('Дубль'), record('Дубль')])
+
+    def test_duplicates_resumed_from_written(self):
+        with mock.patch.object(bot, 'delete_archived_rows', side_effect=bot.SheetsUnavailable('down')):
+            self.run_archive()
+        self.assertEqual(self.batch_states(), ['written'])
+
+        self.run_archive()
+
+        self.assertEqual(self.batch_states(), ['done'])
+        self.assertMovedOnce([self.LONG_TERM, FRESH], [record('Дубль'), record('Дубль')])
+
+    def test_duplicate_removed_by_hand_before_delete(self):
+        with mock.patch.object(bot, 'delete_archived_rows', side_effect=bot.SheetsUnavailable('down')):
+            self.run_archive()
+        del self.hot.data[1]
+
+        self.run_archive()
+
+        # Одна копия удалена вручную — в архиве остаётся одна
+        self.assertEqual(self.batch_states(), ['done'])
+        self.assertMovedOnce([self.LONG_TERM, FRESH], [record('Дубль')])
+
+
+if __name__ == '__main__':
+    unittest.main()
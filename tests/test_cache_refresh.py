@@ -0,0 +1,100 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# bot.py читает настройки при импорте
+os.environ.setdefault('BOT_TOKEN', 'test')
+os.environ.setdefault('SHEET_ID', 'test-sheet')
+os.environ.setdefault('SNAPSHOT_PATH', os.path.join(tempfile.gettempdir(), 'bdpj_test_snapshot.sqlite3'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bot
+from fake_sheets import FakeClient, FakeSpreadsheet
+
+HEADERS = ['Дата_визита', 'Сотрудник_TG', 'ФИО', 'Телефон', 'Telegram', 'Адрес', 'Согласие',
+           'Вид_животного', 'Кличка', 'Пол', 'Возраст_или_ДР', 'Тип_прививки', 'Дата_прививки',
+           'Срок_мес', 'Канал', 'Статус_обработки', 'Комментарий']
+
+
+def sheet_row(fio):
+    return ['01.02.2025', '@anna', fio, '89001234567', '', '', 'Да', 'Собака', 'Бобик', 'М',
+            '2 года', 'Бешенство', '01.02.2025', '12', 'SMS', 'Новый', '']
+
+
+def survey_data(fio):
+    return {'date_visit': '01.02.2025', 'staff_tg': '@anna', 'fio': fio, 'phone': '89001234567',
+            'consent': 'Да', 'animal_type': 'Собака', 'nickname': 'Бобик', 'sex': 'М',
+            'age_or_dob': '2 года', 'vaccine_type': 'Бешенство', 'vaccine_date': '01.02.2025',
+            'term_months': '12', 'channel': 'SMS'}
+
+
+class CacheTopUpTest(unittest.TestCase):
+    """Кэш после дозаписи ботом и строк, добавленных в лист вручную"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.spreadsheet = FakeSpreadsheet()
+        self.sheet = self.spreadsheet.add('Ввод_бот', [HEADERS, sheet_row('Иванов')])
+        self.tenant = bot.Tenant('test', 'test-sheet', snapshot_path=os.path.join(self.tmp.name, 'snap.sqlite3'))
+        self.tenant.loaded = True
+        patches = [
+            mock.patch.object(bot, '_client', FakeClient(self.spreadsheet)),
+            mock.patch.object(bot, 'sheets_budget', bot.RateBudget(10000)),
+            mock.patch.object(bot, 'schedule_snapshot', lambda: None),
+            mock.patch.object(bot, 'refresh_records_async', mock.Mock()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self.tmp.cleanup)
+        self.run_in_tenant(bot.refresh_sheets, ['Ввод_бот'], True)
+
+    def run_in_tenant(self, func, *args):
+        return bot.run_for_tenant(self.tenant, func, *args)
+
+    def cached_fio(self):
+        return [record['ФИО'] for record in self.tenant.records_cache['Ввод_бот']['records']]
+
+    def test_bot_row_after_hand_added_row_is_not_duplicated(self):
+        self.sheet.append_rows([sheet_row('Ручной Ввод')])
+        self.assertEqual(self.run_in_tenant(bot.save_to_sheet, survey_data('Бот Запись')), 'saved')
+        bot.refresh_records_async.assert_called_once_with('Ввод_бот')
+
+        self.run_in_tenant(bot.refresh_sheets, ['Ввод_бот'])
+
+        self.assertEqual(self.cached_fio(), ['Иванов', 'Ручной Ввод', 'Бот Запись'])
+        self.assertEqual(self.tenant.records_cache['Ввод_бот']['sheet_rows'], 3)
+
+    def test_bot_row_right_after_known_rows_is_confirmed(self):
+        self.run_in_tenant(bot.save_to_sheet, survey_data('Бот Запись'))
+
+        self.assertEqual(self.tenant.records_cache['Ввод_бот']['sheet_rows'], 2)
+        bot.refresh_records_async.assert_not_called()
+        self.run_in_tenant(bot.refresh_sheets, ['Ввод_бот'])
+        self.assertEqual(self.cached_fio(), ['Иванов', 'Бот Запись'])
+
+    def test_queued_row_stays_after_rows_from_sheet(self):
+        with mock.patch.object(bot, 'flush_pending_writes', lambda: False):
+            self.run_in_tenant(bot.queue_write, 'Ввод_бот', sheet_row('В очереди'))
+            self.sheet.append_rows([sheet_row('Ручной Ввод')])
+            self.run_in_tenant(bot.refresh_sheets, ['Ввод_бот'])
+
+        self.assertEqual(self.cached_fio(), ['Иванов', 'Ручной Ввод', 'В очереди'])
+        self.assertEqual(self.tenant.records_cache['Ввод_бот']['sheet_rows'], 2)
+
+    def test_rows_removed_above_known_rows_trigger_full_reread(self):
+        self.sheet.append_rows([sheet_row('Петров'), sheet_row('Сидоров')])
+        self.run_in_tenant(bot.refresh_sheets, ['Ввод_бот'], True)
+        del self.sheet.data[1]
+        self.sheet.append_rows([sheet_row('Новый')])
+
+        self.run_in_tenant(bot.refresh_sheets, ['Ввод_бот'])
+
+        self.assertEqual(self.cached_fio(), ['Петров', 'Сидоров', 'Новый'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# bot.py читает настройки при импорте
+os.environ.setdefault('BOT_TOKEN', 'test')
+os.environ.setdefault('SHEET_ID', 'test-sheet')
+os.environ.setdefault('SNAPSHOT_PATH', os.path.join(tempfile.gettempdir(), 'bdpj_test_snapshot.sqlite3'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bot
+from fake_sheets import FakeClient, FakeSpreadsheet
+
+HEADERS = ['ФИО', 'Телефон', 'Кличка', 'Тип_прививки', 'Дата_прививки', 'Статус_обработки']
+
+
+def record(fio, status='Новый'):
+    return [fio, '89001234567', 'Бобик', 'Бешенство', '01.03.2026', status]
+
+
+class PendingEditsTest(unittest.TestCase):
+    """Правки записей при недоступных Sheets ставятся в очередь и вносятся по ключу"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.spreadsheet = FakeSpreadsheet()
+        self.sheet = self.spreadsheet.add(bot.EDITABLE_SHEET, [HEADERS, record('Иванов'), record('Петров')])
+        self.tenant = bot.Tenant('test', 'test-sheet', snapshot_path=os.path.join(self.tmp.name, 'snap.sqlite3'))
+        self.tenant.loaded = True
+        for patch in [
+            mock.patch.object(bot, '_client', FakeClient(self.spreadsheet)),
+            mock.patch.object(bot, 'sheets_budget', bot.RateBudget(10000)),
+            mock.patch.object(bot, 'schedule_snapshot', lambda: None),
+            mock.patch.object(bot, 'refresh_sheets_async', mock.Mock()),
+            mock.patch.object(bot, 'refresh_records_async', mock.Mock()),
+        ]:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.in_tenant(bot.refresh_sheets, [bot.EDITABLE_SHEET], True)
+
+    def in_tenant(self, func, *args):
+        return bot.run_for_tenant(self.tenant, func, *args)
+
+    def target(self, fio):
+        store = self.tenant.records_cache[bot.EDITABLE_SHEET]['records']
+        idx = next(i for i in range(len(store)) if store[i]['ФИО'] == fio)
+        return bot.sheet_row(idx), store.key(idx)
+
+    def edit_while_down(self, fio, fields):
+        row, key = self.target(fio)
+        with mock.patch.object(bot, 'verify_rows', side_effect=bot.SheetsUnavailable('circuit open')):
+            return self.in_tenant(bot.update_records, [(row, key, fields)])
+
+    def sheet_values(self, column):
+        return [row[HEADERS.index(column)] for row in self.sheet.data[1:]]
+
+    def cached_values(self, column):
+        return [record[column] for record in self.tenant.records_cache[bot.EDITABLE_SHEET]['records']]
+
+    def test_edit_is_queued_and_visible_in_cache(self):
+        self.assertEqual(self.edit_while_down('Петров', {'Статус_обработки': 'Обработан'}), 'queued')
+
+        self.assertEqual(self.cached_values('Статус_обработки'), ['Новый', 'Обработан'])
+        self.assertEqual(self.sheet_values('Статус_обработки'), ['Новый', 'Новый'])
+        self.assertTrue(self.in_tenant(bot.flush_pending_writes))
+        self.assertEqual(self.sheet_values('Статус_обработки'), ['Новый', 'Обработан'])
+        self.assertEqual(self.tenant.pending_writes, [])
+
+    def test_queued_edit_survives_cache_refresh(self):
+        self.edit_while_down('Петров', {'Статус_обработки': 'Обработан'})
+
+        with mock.patch.object(bot, 'flush_pending_writes', return_value=False):
+            self.in_tenant(bot.refresh_sheets, [bot.EDITABLE_SHEET], True)
+
+        self.assertEqual(self.cached_values('Статус_обработки'), ['Новый', 'Обработан'])
+
+    def test_edit_finds_record_by_key_after_rows_shift(self):
+        self.edit_while_down('Петров', {'Статус_обработки': 'Обработан'})
+        self.sheet.data.insert(1, [str(value) for value in record('Вставлен Вручную')])
+
+        self.in_tenant(bot.flush_pending_writes)
+
+        self.assertEqual(self.sheet_values('ФИО'), ['Вставлен Вручную', 'Иванов', 'Петров'])
+        self.assertEqual(self.sheet_values('Статус_обработки'), ['Новый', 'Новый', 'Обработан'])
+
+    def test_edit_of_deleted_record_is_dropped(self):
+        self.edit_while_down('Петров', {'Статус_обработки': 'Обработан'})
+        del self.sheet.data[2]
+
+        self.assertTrue(self.in_tenant(bot.flush_pending_writes))
+
+        self.assertEqual(self.sheet_values('Статус_обработки'), ['Новый'])
+        self.assertEqual(self.tenant.pending_writes, [])
+
+    def test_edits_after_key_change_follow_new_key(self):
+        self.edit_while_down('Петров', {'ФИО': 'Петров Исправленный'})
+        self.edit_while_down('Петров Исправленный', {'Статус_обработки': 'Обработан'})
+
+        self.in_tenant(bot.flush_pending_writes)
+
+        self.assertEqual(self.sheet.data[2][:1] + self.sheet.data[2][-1:], ['Петров Исправленный', 'Обработан'])
+
+    def test_direct_edit_sends_queued_edits_first(self):
+        self.edit_while_down('Петров', {'Статус_обработки': 'Обработан'})
+        row, key = self.target('Петров')
+
+        self.in_tenant(bot.update_records, [(row, key, {'Статус_обработки': 'Напомнено'})])
+
+        self.assertEqual(self.sheet_values('Статус_обработки'), ['Новый', 'Напомнено'])
+
+    def test_queued_edit_is_kept_in_snapshot(self):
+        self.edit_while_down('Петров', {'Статус_обработки': 'Обработан'})
+        self.in_tenant(bot.save_snapshot)
+
+        restored = bot.Tenant('test', 'test-sheet', snapshot_path=self.tenant.snapshot_path)
+        bot.run_for_tenant(restored, bot.load_snapshot)
+
+        self.assertEqual(restored.pending_writes, self.tenant.pending_writes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+# bot.py читает настройки при импорте
+os.environ.setdefault('BOT_TOKEN', 'test')
+os.environ.setdefault('SHEET_ID', 'test-sheet')
+os.environ.setdefault('SNAPSHOT_PATH', os.path.join(tempfile.gettempdir(), 'bdpj_test_snapshot.sqlite3'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+
+HEADERS = ['Дата_визита', 'Сотрудник_TG', 'ФИО', 'Телефон', 'Telegram', 'Адрес', 'Согласие',
+           'Вид_животного', 'Кличка', 'Пол', 'Возраст_или_ДР', 'Тип_прививки', 'Дата_прививки',
+           'Срок_мес', 'Канал', 'Статус_обработки', 'Комментарий']
+SURNAMES = ['Иванов', 'Петров', 'Сидоров', 'Кузнецов', 'Смирнова', 'Попова']
+
+
+def make_rows(count, seed=1):
+    """Строки «Ввод_бот» в том виде, в каком их отдаёт лист (телефон и срок — числа)"""
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(count):
+        date = f"2025-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}"
+        rows.append([
+            date, rnd.choice(['@anna', '@oleg', '@vet']), f"{rnd.choice(SURNAMES)} Иван{i} Петрович",
+            79000000000 + i, rnd.choice(['', f'user{i}']), f"г. Боровск, ул. Ленина, д. {i % 200}, кв. {i % 50}",
+            rnd.choice(['Да', 'Нет']), rnd.choice(['Собака', 'Кошка']), f"Бобик{i}", rnd.choice(['М', 'Ж']),
+            f"{rnd.randint(1, 15)} лет", rnd.choice(['Бешенство', 'Комплексная']), date, rnd.choice([12, 36]),
+            rnd.choice(['SMS', 'Telegram']), 'Новый', '',
+        ])
+    return rows
+
+
+class RecordStoreMemoryTest(unittest.TestCase):
+
+    def test_columnar_store_is_at_least_five_times_smaller_than_dicts(self):
+        rows = make_rows(20000)
+        dicts = [dict(zip(HEADERS, row)) for row in rows]
+        store = bot.RecordStore.from_rows(HEADERS, rows)
+
+        ratio = bot.dicts_memory_usage(dicts) / store.memory_usage()
+        self.assertGreaterEqual(ratio, 5, f"RecordStore only {ratio:.1f}x smaller than list of dict")
+
+    def test_store_returns_the_same_records(self):
+        rows = make_rows(500)
+        store = bot.RecordStore.from_rows(HEADERS, rows)
+
+        self.assertEqual(len(store), len(rows))
+        for idx in (0, 123, 499):
+            self.assertEqual(store[idx].to_dict(), dict(zip(HEADERS, rows[idx])))
+
+
+if __name__ == '__main__':
+    unittest.main()